@@ -0,0 +1,302 @@
+'''
+Performance benchmarks of the CarbonCast hot paths on the bundled data/ regions:
+CSV load, date/time features, scaling, training window creation, one epoch of model fit,
+walk-forward inference with the saved second tier models, carbon intensity calculation and MAPE.
+
+Throughput & latency percentiles of every benchmark are written to a results file, and compared
+against a stored baseline. The run fails (exit code 1) if any metric is worse than the baseline
+by more than REGRESSION_THRESHOLD.
+
+The second tier forecast files (weather + source production forecasts) are not bundled, so the
+forecast features are built from the bundled 96-hour source production forecasts. They have the
+right shape for the saved models, but are only meant for timing, not for accuracy.
+'''
+
+import contextlib
+import io
+import json as stdjson
+import os
+import platform
+import sys
+import time
+from datetime import datetime as dt
+
+import json5 as json
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import tensorflow as tf
+
+import carbonIntensityCalculator
+import common
+import secondTierForecasts
+import weatherForecastStore
+
+############################# MACRO START #######################################
+NUM_REPEATS = None
+NUM_WARMUP_RUNS = None
+NUM_HISTORICAL_AND_DATETIME_FEATURES = 6 # carbon intensity + 5 date/time features
+# Metrics where a higher value is better. For all other compared metrics, lower is better.
+HIGHER_IS_BETTER = ["throughput"]
+############################# MACRO END #########################################
+
+
+def runBenchmark(benchmarkFunc, setupFunc, unitsPerCall, unit):
+    # setupFunc() prepares fresh (copied) inputs for every run, and is not timed
+    global NUM_REPEATS
+    global NUM_WARMUP_RUNS
+    latencies = []
+    for run in range(NUM_WARMUP_RUNS + NUM_REPEATS):
+        args = setupFunc()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            benchmarkFunc(*args)
+            latency = time.perf_counter() - start
+        if (run >= NUM_WARMUP_RUNS):
+            latencies.append(latency)
+    return getMetrics(latencies, unitsPerCall, unit)
+
+def getMetrics(latencies, unitsPerCall, unit):
+    latencies = np.array(latencies, dtype=np.float64)
+    metrics = {"unit": unit, "units_per_call": unitsPerCall, "num_calls": len(latencies),
+            "throughput": round(unitsPerCall / np.percentile(latencies, 50), 3), # units/s
+            "latency_mean_s": round(float(np.mean(latencies)), 6),
+            "latency_p50_s": round(float(np.percentile(latencies, 50)), 6),
+            "latency_p90_s": round(float(np.percentile(latencies, 90)), 6),
+            "latency_p99_s": round(float(np.percentile(latencies, 99)), 6)}
+    print("    ", metrics["throughput"], unit+"/s, p50: ", metrics["latency_p50_s"], "s, p90: ",
+            metrics["latency_p90_s"], "s, p99: ", metrics["latency_p99_s"], "s")
+    return metrics
+
+def loadRegionData(region, numValDays, numTestDays, numForecastFeatures):
+    # Hourly data (carbon intensity + date/time features) & forecast features (96 rows per day)
+    # over the bundled source production forecast period
+    inFileName = "../data/"+region+"/"+region+"_direct_emissions.csv"
+    forecastInFileName = ("../data/"+region+"/"+region+"_96hr_source_prod_forecasts_DA_"+
+                            carbonIntensityCalculator.TEST_PERIOD+".csv")
+    startCol = 1
+    dataset = pd.read_csv(inFileName, header=0, infer_datetime_format=True,
+                            parse_dates=['UTC time'], index_col=['UTC time'])
+    forecastDataset = pd.read_csv(forecastInFileName, header=0, infer_datetime_format=True,
+                            parse_dates=['UTC time'], index_col=['UTC time'])
+    numDays = len(forecastDataset)//secondTierForecasts.MAX_PREDICTION_WINDOW_HOURS
+    startIdx = dataset.index.get_loc(forecastDataset.index[0])
+    dataset = dataset[startIdx:startIdx+numDays*24]
+    with contextlib.redirect_stdout(io.StringIO()):
+        dataset = secondTierForecasts.addDateTimeFeatures(dataset, dataset.index.values, startCol)
+    data = dataset.values[:, startCol:startCol+NUM_HISTORICAL_AND_DATETIME_FEATURES].astype(np.float64)
+    forecastData = forecastDataset.values[:numDays*secondTierForecasts.MAX_PREDICTION_WINDOW_HOURS].astype(np.float64)
+    # repeat the source production forecast columns up to the no. of forecast features of the model
+    forecastData = forecastData[:, np.arange(numForecastFeatures) % forecastData.shape[1]]
+
+    numTrainDays = numDays - numValDays - numTestDays
+    trainData, valData, testData = (data[:numTrainDays*24], data[numTrainDays*24:-numTestDays*24],
+                                    data[-numTestDays*24:])
+    # forecasts indexed by (issue day, lead hour); the test store starts with the last validation issue day
+    weatherStore = weatherForecastStore.WeatherForecastStore(forecastData,
+                    secondTierForecasts.MAX_PREDICTION_WINDOW_HOURS,
+                    forecastDataset.index.values[:len(forecastData)])
+    wTrainData, wValData, wTestData = weatherStore.splitIssueDays(numTestDays, numValDays)
+    trainData, valData, testData, _, _ = common.scaleDataset(trainData, valData, testData)
+    # scaleDataset scales in place & the val/test stores share an issue day, so scale copies of the rows
+    wTrainRows, wValRows, wTestRows, _, _ = common.scaleDataset(wTrainData.getRows().copy(),
+                    wValData.getRows().copy(), wTestData.getRows().copy())
+    wTrainData, wValData, wTestData = (wTrainData.withRows(wTrainRows), wValData.withRows(wValRows),
+                    wTestData.withRows(wTestRows))
+    regionData = {"trainData": trainData, "valData": valData, "testData": testData,
+                "wTrainData": wTrainData, "wValData": wValData, "wTestData": wTestData,
+                "inFileName": inFileName, "startCol": startCol}
+    return regionData
+
+def benchmarkRegion(region, benchmarkConfig, secondTierConfig):
+    numValDays = benchmarkConfig["NUM_VAL_DAYS"]
+    numTestDays = benchmarkConfig["NUM_TEST_DAYS"]
+    trainWindowHours = secondTierForecasts.TRAINING_WINDOW_HOURS
+    predictionWindowHours = secondTierForecasts.PREDICTION_WINDOW_HOURS
+    maxPredictionWindowHours = secondTierForecasts.MAX_PREDICTION_WINDOW_HOURS
+    results = {}
+
+    model = tf.keras.models.load_model(secondTierConfig["DIRECT_SAVED_MODEL_LOCATION"]+region+".h5")
+    numModelFeatures = model.input_shape[-1]
+    regionData = loadRegionData(region, numValDays, numTestDays,
+                                numModelFeatures-NUM_HISTORICAL_AND_DATETIME_FEATURES)
+    inFileName, startCol = regionData["inFileName"], regionData["startCol"]
+    trainData, wTrainData = regionData["trainData"], regionData["wTrainData"]
+    testData, wTestData = regionData["testData"], regionData["wTestData"]
+
+    print("  csvLoad")
+    dataset = pd.read_csv(inFileName, header=0, infer_datetime_format=True,
+                        parse_dates=['UTC time'], index_col=['UTC time'])
+    results["csvLoad"] = runBenchmark(
+            lambda: pd.read_csv(inFileName, header=0, infer_datetime_format=True,
+                                parse_dates=['UTC time'], index_col=['UTC time']),
+            lambda: (), len(dataset), "rows")
+
+    print("  addDateTimeFeatures")
+    results["addDateTimeFeatures"] = runBenchmark(secondTierForecasts.addDateTimeFeatures,
+            lambda: (dataset.copy(), dataset.index.values, startCol), len(dataset), "rows")
+
+    print("  scaleDataset")
+    data = dataset.values[:, startCol:].astype(np.float64)
+    valStart, testStart = len(data)-(numValDays+numTestDays)*24, len(data)-numTestDays*24
+    results["scaleDataset"] = runBenchmark(common.scaleDataset,
+            lambda: (data[:valStart].copy(), data[valStart:testStart].copy(), data[testStart:].copy()),
+            len(data), "rows")
+
+    print("  manipulateTrainingDataShape")
+    numWindows = len(trainData)-2*trainWindowHours+1
+    results["manipulateTrainingDataShape"] = runBenchmark(secondTierForecasts.manipulateTrainingDataShape,
+            lambda: (trainData, trainWindowHours, trainWindowHours, wTrainData), numWindows, "windows")
+
+    print("  fit (1 epoch)")
+    with contextlib.redirect_stdout(io.StringIO()):
+        X, y = secondTierForecasts.manipulateTrainingDataShape(trainData, trainWindowHours,
+                                                                trainWindowHours, wTrainData)
+    hyperParams = secondTierForecasts.getHyperParams(secondTierConfig)
+    def createCompiledModel():
+        trainModel = secondTierForecasts.createModel(X.shape[1], X.shape[2], y.shape[1], hyperParams)
+        trainModel.compile(loss=hyperParams["loss"], optimizer=tf.keras.optimizers.Adam(learning_rate=hyperParams["lr"]))
+        return (trainModel,)
+    results["fit"] = runBenchmark(
+            lambda trainModel: trainModel.fit(X, y, epochs=1, batch_size=hyperParams["batchsize"][0], verbose=0),
+            createCompiledModel, len(X), "samples")
+
+    print("  walkForward")
+    # one 96-hour forecast per call, so that latency percentiles are per forecast
+    numForecasts = (len(testData)-predictionWindowHours)//24+1
+    valAndTestData = np.vstack((regionData["valData"], testData))
+    latencies = []
+    for run in range(NUM_WARMUP_RUNS + NUM_REPEATS):
+        for day in range(numForecasts):
+            history = valAndTestData[(numValDays+day)*24-trainWindowHours:(numValDays+day)*24]
+            # issue day 'day' of wTestData is the forecast issued at the start of the history window
+            args = (model, history.tolist(), testData[day*24:day*24+predictionWindowHours], trainWindowHours,
+                    numModelFeatures, secondTierForecasts.DEPENDENT_VARIABLE_COL, None, None,
+                    wTestData.getIssueDays(day, day+1))
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                secondTierForecasts.getDayAheadForecasts(*args)
+                latency = time.perf_counter() - start
+            if (run >= NUM_WARMUP_RUNS):
+                latencies.append(latency)
+    results["walkForward"] = getMetrics(latencies, 1, "forecasts")
+
+    print("  calculateCarbonIntensity")
+    with contextlib.redirect_stdout(io.StringIO()):
+        sourceDataset = carbonIntensityCalculator.initialize(inFileName)
+    sourceDataset = sourceDataset.drop(columns=[sourceDataset.columns[0], "carbon_intensity"])
+    numSources = len(sourceDataset.columns)-1
+    sourceDataset = sourceDataset[-numTestDays*24:]
+    results["calculateCarbonIntensity"] = runBenchmark(carbonIntensityCalculator.calculateCarbonIntensity,
+            lambda: (sourceDataset.copy(), carbonIntensityCalculator.carbonRateDirect, numSources),
+            len(sourceDataset), "rows")
+
+    print("  getMape")
+    ciForecastDataset = pd.read_csv("../data/"+region+"/"+region+"_carbon_from_src_forecasts_direct_"+
+                            carbonIntensityCalculator.TEST_PERIOD+".csv", header=0)
+    ciForecastDataset = ciForecastDataset[:numTestDays*maxPredictionWindowHours]
+    results["getMape"] = runBenchmark(carbonIntensityCalculator.getMape,
+            lambda: (ciForecastDataset["UTC time"].values, ciForecastDataset["actual_carbon_intensity_direct"].values,
+                    ciForecastDataset["forecasted_carbon_intensity_direct"].values, maxPredictionWindowHours),
+            len(ciForecastDataset), "rows")
+    return results
+
+def getEnvironment():
+    environment = {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+                "tensorflow": tf.__version__, "platform": platform.platform(), "cpu_count": os.cpu_count()}
+    return environment
+
+def compareWithBaseline(results, baseline, comparedMetrics, regressionThreshold):
+    regressions = []
+    for region in results:
+        if (region not in baseline["results"]):
+            print("No baseline for region ", region)
+            continue
+        for benchmark in results[region]:
+            if (benchmark not in baseline["results"][region]):
+                print("No baseline for ", region, benchmark)
+                continue
+            for metric in comparedMetrics:
+                current = results[region][benchmark][metric]
+                previous = baseline["results"][region][benchmark][metric]
+                if (previous == 0):
+                    # no relative change from a zero baseline (e.g., a timer below its resolution): report
+                    # the absolute change, without flagging a regression
+                    print("n/a", region, benchmark, metric, ": baseline ", previous, ", current ", current,
+                            ", absolute change: ", current - previous)
+                    continue
+                if (metric in HIGHER_IS_BETTER):
+                    change = (previous - current) / previous
+                else:
+                    change = (current - previous) / previous
+                status = "OK"
+                if (change > regressionThreshold):
+                    status = "REGRESSION"
+                    regressions.append([region, benchmark, metric, previous, current])
+                print(status, region, benchmark, metric, ": baseline ", previous, ", current ", current,
+                        ", change: ", round(change*100, 2), "% worse")
+    return regressions
+
+def runBenchmarks(benchmarkConfig, saveAsBaseline):
+    global NUM_REPEATS
+    global NUM_WARMUP_RUNS
+    NUM_REPEATS = benchmarkConfig["NUM_REPEATS"]
+    NUM_WARMUP_RUNS = benchmarkConfig["NUM_WARMUP_RUNS"]
+    if (benchmarkConfig["NUM_THREADS"] > 0):
+        tf.config.threading.set_intra_op_parallelism_threads(benchmarkConfig["NUM_THREADS"])
+        tf.config.threading.set_inter_op_parallelism_threads(benchmarkConfig["NUM_THREADS"])
+    np.random.seed(benchmarkConfig["RANDOM_SEED"])
+    tf.random.set_seed(benchmarkConfig["RANDOM_SEED"])
+
+    with open(benchmarkConfig["SECOND_TIER_CONFIG_FILE"], "r") as configFile:
+        secondTierConfig = json.load(configFile)
+    secondTierForecasts.initializeMacros(secondTierConfig)
+
+    results = {}
+    for region in benchmarkConfig["REGION"]:
+        print("Benchmarking region: ", region)
+        results[region] = benchmarkRegion(region, benchmarkConfig, secondTierConfig)
+
+    report = {"timestamp": dt.now().isoformat(), "environment": getEnvironment(),
+            "config": benchmarkConfig, "results": results}
+    resultsFileName = benchmarkConfig["RESULTS_FILE"]
+    os.makedirs(os.path.dirname(resultsFileName) or ".", exist_ok=True)
+    with open(resultsFileName, "w") as resultsFile:
+        stdjson.dump(report, resultsFile, indent=4)
+    print("Results written to ", resultsFileName)
+
+    baselineFileName = benchmarkConfig["BASELINE_FILE"]
+    if (saveAsBaseline is True):
+        with open(baselineFileName, "w") as baselineFile:
+            stdjson.dump(report, baselineFile, indent=4)
+        print("Results saved as baseline in ", baselineFileName)
+        return []
+    if (not os.path.exists(baselineFileName)):
+        print("No baseline found at ", baselineFileName, ". Run with -b to save one.")
+        return []
+    with open(baselineFileName, "r") as baselineFile:
+        baseline = stdjson.load(baselineFile)
+    print("Comparing against baseline from ", baseline["timestamp"], "...")
+    regressions = compareWithBaseline(results, baseline, benchmarkConfig["COMPARED_METRICS"],
+                                    benchmarkConfig["REGRESSION_THRESHOLD"])
+    return regressions
+
+
+if __name__ == "__main__":
+    if (len(sys.argv) != 3 or sys.argv[2] not in ["-c", "-b"]):
+        print("Usage: python3 runBenchmarks.py <configFileName> <-c/-b>")
+        print("-c -- compare against the baseline (fails if any metric regresses beyond the threshold)")
+        print("-b -- save the results as the new baseline")
+        print("")
+        exit(0)
+    with open(sys.argv[1], "r") as configFile:
+        benchmarkConfig = json.load(configFile)
+    regressions = runBenchmarks(benchmarkConfig, sys.argv[2] == "-b")
+    if (len(regressions) > 0):
+        print(len(regressions), " metric(s) regressed by more than ",
+                benchmarkConfig["REGRESSION_THRESHOLD"]*100, "%:")
+        for regression in regressions:
+            print(regression)
+        exit(1)
+    print("End")
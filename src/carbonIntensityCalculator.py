@@ -18,6 +18,8 @@ import pandas as pd
 import pytz as pytz
 import tensorflow as tf
 
+import instrumentation
+
 CARBON_INTENSITY_COLUMN = 1 # column for real-time carbon intensity
 SRC_START_COL = 1
 PREDICTION_WINDOW_HOURS = 96
@@ -221,11 +223,13 @@ def runProgram(region, isLifecycle, isForecast, numSources):
             REAL_TIME_SRC_IN_FILE_NAME = "../data/"+region+"/"+region+".csv"
             CARBON_FROM_REAL_TIME_SRC_OUT_FILE_NAME = "../data/"+region+"/"+region+"_direct_emissions.csv"
 
-    
-    dataset = initialize(REAL_TIME_SRC_IN_FILE_NAME)
-    forecastDataset = None
-    if (isForecast is True):
-        forecastDataset = initialize(FORECAST_SRC_IN_FILE_NAME)
+    instrumentation.setLabels(region=region, source=("lifecycle" if isLifecycle is True else "direct"),
+                            period=(TEST_PERIOD if isForecast is True else "real_time"))
+    with instrumentation.stage("readCsv"):
+        dataset = initialize(REAL_TIME_SRC_IN_FILE_NAME)
+        forecastDataset = None
+        if (isForecast is True):
+            forecastDataset = initialize(FORECAST_SRC_IN_FILE_NAME)
 
     # Special case: SE unknown/other lifecycle CEF was 292.9 as per ElectricityMap
     # TODO: In later verwsions, make this saem as CEFs of other regions for consistency.
@@ -235,22 +239,23 @@ def runProgram(region, isLifecycle, isForecast, numSources):
         carbonRateLifecycle["unknown"] = 292.9
         carbonRateLifecycle["other"] = 292.9
 
-    if (isLifecycle is True):
-        if (isForecast is True):
-            print("Calculating carbon intensity from src prod forecasts using lifecycle emission factors...")
-            forecastDataset = calculateCarbonIntensityFromSourceForecasts(forecastDataset, forcast_carbonRateLifecycle, 
-                        numSources)    
-        else:
-            print("Calculating real time carbon intensity using lifecycle emission factors...")
-            dataset = calculateCarbonIntensity(dataset, carbonRateLifecycle, numSources)
-    else:
-        if (isForecast is True):
-            print("Calculating carbon intensity from src prod forecasts using direct emission factors...")
-            forecastDataset = calculateCarbonIntensityFromSourceForecasts(forecastDataset, forcast_carbonRateDirect, 
-                        numSources)            
+    with instrumentation.stage("calculateCarbonIntensity"):
+        if (isLifecycle is True):
+            if (isForecast is True):
+                print("Calculating carbon intensity from src prod forecasts using lifecycle emission factors...")
+                forecastDataset = calculateCarbonIntensityFromSourceForecasts(forecastDataset, forcast_carbonRateLifecycle, 
+                            numSources)    
+            else:
+                print("Calculating real time carbon intensity using lifecycle emission factors...")
+                dataset = calculateCarbonIntensity(dataset, carbonRateLifecycle, numSources)
         else:
-            print("Calculating real time carbon intensity using direct emission factors...")
-            dataset = calculateCarbonIntensity(dataset, carbonRateDirect, numSources)
+            if (isForecast is True):
+                print("Calculating carbon intensity from src prod forecasts using direct emission factors...")
+                forecastDataset = calculateCarbonIntensityFromSourceForecasts(forecastDataset, forcast_carbonRateDirect, 
+                            numSources)            
+            else:
+                print("Calculating real time carbon intensity using direct emission factors...")
+                dataset = calculateCarbonIntensity(dataset, carbonRateDirect, numSources)
 
     if (isForecast is True):
         print("Carbon intensity forecasts:")
@@ -260,8 +265,9 @@ def runProgram(region, isLifecycle, isForecast, numSources):
         actual = np.reshape(actual, actual.shape[0]*actual.shape[1])
         forecast = forecastDataset["carbon_from_src_forecasts"].values
         print("Actual shape: ", actual.shape, " Forecast shape: ", forecast.shape)
-        dailyAvgMape, avgMape, dailyAvgRmse = getMape(forecastDataset["UTC time"].values, actual, 
-                        forecast , PREDICTION_WINDOW_HOURS)
+        with instrumentation.stage("getMape"):
+            dailyAvgMape, avgMape, dailyAvgRmse = getMape(forecastDataset["UTC time"].values, actual, 
+                            forecast , PREDICTION_WINDOW_HOURS)
 
         print("Overall Mean MAPE: ", avgMape)
         print("Daywise statistics...")
@@ -307,4 +313,5 @@ if __name__ == "__main__":
         isForecast = True
     numSources = int(sys.argv[4])
     runProgram(region, isLifecycle, isForecast, numSources)
+    instrumentation.writeRunReport("../run_reports/carbon_intensity_calculator_"+region)
     print("Calculating carbon intensity for region: ", sys.argv[1], " done.")
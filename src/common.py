@@ -97,6 +97,26 @@ def scaleDataset(trainData, valData, testData):
 
     return trainData, valData, testData, ftMin, ftMax
 
+def scaleWithMinMax(data, ftMin, ftMax):
+    # Scaling columns to range (0, 1) using already known (e.g., saved) min/max values
+    for i in range(data.shape[1]):
+        if((ftMax[i] - ftMin[i]) == 0):
+            continue
+        data[:, i] = (data[:, i] - ftMin[i]) / (ftMax[i] - ftMin[i])
+    return data
+
+# Hyperparameters in the configuration files can list several candidate values, which are
+# explored by the hyperparameter search. isListValued is for hyperparameters that are lists
+# themselves (e.g., HIDDEN_UNITS), whose candidates are given as a list of lists.
+def getHyperParamCandidates(value, isListValued=False):
+    if (isListValued is True):
+        if (len(value) > 0 and isinstance(value[0], list)):
+            return value
+        return [value]
+    if (isinstance(value, list)):
+        return value
+    return [value]
+
 def scaleColumn(data, ftMin, ftMax):
     # Scaling columns to range (0, 1)
     col = len(data)
@@ -0,0 +1,65 @@
+'''
+Compares the recursive & multi-output second tier forecast modes for every region of a config file.
+Both modes are trained & evaluated NUMBER_OF_EXPERIMENTS_PER_REGION times on the same data. The mean
+MAPE, RMSE & time for one PREDICTION_WINDOW_HOURS forecast of each mode are written to
+FORECAST_MODE_COMPARISON_FILE, along with the mode with the lower MAPE for each region.
+'''
+
+import csv
+import os
+import sys
+
+import json5 as json
+import numpy as np
+
+import instrumentation
+import secondTierForecasts
+
+FORECAST_MODES = ["recursive", "multioutput"]
+COMPARISON_FIELDS = ["region", "cef_type", "mode", "mape", "rmse", "avg_time_to_forecast_s", "best_mode"]
+
+
+def compareForecastModes(configFileName, cefType):
+    with open(configFileName, "r") as configFile:
+        secondTierConfig = json.load(configFile)
+    numExperiments = secondTierConfig["NUMBER_OF_EXPERIMENTS_PER_REGION"]
+    rows = []
+    for region in secondTierConfig["REGION"]:
+        regionRows = []
+        for mode in FORECAST_MODES:
+            secondTierConfig["FORECAST_MODE"] = mode
+            secondTierForecasts.initializeMacros(secondTierConfig)
+            instrumentation.setLabels(period=mode)
+            scores = secondTierForecasts.runRegion(secondTierConfig, region, cefType, False, range(numExperiments))
+            regionRows.append({"region": region, "cef_type": secondTierForecasts.CEF_TYPE, "mode": mode,
+                            "mape": np.mean([score["mape"] for score in scores]),
+                            "rmse": np.mean([score["rmse"] for score in scores]),
+                            "avg_time_to_forecast_s": np.mean([score["avg_time_to_forecast_s"] for score in scores])})
+        bestMode = min(regionRows, key=lambda row: row["mape"])["mode"]
+        for row in regionRows:
+            row["best_mode"] = bestMode
+        rows.extend(regionRows)
+
+    print("Region, mode: MAPE, RMSE, avg. time to forecast (s)")
+    for row in rows:
+        print(row["region"], row["mode"], ": ", round(row["mape"], 4), ", ", round(row["rmse"], 4), ", ", 
+                round(row["avg_time_to_forecast_s"], 6), " (best: ", row["best_mode"], ")")
+    outFileName = secondTierConfig["FORECAST_MODE_COMPARISON_FILE"]
+    print("Writing comparison to ", outFileName, "...")
+    os.makedirs(os.path.dirname(outFileName) or ".", exist_ok=True)
+    with open(outFileName, "w") as csvfile:
+        csvwriter = csv.DictWriter(csvfile, fieldnames=COMPARISON_FIELDS)
+        csvwriter.writeheader()
+        csvwriter.writerows(rows)
+    instrumentation.writeRunReport(secondTierConfig["RUN_REPORT_FILE_PREFIX"]+"_forecast_mode_comparison")
+    return rows
+
+
+if __name__ == "__main__":
+    print("CarbonCast second tier: recursive vs. multi-output forecasts.")
+    if (len(sys.argv) != 3 or sys.argv[2] not in ["-l", "-d"]):
+        print("Usage: python3 compareForecastModes.py <configFileName> <-l (lifecycle)/ -d (direct)>")
+        print("")
+        exit(0)
+    compareForecastModes(sys.argv[1], sys.argv[2])
+    print("End")
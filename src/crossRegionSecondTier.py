@@ -0,0 +1,276 @@
+'''
+Cross-region second tier: one CNN-LSTM backbone is pretrained on the training windows of all
+CROSS_REGION["PRETRAIN_REGIONS"] together. Each region in REGION then only fine-tunes a small
+region specific output head (a Dense layer) on top of the backbone for FINE_TUNE_EPOCHS epochs,
+instead of training a model from scratch for up to EPOCH epochs.
+All regions have the same history features (CI & date/time features), but different source
+production forecasts. The forecast features are mapped to a common (padded) layout: the union of the
+forecast feature names of the pretraining regions, in the order first seen. A region's features are
+written to their slots of the layout & the other slots are 0. As 0 is also a valid scaled value, one
+mask column per slot (1 if the region has that feature) is appended.
+The backbone & its layout are saved to CROSS_REGION["BACKBONE_DIR"], so that a new region can be
+onboarded (-s) by fine-tuning only. With -c, the regions are also trained from scratch for comparison.
+The wall time & MAPE of every region are written to CROSS_REGION["REPORT_FILE"].
+'''
+
+import csv
+import os
+import sys
+import time
+
+import json5 as json
+import numpy as np
+import tensorflow as tf
+from keras.callbacks import EarlyStopping, ModelCheckpoint, ReduceLROnPlateau
+from keras.layers import Dense
+from keras.models import Sequential, load_model
+
+import common
+import instrumentation
+import modelRegistry
+import secondTierForecasts
+
+CEF_TYPES = {"-d": "direct", "-l": "lifecycle"}
+REPORT_FIELDS = ["region", "model", "cef_type", "experiment", "mape", "rmse", "training_time_s", "epochs",
+                "avg_time_to_forecast_s"]
+
+
+def getBackboneFileName(crossRegionConfig, cefType):
+    return os.path.join(crossRegionConfig["BACKBONE_DIR"], CEF_TYPES[cefType]+"_backbone.h5")
+
+def getLayoutFileName(crossRegionConfig, cefType):
+    return os.path.join(crossRegionConfig["BACKBONE_DIR"], CEF_TYPES[cefType]+"_backbone_layout.json")
+
+def getForecastFeatureLayout(forecastFeatureLists):
+    layout = []
+    for forecastFeatures in forecastFeatureLists:
+        layout.extend([feature for feature in forecastFeatures if feature not in layout])
+    return layout
+
+# [rows, region forecast features] --> [rows, 2 x layout features]: padded features, followed by the mask
+def padForecastFeatures(wData, forecastFeatures, layout):
+    missingFeatures = [feature for feature in forecastFeatures if feature not in layout]
+    if (len(missingFeatures) > 0):
+        raise ValueError("Forecast features "+str(missingFeatures)+" are not in the backbone layout")
+    slots = [layout.index(feature) for feature in forecastFeatures]
+    paddedData = np.zeros((len(wData), 2*len(layout)), dtype=np.float64)
+    paddedData[:, slots] = wData
+    paddedData[:, [len(layout)+slot for slot in slots]] = 1
+    return paddedData
+
+def padRegionData(regionData, layout):
+    paddedRegionData = dict(regionData)
+    for key in ["wTrainData", "wValData", "wTestData"]:
+        paddedRegionData[key] = regionData[key].withRows(padForecastFeatures(regionData[key].getRows(),
+                                                        regionData["forecastFeatures"], layout))
+    paddedRegionData["numFeatures"] = regionData["trainData"].shape[1] + 2*len(layout)
+    return paddedRegionData
+
+def getTrainingWindows(regionData):
+    trainWindowHours = secondTierForecasts.TRAINING_WINDOW_HOURS
+    windows = []
+    for data, wData in [(regionData["trainData"], regionData["wTrainData"]),
+                        (regionData["valData"], regionData["wValData"])]:
+        if (secondTierForecasts.FORECAST_MODE == "multioutput"):
+            X, y = secondTierForecasts.manipulateMultiOutputTrainingDataShape(data, trainWindowHours, wData)
+        else:
+            X, y = secondTierForecasts.manipulateTrainingDataShape(data, trainWindowHours, trainWindowHours, wData)
+        # float32 halves the memory of the windows of all regions
+        windows.extend([X.astype(np.float32), y.astype(np.float32)])
+    return windows
+
+def createBackbone(n_timesteps, n_features, n_outputs, hyperParams):
+    # the single region architecture (createModel) without its output layer
+    backbone = secondTierForecasts.createModel(n_timesteps, n_features, n_outputs, hyperParams)
+    backbone.pop()
+    return backbone
+
+def fitModel(model, X, y, valX, valY, hyperParams, epochs, checkpointFileName):
+    # Same training setup as secondTierForecasts.trainModel. Returns the best model & the no. of epochs run.
+    opt = tf.keras.optimizers.Adam(learning_rate = hyperParams["lr"])
+    model.compile(loss=hyperParams["loss"], optimizer=opt, metrics=['mean_absolute_error'])
+    os.makedirs(os.path.dirname(checkpointFileName) or ".", exist_ok=True)
+    es = EarlyStopping(monitor='val_loss', mode='min', verbose=1, patience=10)
+    mc = ModelCheckpoint(checkpointFileName, monitor='val_loss', mode='min', verbose=1, save_best_only=True)
+    rlr = ReduceLROnPlateau(monitor="val_loss", mode="min", factor=0.1, patience=6, verbose=1,
+                            min_lr=hyperParams["minlr"])
+    with instrumentation.stage("fit", profile=True):
+        hist = model.fit(X, y, epochs=epochs, batch_size=hyperParams["batchsize"][0], verbose=0,
+                        validation_data=(valX, valY), callbacks=[rlr, es, mc])
+    return load_model(checkpointFileName), len(hist.history["loss"])
+
+def pretrainBackbone(secondTierConfig, cefType, pretrainRegions, keepRegions):
+    # Returns the pretraining score row & the padded data of the keepRegions (to be fine-tuned)
+    crossRegionConfig = secondTierConfig["CROSS_REGION"]
+    regionDataList = {}
+    for region in pretrainRegions:
+        instrumentation.setLabels(region=region, source=CEF_TYPES[cefType], period="pretraining")
+        with instrumentation.stage("prepareData"):
+            regionData = secondTierForecasts.prepareRegionData(secondTierConfig, region, cefType)
+        regionData.pop("forecastDataset")
+        regionDataList[region] = regionData
+    layout = getForecastFeatureLayout([regionDataList[region]["forecastFeatures"] for region in pretrainRegions])
+    print("Forecast feature layout (", len(layout), " features): ", layout)
+
+    X, y, valX, valY = [], [], [], []
+    paddedRegionData = {}
+    for region in pretrainRegions:
+        regionData = padRegionData(regionDataList.pop(region), layout)
+        instrumentation.setLabels(region=region, source=CEF_TYPES[cefType], period="pretraining")
+        with instrumentation.stage("buildTrainingWindows"):
+            regionX, regionY, regionValX, regionValY = getTrainingWindows(regionData)
+        X.append(regionX)
+        y.append(regionY)
+        valX.append(regionValX)
+        valY.append(regionValY)
+        if (region in keepRegions):
+            paddedRegionData[region] = regionData
+    X, y, valX, valY = np.concatenate(X), np.concatenate(y), np.concatenate(valX), np.concatenate(valY)
+    print("Pretraining X.shape, y.shape: ", X.shape, y.shape)
+
+    hyperParams = secondTierForecasts.getHyperParams(secondTierConfig)
+    instrumentation.setLabels(region="all", source=CEF_TYPES[cefType], period="pretraining")
+    startTime = time.perf_counter()
+    with instrumentation.stage("training"):
+        model = Sequential([createBackbone(X.shape[1], X.shape[2], y.shape[1], hyperParams),
+                            Dense(y.shape[1])])
+        checkpointFileName = os.path.join(secondTierForecasts.CHECKPOINT_DIR,
+                                        "cross_region_"+CEF_TYPES[cefType]+"_pretrained_model.h5")
+        model, epochs = fitModel(model, X, y, valX, valY, hyperParams, crossRegionConfig["PRETRAIN_EPOCHS"],
+                                checkpointFileName)
+    pretrainingTime = time.perf_counter() - startTime
+    print("Pretraining done in ", round(pretrainingTime, 3), " s, ", epochs, " epochs")
+
+    backboneFileName = getBackboneFileName(crossRegionConfig, cefType)
+    print("Saving backbone & layout to ", backboneFileName)
+    os.makedirs(os.path.dirname(backboneFileName) or ".", exist_ok=True)
+    model.layers[0].save(backboneFileName)
+    modelRegistry.writeMetadataFile(getLayoutFileName(crossRegionConfig, cefType),
+                                    {"layout": layout, "pretrain_regions": pretrainRegions})
+    pretrainingRow = {"region": "all", "model": "pretraining", "cef_type": CEF_TYPES[cefType],
+                    "experiment": 0, "training_time_s": pretrainingTime, "epochs": epochs}
+    return pretrainingRow, paddedRegionData
+
+def fineTuneRegion(secondTierConfig, region, cefType, exptNum, regionData, windows):
+    crossRegionConfig = secondTierConfig["CROSS_REGION"]
+    print("CarbonCast: fine-tuning the cross-region backbone for region:", region)
+    instrumentation.setLabels(region=region, source=CEF_TYPES[cefType], period="expt"+str(exptNum))
+    X, y, valX, valY = windows
+    hyperParams = secondTierForecasts.getHyperParams(secondTierConfig)
+
+    startTime = time.perf_counter()
+    with instrumentation.stage("training"):
+        # a fresh copy of the pretrained backbone for every region & experiment
+        backbone = load_model(getBackboneFileName(crossRegionConfig, cefType), compile=False)
+        backbone.trainable = (crossRegionConfig["FREEZE_BACKBONE"] != "True")
+        model = Sequential([backbone, Dense(y.shape[1], name=region.lower()+"_head")])
+        checkpointFileName = os.path.join(secondTierForecasts.CHECKPOINT_DIR,
+                                        region+"_cross_region_best_model_iter"+str(exptNum)+".h5")
+        model, epochs = fitModel(model, X, y, valX, valY, hyperParams, crossRegionConfig["FINE_TUNE_EPOCHS"],
+                                checkpointFileName)
+    fineTuningTime = time.perf_counter() - startTime
+
+    trainWindowHours = secondTierForecasts.TRAINING_WINDOW_HOURS
+    history = regionData["valData"][-trainWindowHours:, :].tolist()
+    walkForwardStartTime = time.perf_counter()
+    with instrumentation.stage("walkForwardForecast", profile=True):
+        if (secondTierForecasts.FORECAST_MODE == "multioutput"):
+            predictedData = secondTierForecasts.getMultiOutputDayAheadForecasts(model, 1, history,
+                            regionData["testData"], trainWindowHours, regionData["wTestData"])
+        else:
+            ciCol = secondTierForecasts.DEPENDENT_VARIABLE_COL
+            predictedData = secondTierForecasts.getDayAheadForecasts(model, history, regionData["testData"],
+                            trainWindowHours, regionData["numFeatures"], ciCol,
+                            regionData["ftMin"][ciCol], regionData["ftMax"][ciCol],
+                            regionData["wTestData"], regionData["forecastFeatures"])
+    avgTimeToForecast = (time.perf_counter()-walkForwardStartTime) / len(predictedData)
+
+    unscaledTestData, unscaledPredictedData, formattedTestDates, rmseScore, mapeScore, _ = \
+            secondTierForecasts.getUnscaledForecastsAndForecastAccuracy(regionData["testData"],
+                                regionData["testDates"], predictedData, regionData["ftMin"], regionData["ftMax"])
+    print("[CROSS_REGION] ", region, ": fine-tuning time: ", round(fineTuningTime, 3), " s (", epochs,
+        " epochs), RMSE: ", rmseScore, ", MAPE: ", mapeScore)
+    if (secondTierConfig["WRITE_CI_FORECASTS_TO_FILE"] == "True"):
+        outFileNamePrefix = secondTierConfig[region][CEF_TYPES[cefType].upper()+"_CEF_OUT_FILE_NAME_PREFIX"]
+        data = [[str(formattedTestDates[i]), str(unscaledTestData[i]), str(unscaledPredictedData[i])]
+                for i in range(len(unscaledTestData))]
+        with instrumentation.stage("writeForecasts"):
+            common.writeOutFile(outFileNamePrefix+"_cross_region_"+str(exptNum)+".csv", data,
+                                "carbon_intensity", "w")
+    return {"region": region, "model": "cross_region", "cef_type": CEF_TYPES[cefType], "experiment": exptNum,
+            "mape": mapeScore, "rmse": rmseScore, "training_time_s": fineTuningTime, "epochs": epochs,
+            "avg_time_to_forecast_s": avgTimeToForecast}
+
+def runCrossRegion(configFileName, cefType, useSavedBackbone, compareWithSingleRegion):
+    with open(configFileName, "r") as configFile:
+        secondTierConfig = json.load(configFile)
+    secondTierForecasts.initializeMacros(secondTierConfig)
+    secondTierForecasts.CEF_TYPE = CEF_TYPES[cefType]
+    crossRegionConfig = secondTierConfig["CROSS_REGION"]
+    regions = secondTierConfig["REGION"]
+
+    rows = []
+    if (useSavedBackbone is True):
+        print("-s parameter specified. Loading backbone from ", getBackboneFileName(crossRegionConfig, cefType))
+        layout = modelRegistry.readMetadataFile(getLayoutFileName(crossRegionConfig, cefType))["layout"]
+        paddedRegionData = {}
+        for region in regions:
+            instrumentation.setLabels(region=region, source=CEF_TYPES[cefType], period="fineTuning")
+            with instrumentation.stage("prepareData"):
+                regionData = secondTierForecasts.prepareRegionData(secondTierConfig, region, cefType)
+            regionData.pop("forecastDataset")
+            paddedRegionData[region] = padRegionData(regionData, layout)
+    else:
+        pretrainingRow, paddedRegionData = pretrainBackbone(secondTierConfig, cefType,
+                                                crossRegionConfig["PRETRAIN_REGIONS"], regions)
+        rows.append(pretrainingRow)
+        missingRegions = [region for region in regions if region not in paddedRegionData]
+        if (len(missingRegions) > 0):
+            raise ValueError("Regions "+str(missingRegions)+" are not in CROSS_REGION PRETRAIN_REGIONS")
+
+    for region in regions:
+        with instrumentation.stage("buildTrainingWindows"):
+            windows = getTrainingWindows(paddedRegionData[region])
+        for exptNum in range(secondTierConfig["NUMBER_OF_EXPERIMENTS_PER_REGION"]):
+            rows.append(fineTuneRegion(secondTierConfig, region, cefType, exptNum, paddedRegionData[region],
+                                    windows))
+            if (compareWithSingleRegion is True):
+                instrumentation.setLabels(period="expt"+str(exptNum))
+                for score in secondTierForecasts.runRegion(secondTierConfig, region, cefType, False, [exptNum]):
+                    rows.append(dict([(field, score[field]) for field in REPORT_FIELDS if field in score],
+                                    model="single_region"))
+
+    for row in rows:
+        if (row["model"] == "pretraining"):
+            print("Pretraining on ", len(crossRegionConfig["PRETRAIN_REGIONS"]), " regions: ",
+                round(row["training_time_s"], 3), " s, ", row["epochs"], " epochs")
+    for region in regions:
+        for model in ["cross_region", "single_region"]:
+            modelRows = [row for row in rows if row["region"] == region and row["model"] == model]
+            if (len(modelRows) == 0):
+                continue
+            print(region, model, ": mean training time: ", round(np.mean([row["training_time_s"] for row in modelRows]), 3),
+                " s, mean MAPE: ", np.mean([row["mape"] for row in modelRows]))
+
+    outFileName = crossRegionConfig["REPORT_FILE"]
+    print("Writing results to ", outFileName, "...")
+    os.makedirs(os.path.dirname(outFileName) or ".", exist_ok=True)
+    with open(outFileName, "w") as csvfile:
+        csvwriter = csv.DictWriter(csvfile, fieldnames=REPORT_FIELDS)
+        csvwriter.writeheader()
+        csvwriter.writerows(rows)
+    instrumentation.writeRunReport(secondTierConfig["RUN_REPORT_FILE_PREFIX"]+"_cross_region")
+    return rows
+
+
+if __name__ == "__main__":
+    print("CarbonCast second tier, cross-region pretraining & per-region fine-tuning.")
+    if (len(sys.argv) < 3 or sys.argv[2] not in CEF_TYPES or
+            any([arg not in ["-s", "-c"] for arg in sys.argv[3:]])):
+        print("Usage: python3 crossRegionSecondTier.py <configFileName> <-l (lifecycle)/ -d (direct)> <-s> <-c>")
+        print("-s is optional. If provided, the saved backbone is fine-tuned without pretraining (e.g., for a new region).")
+        print("-c is optional. If provided, the regions are also trained from scratch & compared.")
+        print("")
+        exit(0)
+    runCrossRegion(sys.argv[1], sys.argv[2], "-s" in sys.argv[3:], "-c" in sys.argv[3:])
+    print("End")
@@ -0,0 +1,118 @@
+'''
+Ensemble of independently initialized replicas of a model, trained & run as a single Keras model.
+All replicas share the same input batches, so the training/validation windows are built only once and
+K experiments are trained in (roughly) the time of one. The ensemble output has the shape
+(batch, numReplicas, outputs); targets are tiled accordingly.
+Early stopping is per replica: the validation loss of each replica is computed in the validation pass of
+fit() (getReplicaLossMetrics), & ReplicaEarlyStopping restores the best weights of each replica.
+'''
+
+import weakref
+
+import numpy as np
+from keras import losses
+from keras.callbacks import Callback
+from keras.layers import Concatenate, Input, Reshape
+from keras.models import Model
+
+REPLICA_WISE_MODELS = weakref.WeakKeyDictionary() # ensemble model --> model with one input per replica
+
+
+def createEnsembleModel(createReplicaModel, numReplicas, inputShape):
+    # createReplicaModel() should return a new (uncompiled) model every time it is called,
+    # so that each replica has its own, independently initialized weights.
+    inputs = Input(shape=inputShape)
+    replicaOutputs = []
+    for i in range(numReplicas):
+        replicaModel = createReplicaModel()
+        replicaOutput = replicaModel(inputs)
+        replicaOutputs.append(Reshape((1, replicaOutput.shape[-1]))(replicaOutput))
+    if (numReplicas == 1):
+        outputs = replicaOutputs[0]
+    else:
+        outputs = Concatenate(axis=1)(replicaOutputs)
+    model = Model(inputs=inputs, outputs=outputs)
+    print("Ensemble model created with ", numReplicas, " replicas")
+    return model
+
+def getReplicaModel(model, replicaIdx):
+    # Replicas are the nested models of the ensemble, in the order they were created.
+    replicaModels = [layer for layer in model.layers if isinstance(layer, Model)]
+    return replicaModels[replicaIdx]
+
+def tileTargets(y, numReplicas):
+    # [samples, outputs] --> [samples, numReplicas, outputs]
+    return np.repeat(y[:, np.newaxis, :], numReplicas, axis=1)
+
+def getReplicaWiseModel(model):
+    # Model with one input per replica, sharing the replicas (& their weights) of the ensemble, so that each
+    # replica is run only on its own input. Built once per ensemble.
+    if (model not in REPLICA_WISE_MODELS):
+        replicaModels = [layer for layer in model.layers if isinstance(layer, Model)]
+        inputs = [Input(shape=model.input_shape[1:]) for replicaModel in replicaModels]
+        replicaOutputs = []
+        for replicaModel, replicaInput in zip(replicaModels, inputs):
+            replicaOutput = replicaModel(replicaInput)
+            replicaOutputs.append(Reshape((1, replicaOutput.shape[-1]))(replicaOutput))
+        if (len(replicaOutputs) == 1):
+            outputs = replicaOutputs[0]
+        else:
+            outputs = Concatenate(axis=1)(replicaOutputs)
+        REPLICA_WISE_MODELS[model] = Model(inputs=inputs, outputs=outputs)
+    return REPLICA_WISE_MODELS[model]
+
+def predictReplicas(model, replicaInputs):
+    # replicaInputs: [numReplicas, timesteps, features], i.e., each replica has its own input
+    # (needed when each replica's own forecasts are fed back into its history).
+    # Replica i is run only on input i, in a single call. Returns [numReplicas, outputs].
+    replicaWiseModel = getReplicaWiseModel(model)
+    forecasts = replicaWiseModel.predict([replicaInputs[i:i+1] for i in range(replicaInputs.shape[0])], verbose=0)
+    return forecasts[0]
+
+def getReplicaMetricName(replicaIdx):
+    return "replica"+str(replicaIdx)+"_loss"
+
+def getReplicaLossMetrics(lossFunc, numReplicas):
+    # One metric per replica: the loss on the replica's own outputs (val_replica<i>_loss in the logs)
+    lossFunction = losses.get(lossFunc)
+    metrics = []
+    for i in range(numReplicas):
+        def replicaLoss(yTrue, yPred, replicaIdx=i):
+            return lossFunction(yTrue[:, replicaIdx], yPred[:, replicaIdx])
+        replicaLoss.__name__ = getReplicaMetricName(i)
+        metrics.append(replicaLoss)
+    return metrics
+
+class ReplicaEarlyStopping(Callback):
+    # Early stopping & best weights of each replica on its own validation loss (the model must be compiled
+    # with getReplicaLossMetrics). Training stops once no replica has improved for patience epochs, & the
+    # weights of each replica are restored from its own best epoch.
+    def __init__(self, numReplicas, patience):
+        super().__init__()
+        self.numReplicas = numReplicas
+        self.patience = patience
+
+    def on_train_begin(self, logs=None):
+        self.bestLosses = [np.inf]*self.numReplicas
+        self.bestEpochs = [0]*self.numReplicas
+        self.bestWeights = [None]*self.numReplicas
+        self.wait = [0]*self.numReplicas
+
+    def on_epoch_end(self, epoch, logs=None):
+        for i in range(self.numReplicas):
+            valLoss = logs["val_"+getReplicaMetricName(i)]
+            if (valLoss < self.bestLosses[i]):
+                self.bestLosses[i], self.bestEpochs[i], self.wait[i] = valLoss, epoch, 0
+                self.bestWeights[i] = getReplicaModel(self.model, i).get_weights()
+            else:
+                self.wait[i] += 1
+        if (min(self.wait) >= self.patience):
+            print("Epoch ", epoch+1, ": early stopping, no replica improved for ", self.patience, " epochs")
+            self.model.stop_training = True
+
+    def on_train_end(self, logs=None):
+        for i in range(self.numReplicas):
+            if (self.bestWeights[i] is not None):
+                getReplicaModel(self.model, i).set_weights(self.bestWeights[i])
+        print("Best epoch of each replica: ", [epoch+1 for epoch in self.bestEpochs],
+                ", validation loss: ", [round(float(loss), 6) for loss in self.bestLosses])
@@ -23,6 +23,10 @@ from keras.models import load_model
 from keras.layers import RepeatVector
 
 import common
+import ensemble
+import instrumentation
+import modelRegistry
+import weatherForecastStore
 import sys
 import json5 as json
 
@@ -37,13 +41,15 @@ TRAINING_WINDOW_HOURS = None
 PREDICTION_WINDOW_HOURS = None
 MODEL_SLIDING_WINDOW_LEN = None
 BUFFER_HOURS = None
+SAVED_MODEL_LOCATION = None
 ############################# MACRO END #########################################
 
-def runFirstTier(configFileName):
+def runFirstTier(configFileName, loadFromSavedModel):
     global TRAINING_WINDOW_HOURS
     global PREDICTION_WINDOW_HOURS
     global MODEL_SLIDING_WINDOW_LEN
     global BUFFER_HOURS
+    global SAVED_MODEL_LOCATION
 
     firstTierConfig = {}
 
@@ -51,192 +57,354 @@ def runFirstTier(configFileName):
         firstTierConfig = json.load(configFile)
         # print(configurationData)
 
+    initializeMacros(firstTierConfig)
+    if (firstTierConfig["ENABLE_PROFILER_TRACE"] == "True"):
+        instrumentation.enableProfiler(firstTierConfig["PROFILER_TRACE_DIR"])
     NUMBER_OF_EXPERIMENTS = firstTierConfig["NUMBER_OF_EXPERIMENTS_PER_REGION"]
-    TRAINING_WINDOW_HOURS = firstTierConfig["TRAINING_WINDOW_HOURS"]
-    PREDICTION_WINDOW_HOURS = firstTierConfig["PREDICTION_WINDOW_HOURS"]
-    MODEL_SLIDING_WINDOW_LEN = firstTierConfig["MODEL_SLIDING_WINDOW_LEN"]
-    BUFFER_HOURS = PREDICTION_WINDOW_HOURS - 24
+    numReplicas = 1
+    if (loadFromSavedModel is True):
+        NUMBER_OF_EXPERIMENTS = 1
+    elif (firstTierConfig["ENSEMBLE_MODE"] == "True"):
+        # All experiments are trained at once as replicas of a single ensemble model
+        numReplicas = NUMBER_OF_EXPERIMENTS
+        NUMBER_OF_EXPERIMENTS = 1
 
     regionList = firstTierConfig["REGION"]
     for region in regionList:
         print("CarbonCast: ANN model for region:", region)
         regionConfig = firstTierConfig[region]
         sourceList = regionConfig["SOURCES"]
-        sourceColList = regionConfig["SOURCE_COL"]
         trainTestPeriodConfig = firstTierConfig["TRAIN_TEST_PERIOD"]
-        weatherForecastInFileName = regionConfig["WEATHER_FORECAST_IN_FILE_NAME"]
-
 
         sourceIdx = 0
         for source in sourceList:
-            inFileName = regionConfig["IN_FILE_NAME_PREFIX"] + source.lower() + firstTierConfig["IN_FILE_NAME_SUFFIX"]
             outFileNamePrefix = regionConfig["OUT_FILE_NAME_PREFIX"]
-            sourceCol = sourceColList[sourceIdx]
-            partialSourceProductionForecastAvailable = regionConfig["PARTIAL_FORECAST_AVAILABILITY_LIST"][sourceIdx]
-            partialForecastHours =  regionConfig["PARTIAL_FORECAST_HOURS"]
-            print(inFileName)
-            print(weatherForecastInFileName)
-            isRenewableSource = False
-            numFeatures = regionConfig["NUM_FEATURES"]
-            numWeatherFeatures = 0
-            if (source == "SOLAR" or source == "WIND" or source == "HYDRO"):
-                isRenewableSource = True
-            if (isRenewableSource == True):
-                numWeatherFeatures = regionConfig["NUM_WEATHER_FEATURES"]
+            bestSavedMAPE = {} # period -> MAPE of the model saved in the registry during this run
 
             for exptNum in range(NUMBER_OF_EXPERIMENTS):
-                outFileName = outFileNamePrefix + "_" + source.lower() + "_iter" + str(exptNum) + ".csv"
-                periodRMSE, periodMAPE = [], []
+                # one entry per replica (only 1 replica unless in ensemble mode)
+                periodRMSE = [[] for _ in range(numReplicas)]
+                periodMAPE = [[] for _ in range(numReplicas)]
                 
                 periodIdx = 0
                 for period in trainTestPeriodConfig:
                     print(trainTestPeriodConfig[period])
-                    datasetLimiter = trainTestPeriodConfig[period]["DATASET_LIMITER"]
-                    numTestDays = trainTestPeriodConfig[period]["NUM_TEST_DAYS"]
-                    numValDays = firstTierConfig["NUM_VAL_DAYS"]
-                    weatherDatasetLimiter = datasetLimiter//24*PREDICTION_WINDOW_HOURS
-                    print(numTestDays)
-
-                    print("Initializing...")
-                    dataset, dateTime, bufferPeriod, bufferDates, weatherDataset = initialize(
-                                inFileName, weatherForecastInFileName, sourceCol,
-                                datasetLimiter, weatherDatasetLimiter)
-                    # bufferPeriod is for the last test date, if prediction period is beyond 24 hours
-                    print("***** Initialization done *****")
-
-                    # split into train and test
-                    print("Spliting dataset into train/test...")
-                    trainData, valData, testData, fullTrainData = common.splitDataset(dataset.values, numTestDays, 
-                                                            numValDays)
-                    trainDates = dateTime[: -(numTestDays*24)]
-                    fullTrainDates = np.copy(trainDates)
-                    trainDates, validationDates = trainDates[: -(numValDays*24)], trainDates[-(numValDays*24):]
-                    testDates = dateTime[-(numTestDays*24):]
-                    bufferPeriod = bufferPeriod.values
-                    trainData = trainData[:, sourceCol: sourceCol+numFeatures]
-                    valData = valData[:, sourceCol: sourceCol+numFeatures]
-                    testData = testData[:, sourceCol: sourceCol+numFeatures]
-                    partialSourceProductionForecast = None
-                        
-                    bufferPeriod = bufferPeriod[:, sourceCol: sourceCol+numFeatures]
-                    if(len(bufferDates)>0):
-                        testDates = np.append(testDates, bufferDates)
-                        testData = np.vstack((testData, bufferPeriod))
-
-                    print("TrainData shape: ", trainData.shape) # (days x hour) x features
-                    print("ValData shape: ", valData.shape) # (days x hour) x features
-                    print("TestData shape: ", testData.shape) # (days x hour) x features
-
-                    wTrainData, wValData, wTestData, wFullTrainData = None, None, None, None
-                    if (isRenewableSource):
-                        wTrainData, wValData, wTestData, wFullTrainData = common.splitWeatherDataset(
-                                weatherDataset.values, numTestDays, numValDays, PREDICTION_WINDOW_HOURS)
-                        print("WeatherTrainData shape: ", wTrainData.shape) # (days x hour) x features
-                        print("WeatherValData shape: ", wValData.shape) # (days x hour) x features
-                        print("WeatherTestData shape: ", wTestData.shape) # (days x hour) x features
-
-                    print("***** Dataset split done *****")
-
-                    trainData = fillMissingData(trainData)
-                    valData = fillMissingData(valData)
-                    testData = fillMissingData(testData)
-                    featureList = dataset.columns.values
-                    featureList = featureList[sourceCol:sourceCol+numFeatures].tolist()
-
-                    print("Scaling data...")
-                    trainData, valData, testData, ftMin, ftMax = common.scaleDataset(trainData, valData, testData)
-                    print(trainData.shape, valData.shape, testData.shape)
-
-                    if(isRenewableSource):
-                        wTrainData = fillMissingData(wTrainData)
-                        wValData = fillMissingData(wValData)
-                        wTestData = fillMissingData(wTestData)
-                        featureList.extend(weatherDataset.columns.values)
-                        wTrainData, wValData, wTestData, wFtMin, wFtMax = common.scaleDataset(wTrainData, wValData, wTestData)
-                        print(wTrainData.shape, wValData.shape, wTestData.shape)
-
-                    print("Features: ", featureList)
-                        
-                    if (partialSourceProductionForecastAvailable):
-                        partialSourceProductionForecast = dataset["avg_"+source.lower()+"_production_forecast"].iloc[-numTestDays*24:].values
-                        partialSourceProductionForecast = common.scaleColumn(partialSourceProductionForecast, 
-                                ftMin[DEPENDENT_VARIABLE_COL], ftMax[DEPENDENT_VARIABLE_COL])
-                        # print(partialSourceProductionForecast, ftMax[DEPENDENT_VARIABLE_COL], ftMin[DEPENDENT_VARIABLE_COL])
-                    print("***** Data scaling done *****")
+                    modelDir = modelRegistry.getModelDir(SAVED_MODEL_LOCATION, region, source, period)
+                    instrumentation.setLabels(region=region, source=source, period=period)
 
                     ######################## START #####################                    
                     print("Iteration: ", exptNum)
-                    bestModel = trainingandValidationPhase(trainData, wTrainData, 
-                                                    valData, wValData, firstTierConfig)
-
-                    history = valData[-TRAINING_WINDOW_HOURS:, :]
-                    weatherData = None
-                    if (isRenewableSource):
-                        weatherData = wValData[-PREDICTION_WINDOW_HOURS:, :]
-                        print("weatherData shape:", weatherData.shape)
-                    history = history.tolist()
-
-                    bestRMSE, bestMAPE = [], []
-                    predictedData = getDayAheadForecasts(bestModel, history, testData, 
-                                        numFeatures+numWeatherFeatures, wTestData, weatherData, partialSourceProductionForecast)
+                    if (loadFromSavedModel is True):
+                        print("-s parameter specified. Loading model from ", modelDir)
+                        with instrumentation.stage("loadModel"):
+                            bestModel, metadata = modelRegistry.loadModel(modelDir)
+                        with instrumentation.stage("prepareData"):
+                            sourceData = prepareInferenceData(firstTierConfig, region, source, sourceIdx, 
+                                                    period, metadata)
+                    else:
+                        with instrumentation.stage("prepareData"):
+                            sourceData = prepareTrainingData(firstTierConfig, region, source, sourceIdx, period)
+                        with instrumentation.stage("training"):
+                            bestModel = trainingandValidationPhase(sourceData["trainData"], sourceData["wTrainData"], 
+                                                    sourceData["valData"], sourceData["wValData"], firstTierConfig,
+                                                    numReplicas)
+
+                    testData = sourceData["testData"]
+                    ftMin, ftMax = sourceData["ftMin"], sourceData["ftMax"]
+                    history = sourceData["history"].tolist()
+
+                    with instrumentation.stage("walkForwardForecast", profile=True):
+                        if (numReplicas > 1):
+                            replicaPredictedData = getEnsembleDayAheadForecasts(bestModel, numReplicas, history, testData,
+                                            sourceData["numFeatures"], sourceData["wTestData"], 
+                                            sourceData["partialSourceProductionForecast"])
+                        else:
+                            replicaPredictedData = [getDayAheadForecasts(bestModel, history, testData, 
+                                            sourceData["numFeatures"], sourceData["wTestData"], 
+                                            sourceData["partialSourceProductionForecast"])]
                     print("***** Forecast done *****")
-                    
-                    unscaledTestData, unscaledPredictedData, formattedTestDates, rmseScore, mapeScore = getUnscaledForecastsAndForecastAccuracy(
-                                                                        testData, testDates, predictedData, 
-                                                                        ftMin, ftMax)
-                    
-                    print("[BESTMODEL] Overall RMSE score: ", rmseScore)
-                    print("[BESTMODEL] Overall MAPE score: ", mapeScore)
-                    # print(scores)
-                    bestRMSE.append(rmseScore)
-                    bestMAPE.append(mapeScore)
 
-                    
-                    print("[BEST] Average RMSE after ", NUMBER_OF_EXPERIMENTS, " expts: ", np.mean(bestRMSE))
-                    print("[BEST] Average MAPE after ", NUMBER_OF_EXPERIMENTS, " expts: ", np.mean(bestMAPE))
+                    bestRMSE, bestMAPE = [], []
+                    for replicaIdx in range(numReplicas):
+                        outFileName = (outFileNamePrefix + "_" + source.lower() + "_iter" + 
+                                        str(exptNum+replicaIdx) + ".csv")
+                        unscaledTestData, unscaledPredictedData, formattedTestDates, rmseScore, mapeScore = getUnscaledForecastsAndForecastAccuracy(
+                                                                            testData, sourceData["testDates"], 
+                                                                            replicaPredictedData[replicaIdx], 
+                                                                            ftMin, ftMax)
+                        
+                        print("[BESTMODEL] Overall RMSE score: ", rmseScore)
+                        print("[BESTMODEL] Overall MAPE score: ", mapeScore)
+                        # print(scores)
+                        bestRMSE.append(rmseScore)
+                        bestMAPE.append(mapeScore)
+                        periodRMSE[replicaIdx].append([rmseScore])
+                        periodMAPE[replicaIdx].append([mapeScore])
+
+                        # Keep the best model (across experiments) of each period in the registry
+                        if (loadFromSavedModel is False and 
+                                (period not in bestSavedMAPE or mapeScore < bestSavedMAPE[period])):
+                            savedModel = bestModel
+                            if (numReplicas > 1):
+                                savedModel = ensemble.getReplicaModel(bestModel, replicaIdx)
+                            with instrumentation.stage("saveModel"):
+                                modelRegistry.saveModel(modelDir, savedModel, 
+                                        getModelMetadata(region, source, period, sourceData, mapeScore))
+                            bestSavedMAPE[period] = mapeScore
+
+                        with instrumentation.stage("writeForecasts"):
+                            writeSourceProductionForecastsToFile(formattedTestDates, unscaledTestData, 
+                                                            unscaledPredictedData, periodIdx, source, outFileName)
+
+                    print("[BEST] Average RMSE after ", len(bestRMSE), " expts: ", np.mean(bestRMSE))
+                    print("[BEST] Average MAPE after ", len(bestMAPE), " expts: ", np.mean(bestMAPE))
                     print(bestRMSE)
                     print(bestMAPE)
-                    periodRMSE.append(bestRMSE)
-                    periodMAPE.append(bestMAPE)
-
-                    writeSourceProductionForecastsToFile(formattedTestDates, unscaledTestData, unscaledPredictedData,
-                                                        periodIdx, source, outFileName)
+                    if (numReplicas > 1):
+                        _, _, _, rmseScore, mapeScore = getUnscaledForecastsAndForecastAccuracy(
+                                        testData, sourceData["testDates"], np.mean(replicaPredictedData, axis=0), 
+                                        ftMin, ftMax)
+                        print("[ENSEMBLE] Mean forecast RMSE: ", rmseScore, ", MAPE: ", mapeScore)
                     periodIdx +=1
                     ######################## END #####################
 
-                ###
-                common.dumpRandomDataToFile("../data/"+region+"/fuel_forecast/"+region+
-                        "_RMSE_iter"+str(exptNum)+source.lower()+".txt", str(periodRMSE), "w")
-                common.dumpRandomDataToFile("../data/"+region+"/fuel_forecast/"+region+
-                        "_MAPE_iter"+str(exptNum)+source.lower()+".txt", str(periodMAPE), "w")
-                ###
+                for replicaIdx in range(numReplicas):
+                    ###
+                    common.dumpRandomDataToFile("../data/"+region+"/fuel_forecast/"+region+
+                            "_RMSE_iter"+str(exptNum+replicaIdx)+source.lower()+".txt", str(periodRMSE[replicaIdx]), "w")
+                    common.dumpRandomDataToFile("../data/"+region+"/fuel_forecast/"+region+
+                            "_MAPE_iter"+str(exptNum+replicaIdx)+source.lower()+".txt", str(periodMAPE[replicaIdx]), "w")
+                    ###
 
-                print("RMSE: ", periodRMSE)
-                print("MAPE: ", periodMAPE)
+                    print("RMSE: ", periodRMSE[replicaIdx])
+                    print("MAPE: ", periodMAPE[replicaIdx])
             sourceIdx += 1
 
             print("####################", region, source, " done ####################\n\n")
         print("Source production forecast for region: ", region, " done.")
+    instrumentation.writeRunReport(firstTierConfig["RUN_REPORT_FILE_PREFIX"])
     return
 
+def initializeMacros(firstTierConfig):
+    global TRAINING_WINDOW_HOURS
+    global PREDICTION_WINDOW_HOURS
+    global MODEL_SLIDING_WINDOW_LEN
+    global BUFFER_HOURS
+    global SAVED_MODEL_LOCATION
+    TRAINING_WINDOW_HOURS = firstTierConfig["TRAINING_WINDOW_HOURS"]
+    PREDICTION_WINDOW_HOURS = firstTierConfig["PREDICTION_WINDOW_HOURS"]
+    MODEL_SLIDING_WINDOW_LEN = firstTierConfig["MODEL_SLIDING_WINDOW_LEN"]
+    SAVED_MODEL_LOCATION = firstTierConfig["SAVED_MODEL_LOCATION"]
+    BUFFER_HOURS = PREDICTION_WINDOW_HOURS - 24
+    return
+
+def getSourceConfig(firstTierConfig, region, source, sourceIdx, period):
+    global PREDICTION_WINDOW_HOURS
+    regionConfig = firstTierConfig[region]
+    trainTestPeriodConfig = firstTierConfig["TRAIN_TEST_PERIOD"]
+    sourceConfig = {}
+    sourceConfig["inFileName"] = (regionConfig["IN_FILE_NAME_PREFIX"] + source.lower() + 
+                                    firstTierConfig["IN_FILE_NAME_SUFFIX"])
+    sourceConfig["weatherForecastInFileName"] = regionConfig["WEATHER_FORECAST_IN_FILE_NAME"]
+    sourceConfig["sourceCol"] = regionConfig["SOURCE_COL"][sourceIdx]
+    sourceConfig["partialSourceProductionForecastAvailable"] = regionConfig["PARTIAL_FORECAST_AVAILABILITY_LIST"][sourceIdx]
+    sourceConfig["numFeatures"] = regionConfig["NUM_FEATURES"]
+    sourceConfig["isRenewableSource"] = False
+    sourceConfig["numWeatherFeatures"] = 0
+    if (source == "SOLAR" or source == "WIND" or source == "HYDRO"):
+        sourceConfig["isRenewableSource"] = True
+        sourceConfig["numWeatherFeatures"] = regionConfig["NUM_WEATHER_FEATURES"]
+    sourceConfig["datasetLimiter"] = trainTestPeriodConfig[period]["DATASET_LIMITER"]
+    sourceConfig["numTestDays"] = trainTestPeriodConfig[period]["NUM_TEST_DAYS"]
+    sourceConfig["numValDays"] = firstTierConfig["NUM_VAL_DAYS"]
+    sourceConfig["weatherDatasetLimiter"] = sourceConfig["datasetLimiter"]//24*PREDICTION_WINDOW_HOURS
+    print(sourceConfig["inFileName"])
+    print(sourceConfig["weatherForecastInFileName"])
+    return sourceConfig
+
+def prepareTrainingData(firstTierConfig, region, source, sourceIdx, period):
+    global TRAINING_WINDOW_HOURS
+    global PREDICTION_WINDOW_HOURS
+    sourceConfig = getSourceConfig(firstTierConfig, region, source, sourceIdx, period)
+    sourceCol = sourceConfig["sourceCol"]
+    numFeatures = sourceConfig["numFeatures"]
+    numTestDays = sourceConfig["numTestDays"]
+    numValDays = sourceConfig["numValDays"]
+    isRenewableSource = sourceConfig["isRenewableSource"]
+    print(numTestDays)
+
+    print("Initializing...")
+    dataset, dateTime, bufferPeriod, bufferDates, weatherDataset = initialize(
+                sourceConfig["inFileName"], sourceConfig["weatherForecastInFileName"], sourceCol,
+                sourceConfig["datasetLimiter"], sourceConfig["weatherDatasetLimiter"])
+    # bufferPeriod is for the last test date, if prediction period is beyond 24 hours
+    print("***** Initialization done *****")
+
+    # split into train and test
+    print("Spliting dataset into train/test...")
+    trainData, valData, testData, fullTrainData = common.splitDataset(dataset.values, numTestDays, 
+                                            numValDays)
+    trainDates = dateTime[: -(numTestDays*24)]
+    fullTrainDates = np.copy(trainDates)
+    trainDates, validationDates = trainDates[: -(numValDays*24)], trainDates[-(numValDays*24):]
+    testDates = dateTime[-(numTestDays*24):]
+    bufferPeriod = bufferPeriod.values
+    trainData = trainData[:, sourceCol: sourceCol+numFeatures]
+    valData = valData[:, sourceCol: sourceCol+numFeatures]
+    testData = testData[:, sourceCol: sourceCol+numFeatures]
+    partialSourceProductionForecast = None
+        
+    bufferPeriod = bufferPeriod[:, sourceCol: sourceCol+numFeatures]
+    if(len(bufferDates)>0):
+        testDates = np.append(testDates, bufferDates)
+        testData = np.vstack((testData, bufferPeriod))
+
+    print("TrainData shape: ", trainData.shape) # (days x hour) x features
+    print("ValData shape: ", valData.shape) # (days x hour) x features
+    print("TestData shape: ", testData.shape) # (days x hour) x features
+
+    wTrainData, wValData, wTestData, wFullTrainData = None, None, None, None
+    wFtMin, wFtMax = None, None
+    if (isRenewableSource):
+        wTrainData, wValData, wTestData, wFullTrainData = common.splitWeatherDataset(
+                weatherDataset.values, numTestDays, numValDays, PREDICTION_WINDOW_HOURS)
+        print("WeatherTrainData shape: ", wTrainData.shape) # (days x hour) x features
+        print("WeatherValData shape: ", wValData.shape) # (days x hour) x features
+        print("WeatherTestData shape: ", wTestData.shape) # (days x hour) x features
+
+    print("***** Dataset split done *****")
+
+    trainData = fillMissingData(trainData)
+    valData = fillMissingData(valData)
+    testData = fillMissingData(testData)
+    featureList = dataset.columns.values
+    featureList = featureList[sourceCol:sourceCol+numFeatures].tolist()
+
+    print("Scaling data...")
+    trainData, valData, testData, ftMin, ftMax = common.scaleDataset(trainData, valData, testData)
+    print(trainData.shape, valData.shape, testData.shape)
+
+    if(isRenewableSource):
+        wTrainData = fillMissingData(wTrainData)
+        wValData = fillMissingData(wValData)
+        wTestData = fillMissingData(wTestData)
+        featureList.extend(weatherDataset.columns.values)
+        wTrainData, wValData, wTestData, wFtMin, wFtMax = common.scaleDataset(wTrainData, wValData, wTestData)
+        print(wTrainData.shape, wValData.shape, wTestData.shape)
+        # [issue day, PREDICTION_WINDOW_HOURS, features] forecasts of the training, validation & test issue days
+        weatherStore = weatherForecastStore.WeatherForecastStore(np.vstack((wTrainData, wValData, wTestData)),
+                PREDICTION_WINDOW_HOURS, weatherDataset.index.values)
+        wTrainData, wValData, wTestData = weatherStore.splitIssueDays(numTestDays, numValDays)
+
+    print("Features: ", featureList)
+        
+    if (sourceConfig["partialSourceProductionForecastAvailable"]):
+        partialSourceProductionForecast = dataset["avg_"+source.lower()+"_production_forecast"].iloc[-numTestDays*24:].values
+        partialSourceProductionForecast = common.scaleColumn(partialSourceProductionForecast, 
+                ftMin[DEPENDENT_VARIABLE_COL], ftMax[DEPENDENT_VARIABLE_COL])
+        # print(partialSourceProductionForecast, ftMax[DEPENDENT_VARIABLE_COL], ftMin[DEPENDENT_VARIABLE_COL])
+    print("***** Data scaling done *****")
+
+    sourceData = {"trainData": trainData, "valData": valData, "testData": testData,
+                "wTrainData": wTrainData, "wValData": wValData, "wTestData": wTestData,
+                "testDates": testDates, "ftMin": ftMin, "ftMax": ftMax, "wFtMin": wFtMin, "wFtMax": wFtMax,
+                "featureList": featureList, "numFeatures": numFeatures+sourceConfig["numWeatherFeatures"],
+                "history": valData[-TRAINING_WINDOW_HOURS:, :],
+                "partialSourceProductionForecast": partialSourceProductionForecast}
+    return sourceData
+
+# Only the test period (plus the history & weather forecasts just before it) is loaded & scaled
+# using the saved scaler. No training/validation data is built.
+def prepareInferenceData(firstTierConfig, region, source, sourceIdx, period, metadata):
+    global TRAINING_WINDOW_HOURS
+    global PREDICTION_WINDOW_HOURS
+    sourceConfig = getSourceConfig(firstTierConfig, region, source, sourceIdx, period)
+    sourceCol = sourceConfig["sourceCol"]
+    numFeatures = sourceConfig["numFeatures"]
+    numTestDays = sourceConfig["numTestDays"]
+    isRenewableSource = sourceConfig["isRenewableSource"]
+    ftMin, ftMax = metadata["ftMin"], metadata["ftMax"]
+    wFtMin, wFtMax = metadata["wFtMin"], metadata["wFtMax"]
+
+    print("Initializing...")
+    numHistoryAndTestRows = TRAINING_WINDOW_HOURS + numTestDays*24
+    dataset, dateTime, bufferPeriod, bufferDates, weatherDataset = initialize(
+                sourceConfig["inFileName"], sourceConfig["weatherForecastInFileName"], sourceCol,
+                sourceConfig["datasetLimiter"], sourceConfig["weatherDatasetLimiter"], 
+                numHistoryAndTestRows, (numTestDays+1)*PREDICTION_WINDOW_HOURS)
+    print("***** Initialization done *****")
+
+    data = dataset.values[:, sourceCol: sourceCol+numFeatures]
+    history, testData = data[:TRAINING_WINDOW_HOURS], data[TRAINING_WINDOW_HOURS:]
+    testDates = dateTime[TRAINING_WINDOW_HOURS:]
+    if(len(bufferDates)>0):
+        testDates = np.append(testDates, bufferDates)
+        testData = np.vstack((testData, bufferPeriod.values[:, sourceCol: sourceCol+numFeatures]))
+    history = common.scaleWithMinMax(fillMissingData(history), ftMin, ftMax)
+    testData = common.scaleWithMinMax(fillMissingData(testData), ftMin, ftMax)
+    print("History shape: ", history.shape, "TestData shape: ", testData.shape)
+
+    wTestData = None
+    if (isRenewableSource):
+        wData = common.scaleWithMinMax(fillMissingData(weatherDataset.values.astype(np.float64)), wFtMin, wFtMax)
+        # the forecasts of the day before the first test day & of the test days
+        wTestData = weatherForecastStore.WeatherForecastStore(wData, PREDICTION_WINDOW_HOURS, 
+                weatherDataset.index.values)
+        print("WeatherTestData shape: ", wTestData.data.shape)
+
+    partialSourceProductionForecast = None
+    if (sourceConfig["partialSourceProductionForecastAvailable"]):
+        partialSourceProductionForecast = dataset["avg_"+source.lower()+"_production_forecast"].iloc[-numTestDays*24:].values
+        partialSourceProductionForecast = common.scaleColumn(partialSourceProductionForecast, 
+                ftMin[DEPENDENT_VARIABLE_COL], ftMax[DEPENDENT_VARIABLE_COL])
+
+    sourceData = {"testData": testData, "wTestData": wTestData, "testDates": testDates,
+                "ftMin": ftMin, "ftMax": ftMax, "wFtMin": wFtMin, "wFtMax": wFtMax,
+                "featureList": metadata["featureList"], "numFeatures": metadata["numFeatures"],
+                "history": history,
+                "partialSourceProductionForecast": partialSourceProductionForecast}
+    return sourceData
+
+def getModelMetadata(region, source, period, sourceData, mapeScore):
+    global TRAINING_WINDOW_HOURS
+    global PREDICTION_WINDOW_HOURS
+    metadata = {"region": region, "source": source, "period": period,
+                "ftMin": sourceData["ftMin"], "ftMax": sourceData["ftMax"],
+                "wFtMin": sourceData["wFtMin"], "wFtMax": sourceData["wFtMax"],
+                "featureList": sourceData["featureList"], "numFeatures": sourceData["numFeatures"],
+                "trainingWindowHours": TRAINING_WINDOW_HOURS, 
+                "predictionWindowHours": PREDICTION_WINDOW_HOURS,
+                "testMAPE": mapeScore}
+    return metadata
+
 def initialize(inFileName, weatherForecastInFileName, startCol, datasetLimiter,
-                weatherDatasetLimiter):
+                weatherDatasetLimiter, numLastRows=None, numLastWeatherRows=None):
 
     global BUFFER_HOURS
     # load the new file
-    dataset = pd.read_csv(inFileName, header=0, infer_datetime_format=True, 
+    with instrumentation.stage("readCsv"):
+        dataset = pd.read_csv(inFileName, header=0, infer_datetime_format=True, 
+                            parse_dates=['UTC time'], index_col=['UTC time'])
+
+        weatherDataset = pd.read_csv(weatherForecastInFileName, header=0, infer_datetime_format=True, 
                             parse_dates=['UTC time'], index_col=['UTC time'])
+    # print(weatherDataset.head())
+
+    if (numLastRows is not None):
+        # Inference only: keep only the last rows before the limiter (& the buffer period)
+        # so that date/time features are not computed for the whole training period
+        dataset = dataset[datasetLimiter-numLastRows:datasetLimiter+BUFFER_HOURS]
+        datasetLimiter = numLastRows
+        weatherDataset = weatherDataset[weatherDatasetLimiter-numLastWeatherRows:weatherDatasetLimiter]
+        weatherDatasetLimiter = numLastWeatherRows
 
     # print(dataset.head())
     # print(dataset.columns)
     dateTime = dataset.index.values
-
-    weatherDataset = pd.read_csv(weatherForecastInFileName, header=0, infer_datetime_format=True, 
-                            parse_dates=['UTC time'], index_col=['UTC time'])
-    # print(weatherDataset.head())
     
     print("\nAdding features related to date & time...")
-    modifiedDataset = common.addDateTimeFeatures(dataset, dateTime, startCol)
+    with instrumentation.stage("addDateTimeFeatures"):
+        modifiedDataset = common.addDateTimeFeatures(dataset, dateTime, startCol)
     dataset = modifiedDataset
     print("Features related to date & time added")
 
@@ -265,32 +433,31 @@ def fillMissingData(data): # If some data is missing (NaN), use the same value a
                 data[i, j] = data[i-1, j]
     return data
 
-def trainingandValidationPhase(trainData, wTrainData, valData, wValData, firstTierConfig):
+def trainingandValidationPhase(trainData, wTrainData, valData, wValData, firstTierConfig, numReplicas=1):
     global TRAINING_WINDOW_HOURS
-    print("\nManipulating training data...")
-    X, y = manipulateTrainingDataShape(trainData, TRAINING_WINDOW_HOURS, wTrainData)
-    print("\nManipulating validation data...")
-    # Next line actually labels validation data
-    valX, valY = manipulateTrainingDataShape(valData, TRAINING_WINDOW_HOURS, wValData)
+    with instrumentation.stage("buildTrainingWindows"):
+        print("\nManipulating training data...")
+        X, y = manipulateTrainingDataShape(trainData, TRAINING_WINDOW_HOURS, wTrainData)
+        print("\nManipulating validation data...")
+        # Next line actually labels validation data
+        valX, valY = manipulateTrainingDataShape(valData, TRAINING_WINDOW_HOURS, wValData)
                     
     print("***** Training and validation data manipulation done *****")
     print("X.shape, y.shape: ", X.shape, y.shape)
     hyperParams = getANNHyperParams(firstTierConfig)                
     print("\n[BESTMODEL] Starting training...")
-    bestTrainedModel = trainANN(X, y, valX, valY, hyperParams)
+    bestTrainedModel = trainANN(X, y, valX, valY, hyperParams, numReplicas)
     print("***** Training done *****")
     return bestTrainedModel
 
 # convert training data into inputs and outputs (labels)
-def manipulateTrainingDataShape(data, labelWindowHours, weatherData = None):
+# weatherStore has one forecast per day of data. A window starting at hour h of a day uses that day's
+# forecast from lead h on.
+def manipulateTrainingDataShape(data, labelWindowHours, weatherStore = None):
     global TRAINING_WINDOW_HOURS
-    global PREDICTION_WINDOW_HOURS
 
     print("Data shape: ", data.shape)
-    global PREDICTION_WINDOW_HOURS
     X, y, weatherX = list(), list(), list()
-    weatherIdx = 0
-    hourIdx = 0
     # step over the entire history one time step at a time
     for i in range(len(data)-(TRAINING_WINDOW_HOURS+labelWindowHours)+1):
         # define the end of the input sequence
@@ -299,17 +466,12 @@ def manipulateTrainingDataShape(data, labelWindowHours, weatherData = None):
         xInput = data[i:trainWindow, :]
         # xInput = xInput.reshape((len(xInput), 1))
         X.append(xInput)
-        if(weatherData is not None):
-            weatherX.append(weatherData[weatherIdx:weatherIdx+TRAINING_WINDOW_HOURS])
-            weatherIdx +=1
-            hourIdx +=1
-            if(hourIdx ==24):
-                hourIdx = 0
-                weatherIdx += (PREDICTION_WINDOW_HOURS-24)
+        if(weatherStore is not None):
+            weatherX.append(weatherStore.getWindow(i//24, i%24, i%24+TRAINING_WINDOW_HOURS))
         y.append(data[trainWindow:labelWindow, DEPENDENT_VARIABLE_COL])
     X = np.array(X, dtype=np.float64)
     y = np.array(y, dtype=np.float64)
-    if(weatherData is not None):
+    if(weatherStore is not None):
         weatherX = np.array(weatherX, dtype=np.float64)
         X = np.append(X, weatherX, axis=2)
     return X, y
@@ -330,30 +492,51 @@ def manipulateTestDataShape(data, isDates=False):
     return X
 
 
-def trainANN(trainX, trainY, valX, valY, hyperParams):
-    n_timesteps, n_features, n_outputs = trainX.shape[1], trainX.shape[2], trainY.shape[1]
-    epochs = hyperParams["epoch"]
-    batchSize = hyperParams["batchsize"]
-    lossFunc = hyperParams["loss"]
+def createANNModel(n_timesteps, n_features, n_outputs, hyperParams):
     actvFunc = hyperParams["actv"]
     hiddenDims = hyperParams["hidden"]
-    learningRates = hyperParams["lr"]
     model = Sequential()
     model.add(Flatten())
     model.add(Dense(hiddenDims[0], input_shape=(n_timesteps, n_features), activation=actvFunc)) # 50
     model.add(Dense(hiddenDims[1], activation=actvFunc)) # 34
     model.add(Dense(n_outputs))
+    return model
+
+def trainANN(trainX, trainY, valX, valY, hyperParams, numReplicas=1):
+    n_timesteps, n_features, n_outputs = trainX.shape[1], trainX.shape[2], trainY.shape[1]
+    epochs = hyperParams["epoch"]
+    batchSize = hyperParams["batchsize"]
+    lossFunc = hyperParams["loss"]
+    learningRates = hyperParams["lr"]
+    if (numReplicas > 1):
+        # ensemble mode: numReplicas independently initialized models trained together
+        model = ensemble.createEnsembleModel(
+                lambda: createANNModel(n_timesteps, n_features, n_outputs, hyperParams), 
+                numReplicas, (n_timesteps, n_features))
+        trainY = ensemble.tileTargets(trainY, numReplicas)
+        valY = ensemble.tileTargets(valY, numReplicas)
+    else:
+        model = createANNModel(n_timesteps, n_features, n_outputs, hyperParams)
     
     opt = tf.keras.optimizers.Adam(learning_rate = learningRates)
-    model.compile(loss=lossFunc, optimizer=opt,
-                    metrics=['mean_absolute_error'])
-    es = EarlyStopping(monitor='val_loss', mode='min', verbose=1, patience=10)
-    mc = ModelCheckpoint('best_model_ann.h5', monitor='val_loss', mode='min', verbose=1, save_best_only=True)
+    if (numReplicas > 1):
+        # early stopping & best weights per replica, on each replica's own validation loss
+        model.compile(loss=lossFunc, optimizer=opt,
+                        metrics=['mean_absolute_error']+ensemble.getReplicaLossMetrics(lossFunc, numReplicas))
+        callbacks = [ensemble.ReplicaEarlyStopping(numReplicas, patience=10)]
+    else:
+        model.compile(loss=lossFunc, optimizer=opt,
+                        metrics=['mean_absolute_error'])
+        es = EarlyStopping(monitor='val_loss', mode='min', verbose=1, patience=10)
+        mc = ModelCheckpoint('best_model_ann.h5', monitor='val_loss', mode='min', verbose=1, save_best_only=True)
+        callbacks = [es, mc]
     # fit network
     # hist = model.fit(trainX, trainY, epochs=epochs, batch_size=bSize, verbose=verbose)
-    hist = model.fit(trainX, trainY, epochs=epochs, batch_size=batchSize[0], verbose=2,
-                        validation_data=(valX, valY), callbacks=[es, mc])
-    model = load_model("best_model_ann.h5")
+    with instrumentation.stage("fit", profile=True):
+        hist = model.fit(trainX, trainY, epochs=epochs, batch_size=batchSize[0], verbose=2,
+                        validation_data=(valX, valY), callbacks=callbacks)
+    if (numReplicas == 1):
+        model = load_model("best_model_ann.h5")
     common.showModelSummary(hist, model)
     print("Number of features used in training: ", n_features)
     return model
@@ -362,22 +545,21 @@ def trainANN(trainX, trainY, valX, valY, hyperParams):
 
 # walk-forward validation
 def getOneShotForecasts(trainX, trainY, model, history, testData, trainWindowHours, 
-            numFeatures, wTestData = None, weatherData = None, partialSourceProductionForecast = None):
+            numFeatures, weatherStore = None, partialSourceProductionForecast = None):
     global MODEL_SLIDING_WINDOW_LEN
     global BUFFER_HOURS
     # walk-forward validation over each day
     print("Testing (one shot forecasts)...")
     predictions = list()
-    weatherIdx = 0
     for i in range(0, ((len(testData)//24)-(BUFFER_HOURS//24))):
+        weatherData = None
+        if (weatherStore is not None):
+            weatherData = weatherStore.getWindow(i, 0, trainWindowHours)
         # predict n days in one shot
         yhat_sequence, newTrainingData = getForecasts(model, history, trainWindowHours, numFeatures, weatherData)
         predictions.append(yhat_sequence)
         # get real observation and add to history for predicting the next day
         currentDayHours = i* MODEL_SLIDING_WINDOW_LEN
-        if (wTestData is not None):
-            weatherData = wTestData[weatherIdx:weatherIdx+trainWindowHours, :]
-            weatherIdx +=trainWindowHours
         history.extend(testData[currentDayHours:currentDayHours+MODEL_SLIDING_WINDOW_LEN, :].tolist())
         newLabel = testData[currentDayHours:currentDayHours+MODEL_SLIDING_WINDOW_LEN,0].reshape(1, MODEL_SLIDING_WINDOW_LEN)
         np.append(trainX, newTrainingData)
@@ -394,25 +576,25 @@ def getOneShotForecasts(trainX, trainY, model, history, testData, trainWindowHou
 
 def getDayAheadForecasts(model, history, testData, 
                             numFeatures,
-                            wTestData = None, weatherData = None, 
+                            weatherStore = None, 
                             partialSourceProductionForecast = None):
     global TRAINING_WINDOW_HOURS
     global MODEL_SLIDING_WINDOW_LEN
     global PREDICTION_WINDOW_HOURS
     global BUFFER_HOURS
     # walk-forward validation over each day
+    # weatherStore: issue day i is the forecast for test day i
     print("Testing (day ahead forecasts)...")
     predictions = list()
-    weatherIdx = 0
     for i in range(0, ((len(testData)//24)-(BUFFER_HOURS//24))):
         dayAheadPredictions = list()
         # predict n days, 1 day at a time
         tempHistory = history.copy()
         currentDayHours = i* MODEL_SLIDING_WINDOW_LEN
         for j in range(0, PREDICTION_WINDOW_HOURS, 24):
-            if (weatherData is not None):
+            if (weatherStore is not None):
                 yhat_sequence, newTrainingData = getForecasts(model, tempHistory, 
-                            numFeatures, weatherData[j:j+24])
+                            numFeatures, weatherStore.getWindow(i, j, j+24))
             else:
                 yhat_sequence, newTrainingData = getForecasts(model, tempHistory, 
                             numFeatures, None)
@@ -430,15 +612,55 @@ def getDayAheadForecasts(model, history, testData,
         
         history.extend(testData[currentDayHours:currentDayHours+MODEL_SLIDING_WINDOW_LEN, :].tolist())
         predictions.append(dayAheadPredictions)
-        if (wTestData is not None):
-            weatherData = wTestData[weatherIdx:weatherIdx+PREDICTION_WINDOW_HOURS, :]
-            weatherIdx +=PREDICTION_WINDOW_HOURS
 
     # evaluate predictions days for each day
     predictedData = np.array(predictions, dtype=np.float64)
     return predictedData
 
 
+# walk-forward validation of all replicas of an ensemble model. Each replica feeds its own predictions
+# back into its history, and all replicas are run in a single predict call per step.
+def getEnsembleDayAheadForecasts(model, numReplicas, history, testData, 
+                            numFeatures,
+                            weatherStore = None, 
+                            partialSourceProductionForecast = None):
+    global TRAINING_WINDOW_HOURS
+    global MODEL_SLIDING_WINDOW_LEN
+    global PREDICTION_WINDOW_HOURS
+    global BUFFER_HOURS
+    print("Testing (day ahead forecasts, ensemble of ", numReplicas, " replicas)...")
+    predictions = list()
+    history = np.array(history, dtype=np.float64)[-TRAINING_WINDOW_HOURS:]
+    for i in range(0, ((len(testData)//24)-(BUFFER_HOURS//24))):
+        dayAheadPredictions = list()
+        # [numReplicas, TRAINING_WINDOW_HOURS, features]
+        tempHistory = np.repeat(history[np.newaxis, :, :], numReplicas, axis=0)
+        currentDayHours = i* MODEL_SLIDING_WINDOW_LEN
+        for j in range(0, PREDICTION_WINDOW_HOURS, 24):
+            input_x = tempHistory[:, -TRAINING_WINDOW_HOURS:, :]
+            if (weatherStore is not None):
+                replicaWeatherData = np.repeat(weatherStore.getWindow(i, j, j+24)[np.newaxis], numReplicas, axis=0)
+                input_x = np.append(input_x, replicaWeatherData, axis=2)
+            input_x = input_x.reshape((numReplicas, TRAINING_WINDOW_HOURS, numFeatures))
+            yhat_sequence = ensemble.predictReplicas(model, input_x) # [numReplicas, 24]
+            if (j==0 and partialSourceProductionForecast is not None):
+                yhat_sequence[:, :24] = partialSourceProductionForecast[currentDayHours:currentDayHours+24]
+            dayAheadPredictions.append(yhat_sequence)
+            # add current prediction to history for predicting the next day
+            latestHistory = np.repeat(testData[np.newaxis, currentDayHours+j:currentDayHours+j+24, :], 
+                                numReplicas, axis=0)
+            latestHistory[:, :, DEPENDENT_VARIABLE_COL] = yhat_sequence[:, :24]
+            tempHistory = np.append(tempHistory, latestHistory, axis=1)[:, -TRAINING_WINDOW_HOURS:, :]
+
+        # get real observation and add to history for predicting the next day
+        history = np.append(history, testData[currentDayHours:currentDayHours+MODEL_SLIDING_WINDOW_LEN, :], 
+                            axis=0)[-TRAINING_WINDOW_HOURS:]
+        predictions.append(np.concatenate(dayAheadPredictions, axis=1))
+
+    # [numReplicas, days, PREDICTION_WINDOW_HOURS]
+    predictedData = np.array(predictions, dtype=np.float64).transpose(1, 0, 2)
+    return predictedData
+
 def getForecasts(model, history, numFeatures, weatherData):
     global TRAINING_WINDOW_HOURS
     # flatten data
@@ -460,12 +682,14 @@ def getForecasts(model, history, numFeatures, weatherData):
 def getANNHyperParams(firstTierConfig):
     hyperParams = {}
     modelHyperparamsFromConfigFile = firstTierConfig["FIRST_TIER_ANN_MODEL_HYPERPARAMS"]
-    hyperParams["epoch"] = modelHyperparamsFromConfigFile["EPOCH"]
-    hyperParams["batchsize"] = modelHyperparamsFromConfigFile["BATCH_SIZE"]
-    hyperParams["actv"] = modelHyperparamsFromConfigFile["ACTIVATION_FUNC"]
-    hyperParams["loss"] = modelHyperparamsFromConfigFile["LOSS_FUNC"]
-    hyperParams["lr"] = modelHyperparamsFromConfigFile["LEARNING_RATE"]
-    hyperParams["hidden"] = modelHyperparamsFromConfigFile["HIDDEN_UNITS"]
+    # Entries may list several candidate values for the hyperparameter search.
+    # Otherwise, the first candidate is used.
+    hyperParams["epoch"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["EPOCH"])[0]
+    hyperParams["batchsize"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["BATCH_SIZE"])
+    hyperParams["actv"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["ACTIVATION_FUNC"])[0]
+    hyperParams["loss"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["LOSS_FUNC"])[0]
+    hyperParams["lr"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["LEARNING_RATE"])[0]
+    hyperParams["hidden"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["HIDDEN_UNITS"], True)[0]
     return hyperParams
 
 def getUnscaledForecastsAndForecastAccuracy(testData, testDates, predictedData, ftMin, ftMax):
@@ -509,10 +733,17 @@ def writeSourceProductionForecastsToFile(formattedTestDates, unscaledTestData, u
 
 if __name__ == "__main__":
     print("CarbonCast first tier. Refer github repo for regions & sources.")
-    if (len(sys.argv) !=2):
-        print("Usage: python3 firstTierForecasts.py <configFileName>")
+    loadFromSavedModel = False
+    if (len(sys.argv) < 2):
+        print("Usage: python3 firstTierForecasts.py <configFileName> <-s>")
+        print("-s is optional. If provided, CarbonCast will load the saved models (& scalers) from the")
+        print("model registry and only generate forecasts. Otherwise, CarbonCast will train the first tier")
+        print("models and save them in the registry.")
         print("")
         exit(0)
+    else:
+        if (len(sys.argv) == 3 and sys.argv[2] == "-s"):
+            loadFromSavedModel = True
     configFileName = sys.argv[1]
-    runFirstTier(configFileName)
+    runFirstTier(configFileName, loadFromSavedModel)
     print("End")
\ No newline at end of file
@@ -0,0 +1,224 @@
+'''
+Long-running second tier forecasting daemon.
+The direct & lifecycle models of every region (from the saved model locations) and their scaled
+history & test rows are loaded once at startup, with the saved scaler & features of each model (the saved
+model fast path of secondTierForecasts.py; the full data preparation is only run if the model has no
+metadata yet). Forecasts are served over HTTP:
+    GET /forecast?region=<region>&type=<direct/lifecycle>[&day=<test day index>]
+        96-hour carbon intensity forecast issued at the given test day (default: latest day).
+    GET /status
+        Loaded models & batching statistics.
+The daemon replays the test days of the input files (the last NUM_TEST_DAYS days): the latest day is the
+last test day, not today. To serve forecasts for new days, append them to the input files & restart it.
+The models are kept in the model cache (modelCache.py) & looked up for every batch of requests: at most
+MODEL_CACHE["CAPACITY"] models are in memory (evicted ones are reloaded on their next request), & a model
+is reloaded when its .h5 file is replaced.
+Concurrent requests for the same model are micro-batched: requests arriving within
+MAX_BATCH_WAIT_MS of each other (up to MAX_BATCH_SIZE) are forecasted together, with one model
+call per 24-hour step for the whole batch.
+'''
+
+import json as stdjson
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import json5 as json
+import numpy as np
+
+import common
+import modelRegistry
+import secondTierForecasts
+
+CEF_TYPES = {"direct": "-d", "lifecycle": "-l"}
+
+
+class ForecastServer(ThreadingHTTPServer):
+    # the default listen backlog (5) drops connections under concurrent load
+    request_queue_size = 128
+
+
+class ModelBatcher:
+    # Serves the forecast requests of one (region, CEF type) model from a single worker thread
+    def __init__(self, region, cefType, modelFileName, regionData, maxBatchSize, maxBatchWaitSeconds):
+        self.region = region
+        self.cefType = cefType
+        self.modelFileName = modelFileName
+        self.ftMin, self.ftMax = regionData["ftMin"], regionData["ftMax"]
+        self.valData, self.testData = regionData["valData"], regionData["testData"]
+        self.wTestData = regionData["wTestData"]
+        self.testDates = regionData["testDates"]
+        self.numDays = ((len(self.testData)//24)-(secondTierForecasts.BUFFER_HOURS//24))
+        self.maxBatchSize = maxBatchSize
+        self.maxBatchWaitSeconds = maxBatchWaitSeconds
+        self.requestQueue = queue.Queue()
+        self.stats = {"requests": 0, "batches": 0, "model_calls": 0}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, day):
+        future = Future()
+        self.requestQueue.put((day, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.requestQueue.get()]
+            deadline = time.perf_counter() + self.maxBatchWaitSeconds
+            while len(batch) < self.maxBatchSize:
+                timeout = deadline - time.perf_counter()
+                if (timeout <= 0):
+                    break
+                try:
+                    batch.append(self.requestQueue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            # requests for the same day share one forecast
+            days = sorted(set([day for day, _ in batch]))
+            try:
+                # The model is looked up in the cache for every batch, so that it is reloaded if its file
+                # changed (or if it was evicted); the compiled prediction function is reused while it is cached.
+                model = secondTierForecasts.MODEL_CACHE.get(self.region, self.cefType, self.modelFileName)
+                forecasts = self.getForecasts(secondTierForecasts.getPredictFunction(model), days)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.stats["requests"] += len(batch)
+            self.stats["batches"] += 1
+            for day, future in batch:
+                future.set_result(forecasts[days.index(day)])
+
+    def getForecasts(self, predictFunction, days):
+        # Same recursive forecasting as secondTierForecasts.getDayAheadForecasts, for a batch of days
+        trainWindowHours = secondTierForecasts.TRAINING_WINDOW_HOURS
+        predictionWindowHours = secondTierForecasts.PREDICTION_WINDOW_HOURS
+        depVarColumn = secondTierForecasts.DEPENDENT_VARIABLE_COL
+        valAndTestData = np.vstack((self.valData[-trainWindowHours:], self.testData))
+        history = np.array([valAndTestData[day*24:day*24+trainWindowHours] for day in days])
+        # issue day i of wTestData is the forecast for test day i
+        weatherData = self.wTestData.getWindows(np.array(days)[:, np.newaxis], 
+                                                np.arange(predictionWindowHours)[np.newaxis, :])
+
+        predictions = []
+        for j in range(0, predictionWindowHours, 24):
+            input_x = np.append(history[:, -trainWindowHours:], weatherData[:, j:j+24], axis=2)
+            yhat = predictFunction(input_x.astype(np.float32)).numpy()
+            self.stats["model_calls"] += 1
+            predictions.append(yhat[:, :24])
+            # add current prediction to history for predicting the next day
+            latestHistory = np.array([self.testData[day*24+j:day*24+j+24] for day in days])
+            latestHistory[:, :, depVarColumn] = yhat[:, :24]
+            history = np.append(history, latestHistory, axis=1)
+        predictions = np.concatenate(predictions, axis=1)
+
+        forecasts = []
+        for i in range(len(days)):
+            unscaledForecast = common.inverseDataScaling(predictions[i].astype(np.float64),
+                                    self.ftMax[depVarColumn], self.ftMin[depVarColumn])
+            forecasts.append({"region": self.region, "type": self.cefType, "day": days[i],
+                            "start": str(self.testDates[days[i]*24]),
+                            "carbon_intensity_forecast": unscaledForecast.tolist()})
+        return forecasts
+
+
+def loadRegionData(secondTierConfig, region, cefType):
+    # Only the history & test rows, scaled with the saved scaler of the model (as with -s)
+    metadata = secondTierForecasts.loadSavedModelMetadata(region)
+    if (metadata is not None):
+        return secondTierForecasts.prepareInferenceData(secondTierConfig, region, cefType, metadata)
+    regionData = secondTierForecasts.prepareRegionData(secondTierConfig, region, cefType)
+    print("Saving scaler & feature metadata to ", secondTierForecasts.getSavedMetadataFileName(region))
+    modelRegistry.writeMetadataFile(secondTierForecasts.getSavedMetadataFileName(region),
+                                    secondTierForecasts.getModelMetadata(region, regionData))
+    return regionData
+
+def loadBatchers(secondTierConfig):
+    daemonConfig = secondTierConfig["FORECAST_DAEMON"]
+    batchers = {}
+    for region in secondTierConfig["REGION"]:
+        for cefTypeName, cefType in CEF_TYPES.items():
+            print("Loading ", cefTypeName, " model & data for region: ", region)
+            secondTierForecasts.CEF_TYPE = cefTypeName
+            secondTierForecasts.SAVED_MODEL_LOCATION = secondTierConfig["DIRECT_SAVED_MODEL_LOCATION"]
+            if (cefType == "-l"):
+                secondTierForecasts.SAVED_MODEL_LOCATION = secondTierConfig["LIFECYCLE_SAVED_MODEL_LOCATION"]
+            modelFileName = secondTierForecasts.getSavedModelFileName(region)
+            secondTierForecasts.MODEL_CACHE.get(region, cefTypeName, modelFileName)
+            regionData = loadRegionData(secondTierConfig, region, cefType)
+            batchers[(region, cefTypeName)] = ModelBatcher(region, cefTypeName, modelFileName, regionData,
+                                    daemonConfig["MAX_BATCH_SIZE"], daemonConfig["MAX_BATCH_WAIT_MS"]/1000)
+    return batchers
+
+def getRequestHandler(batchers):
+    class ForecastRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            if (url.path == "/status"):
+                status = {}
+                for (region, cefTypeName), batcher in batchers.items():
+                    status[region+"_"+cefTypeName] = dict(batcher.stats, days=batcher.numDays)
+                status["model_cache"] = secondTierForecasts.MODEL_CACHE.getStats()
+                self.sendJSON(200, status)
+                return
+            if (url.path != "/forecast"):
+                self.sendJSON(404, {"error": "unknown path "+url.path})
+                return
+            region = params.get("region", [None])[0]
+            cefTypeName = params.get("type", ["direct"])[0]
+            if ((region, cefTypeName) not in batchers):
+                self.sendJSON(400, {"error": "no model for region "+str(region)+", type "+cefTypeName})
+                return
+            batcher = batchers[(region, cefTypeName)]
+            day = params.get("day", [str(batcher.numDays-1)])[0]
+            if (not day.isdigit() or int(day) >= batcher.numDays):
+                self.sendJSON(400, {"error": "day should be in [0, "+str(batcher.numDays-1)+"]"})
+                return
+            try:
+                forecast = batcher.submit(int(day)).result()
+            except Exception as e:
+                self.sendJSON(500, {"error": str(e)})
+                return
+            self.sendJSON(200, forecast)
+
+        def sendJSON(self, code, data):
+            body = stdjson.dumps(data).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            return # no per-request logging
+
+    return ForecastRequestHandler
+
+def runDaemon(configFileName):
+    with open(configFileName, "r") as configFile:
+        secondTierConfig = json.load(configFile)
+    secondTierForecasts.initializeMacros(secondTierConfig)
+    daemonConfig = secondTierConfig["FORECAST_DAEMON"]
+    batchers = loadBatchers(secondTierConfig)
+    server = ForecastServer((daemonConfig["HOST"], daemonConfig["PORT"]), getRequestHandler(batchers))
+    print("Forecast daemon listening on http://"+daemonConfig["HOST"]+":"+str(daemonConfig["PORT"]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Shutting down...")
+    server.server_close()
+    return
+
+
+if __name__ == "__main__":
+    if (len(sys.argv) != 2):
+        print("Usage: python3 forecastDaemon.py <configFileName>")
+        print("Serves 96-hour carbon intensity forecasts of the regions in the config file, using the saved models.")
+        print("")
+        exit(0)
+    runDaemon(sys.argv[1])
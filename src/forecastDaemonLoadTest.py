@@ -0,0 +1,57 @@
+'''
+Local load-test client for forecastDaemon.py.
+Sends concurrent forecast requests for a region and reports throughput & latency percentiles.
+'''
+
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+
+import numpy as np
+
+
+def sendRequest(url):
+    start = time.perf_counter()
+    with urlopen(url) as response:
+        forecast = json.loads(response.read())
+    latency = time.perf_counter() - start
+    return latency, forecast
+
+def runLoadTest(daemonAddress, region, cefTypeName, numRequests, concurrency):
+    with urlopen("http://"+daemonAddress+"/status") as response:
+        status = json.loads(response.read())
+    numDays = status[region+"_"+cefTypeName]["days"]
+    # spread requests over all available days, so that batches contain different inputs
+    urls = []
+    for i in range(numRequests):
+        urls.append("http://"+daemonAddress+"/forecast?region="+region+"&type="+cefTypeName+
+                    "&day="+str(i % numDays))
+
+    print("Sending ", numRequests, " requests with concurrency ", concurrency, "...")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(sendRequest, urls))
+    totalTime = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _ in results])*1000
+    print("Throughput: ", round(numRequests/totalTime, 2), " requests/s")
+    print("Latency (ms) -- mean: ", round(np.mean(latencies), 2),
+            ", p50: ", round(np.percentile(latencies, 50), 2),
+            ", p90: ", round(np.percentile(latencies, 90), 2),
+            ", p99: ", round(np.percentile(latencies, 99), 2),
+            ", max: ", round(np.max(latencies), 2))
+    with urlopen("http://"+daemonAddress+"/status") as response:
+        stats = json.loads(response.read())[region+"_"+cefTypeName]
+    if (stats["batches"] > 0):
+        print("Avg. requests per batch (since daemon start): ", round(stats["requests"]/stats["batches"], 2))
+    return
+
+
+if __name__ == "__main__":
+    if (len(sys.argv) != 6):
+        print("Usage: python3 forecastDaemonLoadTest.py <host:port> <region> <direct/lifecycle> <num_requests> <concurrency>")
+        print("")
+        exit(0)
+    runLoadTest(sys.argv[1], sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5]))
@@ -0,0 +1,39 @@
+'''
+Fixed-size history of the last N (scaled) rows used as model input during walk-forward forecasting.
+Rows are written twice into a preallocated buffer of 2N rows, so that the last N rows are always
+a contiguous slice. Appending a row & getting the current window are O(1) w.r.t. the length of
+the history, and no memory is allocated after creation.
+'''
+
+import numpy as np
+
+
+class HistoryBuffer:
+    def __init__(self, initialRows, windowLen=None):
+        initialRows = np.asarray(initialRows, dtype=np.float64)
+        if (windowLen is None):
+            windowLen = len(initialRows)
+        self.windowLen = windowLen
+        self.buffer = np.zeros((2*windowLen, initialRows.shape[1]), dtype=np.float64)
+        self.start = 0
+        self.extend(initialRows[-windowLen:])
+
+    def append(self, row):
+        self.buffer[self.start] = row
+        self.buffer[self.start+self.windowLen] = row
+        self.start = (self.start+1) % self.windowLen
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def getWindow(self):
+        # Last windowLen rows, oldest first. This is a view, copy it if it is kept across appends.
+        return self.buffer[self.start:self.start+self.windowLen]
+
+    def copy(self):
+        historyBuffer = HistoryBuffer.__new__(HistoryBuffer)
+        historyBuffer.windowLen = self.windowLen
+        historyBuffer.buffer = self.buffer.copy()
+        historyBuffer.start = self.start
+        return historyBuffer
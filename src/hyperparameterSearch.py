@@ -0,0 +1,218 @@
+'''
+Parallel hyperparameter search for the first tier (ANN) and second tier (CNN-LSTM) models.
+
+Entries of FIRST_TIER_ANN_MODEL_HYPERPARAMS / SECOND_TIER_CNN_LSTM_MODEL_HYPERPARAMS that list several
+values (e.g., "BATCH_SIZE": [10, 32], "HIDDEN_UNITS": [[50, 34], [50, 50]]) are expanded into a grid
+(or randomly sampled from it). Trials are trained in parallel worker processes and pruned with
+successive halving on val_loss: every rung trains the surviving trials for more epochs, and only
+the best 1/REDUCTION_FACTOR of them move on to the next rung. All results are written to a
+leaderboard file.
+'''
+
+import csv
+import itertools
+import json as stdjson
+import multiprocessing
+import os
+import random
+import sys
+
+import json5 as json
+import numpy as np
+
+import common
+
+# Hyperparameters that are lists themselves. Their candidates are given as a list of lists.
+LIST_VALUED_HYPERPARAMS = ["HIDDEN_UNITS"]
+MODEL_HYPERPARAMS_KEY = {"-1": "FIRST_TIER_ANN_MODEL_HYPERPARAMS",
+                        "-2": "SECOND_TIER_CNN_LSTM_MODEL_HYPERPARAMS"}
+
+# Per worker process cache of training/validation windows, so that trials of the same
+# (tier, region, target) do not rebuild them.
+TRAINING_DATA_CACHE = {}
+
+
+def expandSearchSpace(modelHyperparams):
+    keys = list(modelHyperparams.keys())
+    candidates = []
+    for key in keys:
+        candidates.append(common.getHyperParamCandidates(modelHyperparams[key], 
+                                                        key in LIST_VALUED_HYPERPARAMS))
+
+    trialHyperparamsList = []
+    for combination in itertools.product(*candidates):
+        trialHyperparams = {}
+        for key, value in zip(keys, combination):
+            # BATCH_SIZE is always read as a list by the tiers
+            if (key == "BATCH_SIZE"):
+                value = [value]
+            trialHyperparams[key] = value
+        trialHyperparamsList.append(trialHyperparams)
+    return trialHyperparamsList
+
+def getTrials(searchConfig, modelHyperparams):
+    trialHyperparamsList = expandSearchSpace(modelHyperparams)
+    print("Search space size: ", len(trialHyperparamsList))
+    if (searchConfig["MODE"] == "random"):
+        rng = random.Random(searchConfig["RANDOM_SEED"])
+        numTrials = min(searchConfig["NUM_RANDOM_TRIALS"], len(trialHyperparamsList))
+        trialHyperparamsList = rng.sample(trialHyperparamsList, numTrials)
+    return trialHyperparamsList
+
+def initializeWorker(numThreads):
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(numThreads)
+    tf.config.threading.set_inter_op_parallelism_threads(numThreads)
+    return
+
+def getTrainingData(tier, config, region, target):
+    cacheKey = (tier, region, target)
+    if (cacheKey in TRAINING_DATA_CACHE):
+        return TRAINING_DATA_CACHE[cacheKey]
+    if (tier == "-1"):
+        import firstTierForecasts as tierModule
+        tierModule.initializeMacros(config)
+        sourceIdx = config[region]["SOURCES"].index(target)
+        period = list(config["TRAIN_TEST_PERIOD"].keys())[-1]
+        sourceData = tierModule.prepareTrainingData(config, region, target, sourceIdx, period)
+        X, y = tierModule.manipulateTrainingDataShape(sourceData["trainData"],
+                    tierModule.TRAINING_WINDOW_HOURS, sourceData["wTrainData"])
+        valX, valY = tierModule.manipulateTrainingDataShape(sourceData["valData"],
+                    tierModule.TRAINING_WINDOW_HOURS, sourceData["wValData"])
+    else:
+        import secondTierForecasts as tierModule
+        tierModule.initializeMacros(config)
+        regionData = tierModule.prepareRegionData(config, region, target)
+        X, y = tierModule.manipulateTrainingDataShape(regionData["trainData"], tierModule.TRAINING_WINDOW_HOURS,
+                    tierModule.TRAINING_WINDOW_HOURS, regionData["wTrainData"])
+        valX, valY = tierModule.manipulateTrainingDataShape(regionData["valData"], tierModule.TRAINING_WINDOW_HOURS,
+                    tierModule.TRAINING_WINDOW_HOURS, regionData["wValData"])
+    TRAINING_DATA_CACHE[cacheKey] = (X, y, valX, valY)
+    return TRAINING_DATA_CACHE[cacheKey]
+
+def runTrial(trialArgs):
+    # Trains a trial from initialEpoch up to (total) epochs. The model (with its optimizer state)
+    # is saved in the trial directory, so that the next rung continues from where this one stopped.
+    tier, configFileName, region, target, trialId, trialHyperparams, epochs, initialEpoch, trialDir = trialArgs
+    import tensorflow as tf
+    from keras.callbacks import ReduceLROnPlateau
+    from keras.models import load_model
+
+    with open(configFileName, "r") as configFile:
+        config = json.load(configFile)
+    config[MODEL_HYPERPARAMS_KEY[tier]] = trialHyperparams
+    X, y, valX, valY = getTrainingData(tier, config, region, target)
+    n_timesteps, n_features, n_outputs = X.shape[1], X.shape[2], y.shape[1]
+    modelFileName = os.path.join(trialDir, "model.h5")
+
+    callbacks = []
+    if (tier == "-1"):
+        import firstTierForecasts as tierModule
+        hyperParams = tierModule.getANNHyperParams(config)
+        if (initialEpoch == 0):
+            model = tierModule.createANNModel(n_timesteps, n_features, n_outputs, hyperParams)
+    else:
+        import secondTierForecasts as tierModule
+        hyperParams = tierModule.getHyperParams(config)
+        callbacks.append(ReduceLROnPlateau(monitor="val_loss", mode="min", factor=0.1, patience=6,
+                        verbose=0, min_lr=hyperParams["minlr"]))
+        if (initialEpoch == 0):
+            model = tierModule.createModel(n_timesteps, n_features, n_outputs, hyperParams)
+
+    if (initialEpoch == 0):
+        os.makedirs(trialDir, exist_ok=True)
+        opt = tf.keras.optimizers.Adam(learning_rate = hyperParams["lr"])
+        model.compile(loss=hyperParams["loss"], optimizer=opt, metrics=['mean_absolute_error'])
+    else:
+        model = load_model(modelFileName)
+
+    hist = model.fit(X, y, epochs=epochs, initial_epoch=initialEpoch, batch_size=hyperParams["batchsize"][0],
+                    verbose=0, validation_data=(valX, valY), callbacks=callbacks)
+    model.save(modelFileName)
+    bestValLoss = float(np.min(hist.history["val_loss"]))
+    print("Trial ", trialId, ": epochs ", initialEpoch, "-", epochs, ", best val_loss: ", bestValLoss)
+    return trialId, bestValLoss
+
+def writeLeaderboard(outFileName, trialHyperparamsList, trialResults):
+    print("Writing leaderboard to ", outFileName, "...")
+    fields = ["rank", "trial", "best_val_loss", "epochs_trained", "rungs", "hyperparams"]
+    ranking = sorted(trialResults.keys(), key=lambda trialId: (-trialResults[trialId]["rungs"],
+                                                                trialResults[trialId]["bestValLoss"]))
+    rows = []
+    for rank in range(len(ranking)):
+        trialId = ranking[rank]
+        result = trialResults[trialId]
+        rows.append([rank+1, trialId, result["bestValLoss"], result["epochs"], result["rungs"],
+                        stdjson.dumps(trialHyperparamsList[trialId])])
+    os.makedirs(os.path.dirname(outFileName) or ".", exist_ok=True)
+    with open(outFileName, "w") as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(fields)
+        csvwriter.writerows(rows)
+    return ranking
+
+def runSearch(configFileName, tier, region, target):
+    with open(configFileName, "r") as configFile:
+        config = json.load(configFile)
+    searchConfig = config["HYPERPARAMETER_SEARCH"]
+    modelHyperparams = config[MODEL_HYPERPARAMS_KEY[tier]]
+    # the number of epochs is decided by successive halving, not searched over
+    maxEpochs = max(common.getHyperParamCandidates(modelHyperparams["EPOCH"]))
+    modelHyperparams["EPOCH"] = maxEpochs
+    numWorkers = searchConfig["NUM_WORKERS"]
+    reductionFactor = searchConfig["REDUCTION_FACTOR"]
+    searchDir = os.path.join(searchConfig["OUT_DIR"], region + "_" + target.lstrip("-").lower())
+
+    trialHyperparamsList = getTrials(searchConfig, modelHyperparams)
+    print("No. of trials: ", len(trialHyperparamsList), ", workers: ", numWorkers)
+
+    trialResults = {}
+    for trialId in range(len(trialHyperparamsList)):
+        trialResults[trialId] = {"bestValLoss": float("inf"), "epochs": 0, "rungs": 0}
+    survivors = list(range(len(trialHyperparamsList)))
+    rungEpochs = min(searchConfig["MIN_EPOCHS"], maxEpochs)
+    numThreads = max(1, multiprocessing.cpu_count() // numWorkers)
+    # spawn: TensorFlow is not fork safe
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes=numWorkers, initializer=initializeWorker, initargs=(numThreads,)) as pool:
+        rung = 0
+        while True:
+            print("Rung ", rung, ": training ", len(survivors), " trials up to ", rungEpochs, " epochs")
+            trialArgsList = []
+            for trialId in survivors:
+                trialArgsList.append((tier, configFileName, region, target, trialId, trialHyperparamsList[trialId],
+                                    rungEpochs, trialResults[trialId]["epochs"],
+                                    os.path.join(searchDir, "trial_" + str(trialId))))
+            for trialId, bestValLoss in pool.imap_unordered(runTrial, trialArgsList):
+                trialResults[trialId]["bestValLoss"] = min(trialResults[trialId]["bestValLoss"], bestValLoss)
+                trialResults[trialId]["epochs"] = rungEpochs
+                trialResults[trialId]["rungs"] = rung+1
+            writeLeaderboard(os.path.join(searchDir, "leaderboard.csv"), trialHyperparamsList, trialResults)
+
+            if (len(survivors) <= 1 or rungEpochs >= maxEpochs):
+                break
+            survivors = sorted(survivors, key=lambda trialId: trialResults[trialId]["bestValLoss"])
+            survivors = survivors[:max(1, len(survivors)//reductionFactor)]
+            rungEpochs = min(rungEpochs * reductionFactor, maxEpochs)
+            rung += 1
+
+    ranking = writeLeaderboard(os.path.join(searchDir, "leaderboard.csv"), trialHyperparamsList, trialResults)
+    print("Best hyperparameters (val_loss: ", trialResults[ranking[0]]["bestValLoss"], "):")
+    print(trialHyperparamsList[ranking[0]])
+    return trialHyperparamsList[ranking[0]]
+
+
+if __name__ == "__main__":
+    print("CarbonCast hyperparameter search.")
+    if (len(sys.argv) != 5 or sys.argv[2] not in MODEL_HYPERPARAMS_KEY):
+        print("Usage: python3 hyperparameterSearch.py <configFileName> <-1/-2> <region> <source/-l/-d>")
+        print("-1 -- first tier (source is one of the region's SOURCES, e.g., SOLAR), ")
+        print("-2 -- second tier (-l -- lifecycle, -d -- direct)")
+        print("")
+        exit(0)
+    configFileName = sys.argv[1]
+    tier = sys.argv[2]
+    region = sys.argv[3]
+    target = sys.argv[4]
+    runSearch(configFileName, tier, region, target)
+    print("End")
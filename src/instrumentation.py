@@ -0,0 +1,180 @@
+'''
+Lightweight instrumentation of the CarbonCast pipelines.
+Wall time, CPU time & peak RSS are recorded for every named stage, labelled with the
+(region, source, period) being processed. The peak RSS of a stage is sampled (every RSS_SAMPLE_INTERVAL_S,
+by a background thread) while the stage runs, since the process peak (ru_maxrss) only ever grows & would
+attribute an earlier stage's peak to every later stage. Stages can be nested. Results are written to a
+JSON & a CSV run report. Optionally, a TensorFlow profiler trace is captured around selected
+stages (model fit & walk-forward prediction).
+'''
+
+import csv
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+############################# MACRO START #######################################
+REPORT_FIELDS = ["stage", "region", "source", "period", "wall_time_s", "cpu_time_s",
+                "peak_rss_mb", "peak_rss_growth_mb", "process_peak_rss_mb", "value"]
+PROFILER_TRACE_DIR = None
+RSS_SAMPLE_INTERVAL_S = 0.02
+############################# MACRO END #########################################
+
+STAGE_RECORDS = []
+CURRENT_LABELS = {"region": "", "source": "", "period": ""}
+STAGE_STACK = []
+STAGE_PEAK_RSS = [] # peak RSS sampled so far in each stage of STAGE_STACK
+RSS_LOCK = threading.Lock()
+RSS_SAMPLER = None
+
+
+def getPeakRSS():
+    # ru_maxrss is in KB on Linux & in bytes on macOS. Returned in MB.
+    peakRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if (sys.platform == "darwin"):
+        return peakRSS / (1024 * 1024)
+    return peakRSS / 1024
+
+def getCurrentRSS():
+    # Current RSS in MB, from /proc on Linux. Elsewhere, the process peak RSS is used instead.
+    try:
+        with open("/proc/self/statm", "r") as statmFile:
+            residentPages = int(statmFile.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return getPeakRSS()
+    return residentPages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+def recordRSS(rss):
+    # Updates the peak RSS of all open stages (a nested stage's peak is also its parents')
+    with RSS_LOCK:
+        for i in range(len(STAGE_PEAK_RSS)):
+            STAGE_PEAK_RSS[i] = max(STAGE_PEAK_RSS[i], rss)
+    return
+
+def sampleRSS():
+    while True:
+        time.sleep(RSS_SAMPLE_INTERVAL_S)
+        if (len(STAGE_PEAK_RSS) > 0):
+            recordRSS(getCurrentRSS())
+
+def startRSSSampler():
+    global RSS_SAMPLER
+    if (RSS_SAMPLER is None):
+        RSS_SAMPLER = threading.Thread(target=sampleRSS, daemon=True)
+        RSS_SAMPLER.start()
+    return
+
+def setLabels(region=None, source=None, period=None):
+    # Labels are attached to all stages recorded after this call
+    if (region is not None):
+        CURRENT_LABELS["region"] = region
+    if (source is not None):
+        CURRENT_LABELS["source"] = source
+    if (period is not None):
+        CURRENT_LABELS["period"] = period
+    return
+
+def enableProfiler(traceDir):
+    global PROFILER_TRACE_DIR
+    PROFILER_TRACE_DIR = traceDir
+    print("TensorFlow profiler traces will be written to ", traceDir)
+    return
+
+@contextmanager
+def profilerTrace(name):
+    if (PROFILER_TRACE_DIR is None):
+        yield
+        return
+    import tensorflow as tf
+    traceName = "_".join([label for label in [CURRENT_LABELS["region"], CURRENT_LABELS["source"],
+                            CURRENT_LABELS["period"], name] if label != ""])
+    tf.profiler.experimental.start(os.path.join(PROFILER_TRACE_DIR, traceName))
+    try:
+        yield
+    finally:
+        tf.profiler.experimental.stop()
+
+@contextmanager
+def stage(name, profile=False):
+    # Nested stages are recorded as "parent/child"
+    STAGE_STACK.append(name)
+    stageName = "/".join(STAGE_STACK)
+    startRSSSampler()
+    startRSS = getCurrentRSS()
+    with RSS_LOCK:
+        STAGE_PEAK_RSS.append(startRSS)
+    startCPUTime = time.process_time()
+    startWallTime = time.perf_counter()
+    try:
+        if (profile is True):
+            with profilerTrace(name):
+                yield
+        else:
+            yield
+    finally:
+        wallTime = time.perf_counter() - startWallTime
+        cpuTime = time.process_time() - startCPUTime
+        recordRSS(getCurrentRSS())
+        with RSS_LOCK:
+            peakRSS = STAGE_PEAK_RSS.pop()
+        STAGE_STACK.pop()
+        # peak_rss_growth_mb: peak RSS of the stage above the RSS at its start
+        STAGE_RECORDS.append({"stage": stageName, "region": CURRENT_LABELS["region"],
+                            "source": CURRENT_LABELS["source"], "period": CURRENT_LABELS["period"],
+                            "wall_time_s": round(wallTime, 6), "cpu_time_s": round(cpuTime, 6),
+                            "peak_rss_mb": round(peakRSS, 3), "peak_rss_growth_mb": round(peakRSS - startRSS, 3),
+                            "process_peak_rss_mb": round(getPeakRSS(), 3), "value": ""})
+
+def recordValue(name, value):
+    # For values measured by the pipelines themselves (e.g., avg. time for a 96-hour forecast)
+    STAGE_RECORDS.append({"stage": name, "region": CURRENT_LABELS["region"],
+                        "source": CURRENT_LABELS["source"], "period": CURRENT_LABELS["period"],
+                        "wall_time_s": "", "cpu_time_s": "", "peak_rss_mb": "", "peak_rss_growth_mb": "",
+                        "process_peak_rss_mb": round(getPeakRSS(), 3), "value": value})
+    return
+
+def measureCall(func, *args):
+    # Wall time (s) & peak traced memory (MB, Python & NumPy allocations) of a single call
+    tracemalloc.start()
+    startWallTime = time.perf_counter()
+    try:
+        result = func(*args)
+    finally:
+        wallTime = time.perf_counter() - startWallTime
+        _, peakMemory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, wallTime, peakMemory / (1024 * 1024)
+
+def getSummary():
+    # Total wall & CPU time of each stage across all (region, source, period)
+    summary = {}
+    for record in STAGE_RECORDS:
+        if (record["wall_time_s"] == ""):
+            continue
+        if (record["stage"] not in summary):
+            summary[record["stage"]] = {"count": 0, "wall_time_s": 0, "cpu_time_s": 0, "peak_rss_mb": 0}
+        stageSummary = summary[record["stage"]]
+        stageSummary["count"] += 1
+        stageSummary["wall_time_s"] = round(stageSummary["wall_time_s"] + record["wall_time_s"], 6)
+        stageSummary["cpu_time_s"] = round(stageSummary["cpu_time_s"] + record["cpu_time_s"], 6)
+        stageSummary["peak_rss_mb"] = max(stageSummary["peak_rss_mb"], record["peak_rss_mb"])
+    return summary
+
+def writeRunReport(outFileNamePrefix):
+    # Writes <prefix>.json (all records & a per-stage summary) & <prefix>.csv (all records)
+    print("Writing run report to ", outFileNamePrefix+".json/.csv", "...")
+    os.makedirs(os.path.dirname(outFileNamePrefix) or ".", exist_ok=True)
+    report = {"command": " ".join(sys.argv), "process_peak_rss_mb": round(getPeakRSS(), 3),
+            "summary": getSummary(), "stages": STAGE_RECORDS}
+    with open(outFileNamePrefix+".json", "w") as jsonFile:
+        json.dump(report, jsonFile, indent=4, default=float)
+    with open(outFileNamePrefix+".csv", "w") as csvfile:
+        csvwriter = csv.DictWriter(csvfile, fieldnames=REPORT_FIELDS)
+        csvwriter.writeheader()
+        csvwriter.writerows(STAGE_RECORDS)
+    return
@@ -0,0 +1,85 @@
+'''
+LRU cache of loaded second tier models, for processes that forecast for many (region, CEF type)
+pairs. Models are keyed by (region, CEF type, hash of the model file), so that a model is reloaded
+when its .h5 file changes. At most CAPACITY models are kept in memory; the least recently used
+model is evicted first. Models are loaded lazily on first use, or preloaded.
+'''
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def loadKerasModel(modelFileName):
+    from keras.models import load_model
+    return load_model(modelFileName)
+
+class ModelCache:
+    def __init__(self, capacity, loadFunction=loadKerasModel):
+        if (capacity < 1):
+            raise ValueError("Model cache capacity should be at least 1")
+        self.capacity = capacity
+        self.loadFunction = loadFunction
+        self.models = OrderedDict() # (region, cefType, fileHash) --> model, most recently used last
+        self.fileHashes = {} # model file name --> (mtime, size, fileHash)
+        self.lock = threading.RLock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0,
+                    "loads": 0, "total_load_time_s": 0}
+
+    def getFileHash(self, modelFileName):
+        # The file is only re-hashed if its modification time or size changed
+        fileStat = os.stat(modelFileName)
+        cachedHash = self.fileHashes.get(modelFileName)
+        if (cachedHash is not None and cachedHash[:2] == (fileStat.st_mtime_ns, fileStat.st_size)):
+            return cachedHash[2]
+        sha256 = hashlib.sha256()
+        with open(modelFileName, "rb") as modelFile:
+            for chunk in iter(lambda: modelFile.read(1 << 20), b""):
+                sha256.update(chunk)
+        fileHash = sha256.hexdigest()
+        self.fileHashes[modelFileName] = (fileStat.st_mtime_ns, fileStat.st_size, fileHash)
+        return fileHash
+
+    def get(self, region, cefType, modelFileName):
+        with self.lock:
+            key = (region, cefType, self.getFileHash(modelFileName))
+            if (key in self.models):
+                self.stats["hits"] += 1
+                self.models.move_to_end(key)
+                return self.models[key]
+            self.stats["misses"] += 1
+            # models loaded from an older version of the file are stale
+            for staleKey in [cachedKey for cachedKey in self.models if cachedKey[:2] == key[:2]]:
+                del self.models[staleKey]
+                self.stats["invalidations"] += 1
+            startTime = time.perf_counter()
+            model = self.loadFunction(modelFileName)
+            self.stats["loads"] += 1
+            self.stats["total_load_time_s"] = round(self.stats["total_load_time_s"] +
+                                                    time.perf_counter() - startTime, 6)
+            self.models[key] = model
+            while (len(self.models) > self.capacity):
+                self.models.popitem(last=False)
+                self.stats["evictions"] += 1
+            return model
+
+    def preload(self, modelFiles):
+        # modelFiles: list of (region, cefType, modelFileName). Only the last CAPACITY models stay loaded.
+        for region, cefType, modelFileName in modelFiles:
+            self.get(region, cefType, modelFileName)
+        return
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+        return
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats, size=len(self.models), capacity=self.capacity)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"]/lookups, 4) if lookups > 0 else 0
+        stats["avg_load_time_s"] = round(stats["total_load_time_s"]/stats["loads"], 6) if stats["loads"] > 0 else 0
+        return stats
@@ -0,0 +1,70 @@
+'''
+Registry of trained models. A model is saved together with the scaler (feature min/max values) fitted
+on its training data and the list of features it was trained on, so that it can be reloaded later for
+inference without rebuilding the training dataset.
+
+Layout: <location>/<region>/<source>/<period>/{model.h5, metadata.json}
+'''
+
+import json
+import os
+
+import numpy as np
+from keras.models import load_model
+
+MODEL_FILE_NAME = "model.h5"
+METADATA_FILE_NAME = "metadata.json"
+
+
+def getModelDir(location, region, source, period):
+    return os.path.join(location, region, source.lower(), period)
+
+def isModelSaved(modelDir):
+    return (os.path.exists(os.path.join(modelDir, MODEL_FILE_NAME)) and
+            os.path.exists(os.path.join(modelDir, METADATA_FILE_NAME)))
+
+def toSerializable(value):
+    # numpy scalars/arrays (e.g., ftMin, ftMax) are not json serializable
+    if (value is None):
+        return None
+    if (isinstance(value, (list, tuple, np.ndarray))):
+        return [toSerializable(val) for val in value]
+    if (isinstance(value, np.generic)):
+        return value.item()
+    return value
+
+def writeMetadataFile(metadataFileName, metadata):
+    os.makedirs(os.path.dirname(metadataFileName) or ".", exist_ok=True)
+    serializableMetadata = {}
+    for key, val in metadata.items():
+        serializableMetadata[key] = toSerializable(val)
+    with open(metadataFileName, "w") as metadataFile:
+        json.dump(serializableMetadata, metadataFile, indent=4)
+    return
+
+def readMetadataFile(metadataFileName):
+    with open(metadataFileName, "r") as metadataFile:
+        metadata = json.load(metadataFile)
+    return metadata
+
+def saveMetadata(modelDir, metadata):
+    writeMetadataFile(os.path.join(modelDir, METADATA_FILE_NAME), metadata)
+    return
+
+def loadMetadata(modelDir):
+    return readMetadataFile(os.path.join(modelDir, METADATA_FILE_NAME))
+
+def saveModel(modelDir, model, metadata):
+    print("Saving model & metadata to ", modelDir)
+    os.makedirs(modelDir, exist_ok=True)
+    model.save(os.path.join(modelDir, MODEL_FILE_NAME))
+    saveMetadata(modelDir, metadata)
+    return
+
+def loadModel(modelDir):
+    print("Loading model & metadata from ", modelDir)
+    if (isModelSaved(modelDir) is False):
+        raise FileNotFoundError("No saved model found in " + modelDir)
+    model = load_model(os.path.join(modelDir, MODEL_FILE_NAME))
+    metadata = loadMetadata(modelDir)
+    return model, metadata
@@ -0,0 +1,218 @@
+'''
+Multi-task second tier: one CNN-LSTM with a shared trunk & two output heads forecasts both the
+direct & the lifecycle carbon intensity of a region, from one training run & one model call per step.
+The input has the history of both carbon intensities (direct CI, date/time features, lifecycle CI),
+followed by the weather & source production forecasts. The trunk is the single task architecture
+(createModel) without its output layer. Both FORECAST_MODEs are supported.
+With -c, the two single task models are also trained, & the training time & MAPE of each CI type are
+compared in MULTI_TASK_COMPARISON_FILE. The training time of all models includes building the training &
+validation windows.
+'''
+
+import csv
+import os
+import sys
+import time
+
+import json5 as json
+import numpy as np
+import tensorflow as tf
+from keras.callbacks import EarlyStopping, ModelCheckpoint, ReduceLROnPlateau
+from keras.layers import Dense, Input
+from keras.models import Model, load_model
+
+import common
+import instrumentation
+import secondTierForecasts
+
+CEF_TYPES = {"direct": "-d", "lifecycle": "-l"}
+COMPARISON_FIELDS = ["region", "model", "cef_type", "experiment", "mape", "rmse", "training_time_s",
+                    "avg_time_to_forecast_s"]
+
+
+def createMultiTaskModel(n_timesteps, n_features, n_outputs, hyperParams):
+    singleTaskModel = secondTierForecasts.createModel(n_timesteps, n_features, n_outputs, hyperParams)
+    inputs = Input(shape=(n_timesteps, n_features))
+    trunkOutput = inputs
+    for layer in singleTaskModel.layers[:-1]:
+        trunkOutput = layer(trunkOutput)
+    outputs = [Dense(n_outputs, name=cefTypeName)(trunkOutput) for cefTypeName in CEF_TYPES]
+    return Model(inputs=inputs, outputs=outputs)
+
+def prepareMultiTaskData(secondTierConfig, region):
+    # Direct & lifecycle datasets have the same rows & features, except for the CI column
+    regionData = {}
+    for cefTypeName, cefType in CEF_TYPES.items():
+        regionData[cefTypeName] = secondTierForecasts.prepareRegionData(secondTierConfig, region, cefType)
+    directData, lifecycleData = regionData["direct"], regionData["lifecycle"]
+    if (not np.array_equal(directData["testDates"], lifecycleData["testDates"]) or
+            len(directData["trainData"]) != len(lifecycleData["trainData"])):
+        raise ValueError("Direct & lifecycle datasets of "+region+" do not have the same rows")
+    ciCol = secondTierForecasts.DEPENDENT_VARIABLE_COL
+    multiTaskData = {}
+    for key in ["trainData", "valData", "testData"]:
+        multiTaskData[key] = np.append(np.asarray(directData[key], dtype=np.float64),
+                            np.asarray(lifecycleData[key][:, ciCol:ciCol+1], dtype=np.float64), axis=1)
+    for key in ["wTrainData", "wValData", "wTestData", "testDates"]:
+        multiTaskData[key] = directData[key]
+    return regionData, multiTaskData
+
+def manipulateMultiTaskTrainingDataShape(data, weatherStore):
+    # Same windows as the single task model, with the lifecycle CI (last column) as the second target
+    trainWindowHours = secondTierForecasts.TRAINING_WINDOW_HOURS
+    if (secondTierForecasts.FORECAST_MODE == "multioutput"):
+        X, directY = secondTierForecasts.manipulateMultiOutputTrainingDataShape(data, trainWindowHours, weatherStore)
+    else:
+        X, directY = secondTierForecasts.manipulateTrainingDataShape(data, trainWindowHours, trainWindowHours,
+                                                                    weatherStore)
+    labelWindows = np.lib.stride_tricks.sliding_window_view(data[trainWindowHours:, -1], directY.shape[1])
+    lifecycleY = np.array(labelWindows[:len(X)], dtype=np.float64)
+    return X, [directY, lifecycleY]
+
+def trainMultiTaskModel(X, y, valX, valY, hyperParams, exptNum, region):
+    n_timesteps, n_features, n_outputs = X.shape[1], X.shape[2], y[0].shape[1]
+    print("Timesteps: ", n_timesteps, "No. of features: ", n_features, "No. of outputs: ", n_outputs, " x 2")
+    model = createMultiTaskModel(n_timesteps, n_features, n_outputs, hyperParams)
+    opt = tf.keras.optimizers.Adam(learning_rate = hyperParams["lr"])
+    model.compile(loss={cefTypeName: hyperParams["loss"] for cefTypeName in CEF_TYPES}, optimizer=opt,
+                metrics={cefTypeName: ['mean_absolute_error'] for cefTypeName in CEF_TYPES})
+    os.makedirs(secondTierForecasts.CHECKPOINT_DIR, exist_ok=True)
+    checkpointFileName = os.path.join(secondTierForecasts.CHECKPOINT_DIR,
+                                    region+"_multitask_best_model_iter"+str(exptNum)+".h5")
+    es = EarlyStopping(monitor='val_loss', mode='min', verbose=1, patience=10)
+    mc = ModelCheckpoint(checkpointFileName, monitor='val_loss', mode='min', verbose=1, save_best_only=True)
+    rlr = ReduceLROnPlateau(monitor="val_loss", mode="min", factor=0.1, patience=6, verbose=1,
+                            min_lr=hyperParams["minlr"])
+    with instrumentation.stage("fit", profile=True):
+        model.fit(X, y, epochs=hyperParams["epoch"], batch_size=hyperParams["batchsize"][0], verbose=0,
+                validation_data=(valX, valY), callbacks=[rlr, es, mc])
+    return load_model(checkpointFileName)
+
+def getMultiTaskDayAheadForecasts(model, history, testData, weatherStore):
+    # Recursive mode: both forecasts are fed back into the history every 24 hours.
+    # Multi-output mode: a single model call per day.
+    trainWindowHours = secondTierForecasts.TRAINING_WINDOW_HOURS
+    predictionWindowHours = secondTierForecasts.PREDICTION_WINDOW_HOURS
+    slidingWindowLen = secondTierForecasts.MODEL_SLIDING_WINDOW_LEN
+    ciCol = secondTierForecasts.DEPENDENT_VARIABLE_COL
+    stepHours = 24 if secondTierForecasts.FORECAST_MODE == "recursive" else predictionWindowHours
+    numDays = ((len(testData)//24)-(secondTierForecasts.BUFFER_HOURS//24))
+    predictFunction = secondTierForecasts.getPredictFunction(model)
+    history = np.asarray(history, dtype=np.float64)[-trainWindowHours:]
+    predictions = {cefTypeName: [] for cefTypeName in CEF_TYPES}
+    startTime = time.perf_counter()
+    for i in range(numDays):
+        tempHistory = history
+        currentDayHours = i*slidingWindowLen
+        dayAheadPredictions = {cefTypeName: [] for cefTypeName in CEF_TYPES}
+        for j in range(0, predictionWindowHours, stepHours):
+            weatherWindow = secondTierForecasts.stackWeatherWindows(
+                            np.asarray(weatherStore.getWindow(i, j, j+stepHours)[np.newaxis], dtype=np.float64))
+            input_x = np.append(tempHistory[np.newaxis, -trainWindowHours:], weatherWindow, axis=2)
+            directYhat, lifecycleYhat = [yhat.numpy()[0] for yhat in predictFunction(input_x.astype(np.float32))]
+            dayAheadPredictions["direct"].extend(directYhat)
+            dayAheadPredictions["lifecycle"].extend(lifecycleYhat)
+            # add current predictions to history for predicting the next day
+            latestHistory = np.array(testData[currentDayHours+j:currentDayHours+j+24, :], dtype=np.float64)
+            latestHistory[:, ciCol] = directYhat[:24]
+            latestHistory[:, -1] = lifecycleYhat[:24]
+            tempHistory = np.append(tempHistory, latestHistory, axis=0)[-trainWindowHours:]
+        for cefTypeName in CEF_TYPES:
+            predictions[cefTypeName].append(dayAheadPredictions[cefTypeName])
+        history = np.append(history, testData[currentDayHours:currentDayHours+slidingWindowLen, :],
+                            axis=0)[-trainWindowHours:]
+    avgTimeToForecast = (time.perf_counter()-startTime)/numDays
+    print("Average time taken for a direct & lifecycle forecast = ", avgTimeToForecast)
+    for cefTypeName in CEF_TYPES:
+        predictions[cefTypeName] = np.array(predictions[cefTypeName], dtype=np.float64)
+    return predictions, avgTimeToForecast
+
+def runMultiTaskRegion(secondTierConfig, region, exptNum):
+    print("CarbonCast: multi-task CNN-LSTM model for region:", region)
+    instrumentation.setLabels(region=region, source="multitask", period="expt"+str(exptNum))
+    with instrumentation.stage("prepareData"):
+        regionData, multiTaskData = prepareMultiTaskData(secondTierConfig, region)
+
+    # timed from the same point as the single task models (trainingandValidationPhase), i.e., with the
+    # training & validation windows
+    trainingStartTime = time.perf_counter()
+    with instrumentation.stage("buildTrainingWindows"):
+        X, y = manipulateMultiTaskTrainingDataShape(multiTaskData["trainData"], multiTaskData["wTrainData"])
+        valX, valY = manipulateMultiTaskTrainingDataShape(multiTaskData["valData"], multiTaskData["wValData"])
+    print("X.shape, y.shape: ", X.shape, y[0].shape, y[1].shape)
+    with instrumentation.stage("training"):
+        model = trainMultiTaskModel(X, y, valX, valY, secondTierForecasts.getHyperParams(secondTierConfig),
+                                    exptNum, region)
+    trainingTime = time.perf_counter() - trainingStartTime
+
+    with instrumentation.stage("walkForwardForecast", profile=True):
+        predictions, avgTimeToForecast = getMultiTaskDayAheadForecasts(model,
+                        multiTaskData["valData"][-secondTierForecasts.TRAINING_WINDOW_HOURS:],
+                        multiTaskData["testData"], multiTaskData["wTestData"])
+
+    scores = []
+    for cefTypeName in CEF_TYPES:
+        cefData = regionData[cefTypeName]
+        unscaledTestData, unscaledPredictedData, formattedTestDates, rmseScore, mapeScore, _ = \
+                secondTierForecasts.getUnscaledForecastsAndForecastAccuracy(cefData["testData"],
+                                    cefData["testDates"], predictions[cefTypeName], cefData["ftMin"], cefData["ftMax"])
+        print("[MULTITASK] ", region, cefTypeName, ": RMSE: ", rmseScore, ", MAPE: ", mapeScore)
+        scores.append({"region": region, "model": "multitask", "cef_type": cefTypeName, "experiment": exptNum,
+                    "mape": mapeScore, "rmse": rmseScore, "training_time_s": trainingTime,
+                    "avg_time_to_forecast_s": avgTimeToForecast})
+        if (secondTierConfig["WRITE_CI_FORECASTS_TO_FILE"] == "True"):
+            outFileNamePrefix = secondTierConfig[region][cefTypeName.upper()+"_CEF_OUT_FILE_NAME_PREFIX"]
+            data = [[str(formattedTestDates[i]), str(unscaledTestData[i]), str(unscaledPredictedData[i])]
+                    for i in range(len(unscaledTestData))]
+            with instrumentation.stage("writeForecasts"):
+                common.writeOutFile(outFileNamePrefix+"_multitask_"+str(exptNum)+".csv", data,
+                                    "carbon_intensity", "w")
+    return scores
+
+def runMultiTask(configFileName, compareWithSingleTask):
+    with open(configFileName, "r") as configFile:
+        secondTierConfig = json.load(configFile)
+    secondTierForecasts.initializeMacros(secondTierConfig)
+    rows = []
+    for region in secondTierConfig["REGION"]:
+        for exptNum in range(secondTierConfig["NUMBER_OF_EXPERIMENTS_PER_REGION"]):
+            rows.extend(runMultiTaskRegion(secondTierConfig, region, exptNum))
+            if (compareWithSingleTask is True):
+                for cefType in CEF_TYPES.values():
+                    instrumentation.setLabels(period="expt"+str(exptNum))
+                    for score in secondTierForecasts.runRegion(secondTierConfig, region, cefType, False, [exptNum]):
+                        rows.append(dict([(field, score[field]) for field in COMPARISON_FIELDS if field in score],
+                                        model="single_task"))
+
+    for region in secondTierConfig["REGION"]:
+        for model in ["multitask", "single_task"]:
+            modelRows = [row for row in rows if row["region"] == region and row["model"] == model]
+            if (len(modelRows) == 0):
+                continue
+            # the multi-task model is trained once for both CI types (counted in its direct rows only)
+            trainingTime = np.sum([row["training_time_s"] for row in modelRows
+                                    if model == "single_task" or row["cef_type"] == "direct"])
+            print(region, model, ": total training time: ", round(trainingTime, 3), " s, mean MAPE -- direct: ",
+                np.mean([row["mape"] for row in modelRows if row["cef_type"] == "direct"]), ", lifecycle: ",
+                np.mean([row["mape"] for row in modelRows if row["cef_type"] == "lifecycle"]))
+
+    outFileName = secondTierConfig["MULTI_TASK_COMPARISON_FILE"]
+    print("Writing results to ", outFileName, "...")
+    os.makedirs(os.path.dirname(outFileName) or ".", exist_ok=True)
+    with open(outFileName, "w") as csvfile:
+        csvwriter = csv.DictWriter(csvfile, fieldnames=COMPARISON_FIELDS)
+        csvwriter.writeheader()
+        csvwriter.writerows(rows)
+    instrumentation.writeRunReport(secondTierConfig["RUN_REPORT_FILE_PREFIX"]+"_multitask")
+    return rows
+
+
+if __name__ == "__main__":
+    print("CarbonCast second tier, multi-task (direct & lifecycle) model.")
+    if (len(sys.argv) < 2 or (len(sys.argv) == 3 and sys.argv[2] != "-c") or len(sys.argv) > 3):
+        print("Usage: python3 multiTaskSecondTier.py <configFileName> <-c>")
+        print("-c is optional. If provided, the single task direct & lifecycle models are also trained & compared.")
+        print("")
+        exit(0)
+    runMultiTask(sys.argv[1], len(sys.argv) == 3)
+    print("End")
@@ -0,0 +1,210 @@
+'''
+NumPy-only inference for the saved second tier CNN-LSTM models.
+exportWeights() reads the layer configs & weights of a saved Keras model (.h5) with h5py &
+writes them to a .npz file. loadNumpyModel() & predict() only need NumPy, so forecasting
+workers using the exported models do not need to import TensorFlow.
+Supported layers (the second tier CNN-LSTM stack): Conv1D, MaxPooling1D, Flatten,
+RepeatVector, LSTM, Dropout & Dense.
+'''
+
+import json
+import os
+import sys
+
+import numpy as np
+
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0),
+    "tanh": np.tanh,
+    "sigmoid": lambda x: 1/(1+np.exp(-x)),
+    "hard_sigmoid": lambda x: np.clip(0.2*x+0.5, 0, 1),
+    "elu": lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+    "softplus": lambda x: np.logaddexp(x, 0),
+}
+SUPPORTED_LAYERS = ["InputLayer", "Conv1D", "MaxPooling1D", "Flatten", "RepeatVector",
+                    "LSTM", "Dropout", "Dense"]
+
+
+def decodeAttr(value):
+    if (isinstance(value, bytes)):
+        return value.decode("utf-8")
+    return value
+
+def exportWeights(h5FileName, outFileName):
+    # Layer configs are stored as JSON in the .npz, weights as "<layer index>_<weight index>"
+    import h5py
+    print("Exporting ", h5FileName, " to ", outFileName, "...")
+    with h5py.File(h5FileName, "r") as h5File:
+        modelConfig = json.loads(decodeAttr(h5File.attrs["model_config"]))
+        modelWeights = h5File["model_weights"] if "model_weights" in h5File else h5File
+        layerConfigs = modelConfig["config"]
+        if (isinstance(layerConfigs, dict)):
+            layerConfigs = layerConfigs["layers"]
+        layers, weights = [], {}
+        for layerConfig in layerConfigs:
+            className = layerConfig["class_name"]
+            if (className not in SUPPORTED_LAYERS):
+                raise ValueError("Layer "+className+" is not supported by the NumPy backend")
+            if (className == "InputLayer"):
+                continue
+            layerName = layerConfig["config"]["name"]
+            layerIdx = len(layers)
+            numWeights = 0
+            if (layerName in modelWeights):
+                layerGroup = modelWeights[layerName]
+                for weightIdx, weightName in enumerate(layerGroup.attrs["weight_names"]):
+                    weights[str(layerIdx)+"_"+str(weightIdx)] = np.array(layerGroup[decodeAttr(weightName)])
+                    numWeights += 1
+            layers.append({"class_name": className, "config": layerConfig["config"],
+                        "num_weights": numWeights})
+    os.makedirs(os.path.dirname(outFileName) or ".", exist_ok=True)
+    np.savez(outFileName, layers=np.array(json.dumps(layers)), **weights)
+    return
+
+def loadNumpyModel(npzFileName):
+    with np.load(npzFileName) as npzFile:
+        layers = json.loads(str(npzFile["layers"]))
+        for layerIdx, layer in enumerate(layers):
+            layer["weights"] = [npzFile[str(layerIdx)+"_"+str(weightIdx)].astype(np.float64)
+                                for weightIdx in range(layer["num_weights"])]
+    return layers
+
+def getActivation(name):
+    if (name not in ACTIVATIONS):
+        raise ValueError("Activation "+str(name)+" is not supported by the NumPy backend")
+    return ACTIVATIONS[name]
+
+def getSamePadding(inputLen, windowSize, stride, dilation=1):
+    # Same as TF "SAME" padding: the extra padding (if any) goes to the end
+    outputLen = -(-inputLen // stride)
+    totalPadding = max((outputLen-1)*stride + (windowSize-1)*dilation + 1 - inputLen, 0)
+    return totalPadding//2, totalPadding - totalPadding//2
+
+def conv1D(x, config, weights):
+    kernel, kernelSize = weights[0], weights[0].shape[0]
+    stride, dilation = config["strides"][0], config["dilation_rate"][0]
+    if (config["padding"] == "same"):
+        x = np.pad(x, ((0, 0), getSamePadding(x.shape[1], kernelSize, stride, dilation), (0, 0)))
+    elif (config["padding"] != "valid"):
+        raise ValueError("Conv1D padding "+config["padding"]+" is not supported by the NumPy backend")
+    # windows: (batch, output len, channels, kernel size)
+    windows = np.lib.stride_tricks.sliding_window_view(x, (kernelSize-1)*dilation+1, axis=1)
+    windows = windows[:, ::stride, :, ::dilation]
+    y = np.einsum("btck,kcf->btf", windows, kernel)
+    if (config.get("use_bias", True) is True):
+        y = y + weights[1]
+    return getActivation(config["activation"])(y)
+
+def maxPooling1D(x, config):
+    poolSize, stride = config["pool_size"][0], config["strides"][0]
+    if (config["padding"] == "same"):
+        x = np.pad(x, ((0, 0), getSamePadding(x.shape[1], poolSize, stride), (0, 0)),
+                constant_values=-np.inf)
+    windows = np.lib.stride_tricks.sliding_window_view(x, poolSize, axis=1)[:, ::stride]
+    return windows.max(axis=3)
+
+def lstm(x, config, weights):
+    # Keras gate order: input, forget, cell, output
+    kernel, recurrentKernel = weights[0], weights[1]
+    units = config["units"]
+    bias = weights[2] if config.get("use_bias", True) is True else np.zeros(4*units)
+    activation = getActivation(config["activation"])
+    recurrentActivation = getActivation(config["recurrent_activation"])
+    xProjection = x @ kernel + bias
+    h = np.zeros((x.shape[0], units))
+    c = np.zeros((x.shape[0], units))
+    outputs = []
+    for t in range(x.shape[1]):
+        z = xProjection[:, t] + h @ recurrentKernel
+        i = recurrentActivation(z[:, :units])
+        f = recurrentActivation(z[:, units:2*units])
+        c = f*c + i*activation(z[:, 2*units:3*units])
+        h = recurrentActivation(z[:, 3*units:])*activation(c)
+        outputs.append(h)
+    if (config.get("return_sequences", False) is True):
+        return np.stack(outputs, axis=1)
+    return h
+
+def predict(layers, x):
+    # x: (batch, timesteps, features). Dropout is a no-op at inference time.
+    x = np.asarray(x, dtype=np.float64)
+    for layer in layers:
+        className, config, weights = layer["class_name"], layer["config"], layer["weights"]
+        if (className == "Conv1D"):
+            x = conv1D(x, config, weights)
+        elif (className == "MaxPooling1D"):
+            x = maxPooling1D(x, config)
+        elif (className == "Flatten"):
+            x = x.reshape(x.shape[0], -1)
+        elif (className == "RepeatVector"):
+            x = np.repeat(x[:, np.newaxis, :], config["n"], axis=1)
+        elif (className == "LSTM"):
+            x = lstm(x, config, weights)
+        elif (className == "Dense"):
+            y = x @ weights[0]
+            if (config.get("use_bias", True) is True):
+                y = y + weights[1]
+            x = getActivation(config["activation"])(y)
+    return x
+
+def getPredictFunction(layers):
+    # Same call convention as secondTierForecasts.getPredictFunction
+    class NumpyPrediction:
+        def __init__(self, values):
+            self.values = values
+        def numpy(self):
+            return self.values
+    return lambda x: NumpyPrediction(predict(layers, x).astype(np.float32))
+
+def exportSavedModels(savedModelDir, outDir):
+    # Exports <savedModelDir>/<direct/lifecycle>/<region>.h5 to <outDir>/<direct/lifecycle>/<region>.npz
+    exportedFiles = []
+    for cefTypeDir in ["direct", "lifecycle"]:
+        modelDir = os.path.join(savedModelDir, cefTypeDir)
+        if (not os.path.isdir(modelDir)):
+            continue
+        for fileName in sorted(os.listdir(modelDir)):
+            if (not fileName.endswith(".h5")):
+                continue
+            outFileName = os.path.join(outDir, cefTypeDir, fileName[:-len(".h5")]+".npz")
+            exportWeights(os.path.join(modelDir, fileName), outFileName)
+            exportedFiles.append((os.path.join(modelDir, fileName), outFileName))
+    return exportedFiles
+
+def verifyAgainstKeras(h5FileName, npzFileName, numSamples=64, tolerance=1e-5):
+    # Compares NumPy & Keras outputs on random inputs in the model's input range ([0, 1] after scaling).
+    # The NumPy backend computes in float64, so it is compared with a float64 copy of the Keras model.
+    # The float32 Keras model is only reported: its own rounding error can exceed 1e-5 for some models.
+    from keras.models import load_model, model_from_json
+    kerasModel = load_model(h5FileName, compile=False)
+    modelConfig = json.loads(kerasModel.to_json())
+    for layerConfig in modelConfig["config"]["layers"]:
+        layerConfig["config"]["dtype"] = "float64"
+    kerasModel64 = model_from_json(json.dumps(modelConfig))
+    kerasModel64.set_weights([weights.astype(np.float64) for weights in kerasModel.get_weights()])
+    layers = loadNumpyModel(npzFileName)
+    x = np.random.default_rng(0).random((numSamples,)+tuple(kerasModel.input_shape[1:]))
+    numpyOutput = predict(layers, x)
+    maxAbsDiff = float(np.max(np.abs(kerasModel64.predict(x, verbose=0) - numpyOutput)))
+    maxAbsDiff32 = float(np.max(np.abs(kerasModel.predict(x.astype(np.float32), verbose=0) - numpyOutput)))
+    print(os.path.basename(npzFileName), "max abs. difference from Keras (float64): ", maxAbsDiff,
+            ", (float32): ", maxAbsDiff32)
+    return maxAbsDiff <= tolerance
+
+if __name__ == "__main__":
+    if (len(sys.argv) < 3):
+        print("Usage: python3 numpyModel.py <saved model dir> <export dir> [-v]")
+        print("Exports the direct & lifecycle .h5 models in <saved model dir> to .npz files for NumPy-only inference.")
+        print("-v: verify that the exported models match the Keras outputs (requires TensorFlow)")
+        print("Example: python3 numpyModel.py ../saved_second_tier_models/ ../exported_second_tier_models/ -v")
+        print("")
+        exit(0)
+    exportedFiles = exportSavedModels(sys.argv[1], sys.argv[2])
+    if (len(sys.argv) > 3 and sys.argv[3] == "-v"):
+        mismatches = [npzFileName for h5FileName, npzFileName in exportedFiles
+                        if verifyAgainstKeras(h5FileName, npzFileName) is False]
+        if (len(mismatches) > 0):
+            print("Outputs differ from Keras by more than 1e-5 for: ", mismatches)
+            exit(1)
+        print("All exported models match the Keras outputs.")
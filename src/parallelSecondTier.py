@@ -0,0 +1,124 @@
+'''
+Parallel runner for the second tier.
+Every (region, CEF type, experiment) of the config file is a separate job. Jobs are run in parallel
+worker processes (one TensorFlow runtime each, limited to THREADS_PER_WORKER threads), so that a
+full sweep uses all cores. Each job writes its best model checkpoints & run report to its own
+directory (<JOB_DIR>/<region>_<CEF type>_expt<N>/), so concurrent jobs & concurrent runs with
+different JOB_DIRs never overwrite each other's files. The scores of all jobs are merged into one
+summary file.
+ENSEMBLE_MODE is not used here: every experiment is trained as a separate job.
+'''
+
+import csv
+import multiprocessing
+import os
+import sys
+import traceback
+
+import json5 as json
+import numpy as np
+
+CEF_TYPES = {"-d": "direct", "-l": "lifecycle"}
+SUMMARY_FIELDS = ["region", "cef_type", "experiment", "rmse", "mape", "avg_time_to_forecast_s", "training_time_s"]
+
+
+def getJobs(secondTierConfig, cefTypes):
+    jobDir = secondTierConfig["PARALLEL_RUNNER"]["JOB_DIR"]
+    jobs = []
+    for region in secondTierConfig["REGION"]:
+        for cefType in cefTypes:
+            for exptNum in range(secondTierConfig["NUMBER_OF_EXPERIMENTS_PER_REGION"]):
+                jobs.append((region, cefType, exptNum,
+                            os.path.join(jobDir, region+"_"+CEF_TYPES[cefType]+"_expt"+str(exptNum))))
+    return jobs
+
+def initializeWorker(numThreads):
+    # TensorFlow is only imported in the workers
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(numThreads)
+    tf.config.threading.set_inter_op_parallelism_threads(numThreads)
+    return
+
+def runJob(jobArgs):
+    configFileName, region, cefType, exptNum, jobDir = jobArgs
+    try:
+        import instrumentation
+        import secondTierForecasts
+        with open(configFileName, "r") as configFile:
+            secondTierConfig = json.load(configFile)
+        secondTierConfig["CHECKPOINT_DIR"] = jobDir
+        secondTierForecasts.initializeMacros(secondTierConfig)
+        instrumentation.setLabels(region=region, source=CEF_TYPES[cefType], period="expt"+str(exptNum))
+        scores = secondTierForecasts.runRegion(secondTierConfig, region, cefType, False, [exptNum])
+        instrumentation.writeRunReport(os.path.join(jobDir, "run_report"))
+    except Exception:
+        # one failing job should not stop the rest of the sweep
+        return jobArgs, [], traceback.format_exc()
+    return jobArgs, scores, None
+
+def writeScoreSummary(outFileName, scores):
+    # One row per experiment, followed by the mean & std. dev. over the experiments of each (region, CEF type)
+    print("Writing score summary to ", outFileName, "...")
+    scores = sorted(scores, key=lambda score: (score["region"], score["cef_type"], score["experiment"]))
+    rows = []
+    for key in sorted(set([(score["region"], score["cef_type"]) for score in scores])):
+        keyScores = [score for score in scores if (score["region"], score["cef_type"]) == key]
+        rows.extend(keyScores)
+        for statName, statFunc in [("mean", np.mean), ("std", np.std)]:
+            row = {"region": key[0], "cef_type": key[1], "experiment": statName}
+            for field in SUMMARY_FIELDS[3:]:
+                row[field] = statFunc([score[field] for score in keyScores])
+            rows.append(row)
+        print(key[0], key[1], ": mean RMSE: ", rows[-2]["rmse"], ", mean MAPE: ", rows[-2]["mape"],
+                ", (", len(keyScores), " expts)")
+    os.makedirs(os.path.dirname(outFileName) or ".", exist_ok=True)
+    with open(outFileName, "w") as csvfile:
+        csvwriter = csv.DictWriter(csvfile, fieldnames=SUMMARY_FIELDS)
+        csvwriter.writeheader()
+        csvwriter.writerows(rows)
+    return rows
+
+def runParallel(configFileName, cefTypes):
+    with open(configFileName, "r") as configFile:
+        secondTierConfig = json.load(configFile)
+    runnerConfig = secondTierConfig["PARALLEL_RUNNER"]
+    threadsPerWorker = runnerConfig["THREADS_PER_WORKER"]
+    numWorkers = runnerConfig["NUM_WORKERS"]
+    if (numWorkers <= 0):
+        numWorkers = max(1, multiprocessing.cpu_count() // threadsPerWorker)
+    jobs = getJobs(secondTierConfig, cefTypes)
+    numWorkers = min(numWorkers, len(jobs))
+    print("No. of jobs: ", len(jobs), ", workers: ", numWorkers, ", threads per worker: ", threadsPerWorker)
+
+    scores, failedJobs = [], []
+    # spawn: TensorFlow is not fork safe. A fresh process per job releases the memory of the previous one.
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes=numWorkers, initializer=initializeWorker,
+                    initargs=(threadsPerWorker,), maxtasksperchild=1) as pool:
+        jobArgsList = [(configFileName,)+job for job in jobs]
+        for jobIdx, (jobArgs, jobScores, error) in enumerate(pool.imap_unordered(runJob, jobArgsList)):
+            jobName = jobArgs[1]+" "+CEF_TYPES[jobArgs[2]]+" expt "+str(jobArgs[3])
+            if (error is not None):
+                print("[", jobIdx+1, "/", len(jobs), "] ", jobName, " failed:\n", error)
+                failedJobs.append(jobName)
+                continue
+            print("[", jobIdx+1, "/", len(jobs), "] ", jobName, " done")
+            scores.extend(jobScores)
+
+    writeScoreSummary(runnerConfig["SCORE_SUMMARY_FILE"], scores)
+    if (len(failedJobs) > 0):
+        print("Failed jobs: ", failedJobs)
+    return scores, failedJobs
+
+
+if __name__ == "__main__":
+    print("CarbonCast second tier, parallel runner.")
+    if (len(sys.argv) != 3 or sys.argv[2] not in ["-l", "-d", "-a"]):
+        print("Usage: python3 parallelSecondTier.py <configFileName> <-l (lifecycle)/ -d (direct)/ -a (both)>")
+        print("")
+        exit(0)
+    cefTypes = ["-d", "-l"] if sys.argv[2] == "-a" else [sys.argv[2]]
+    _, failedJobs = runParallel(sys.argv[1], cefTypes)
+    print("End")
+    if (len(failedJobs) > 0):
+        exit(1)
@@ -5,7 +5,10 @@ Multivariate multi-step time series forecasting
 
 import csv
 import math
+import os
 import sys
+import time
+import weakref
 from datetime import datetime as dt
 from datetime import timezone as tz
 
@@ -27,7 +30,13 @@ from keras.layers import RepeatVector
 import json5 as json
 
 import common
+import ensemble
+import historyBuffer
+import instrumentation
+import modelCache
+import modelRegistry
 import utility
+import weatherForecastStore
 
 
 # [DM] Sweden "unknown" carbon emission factor is different. Refer ElectricityMap github for details
@@ -43,16 +52,21 @@ MAX_PREDICTION_WINDOW_HOURS = None
 MODEL_SLIDING_WINDOW_LEN = None
 BUFFER_HOURS = None
 SAVED_MODEL_LOCATION = None
+CEF_TYPE = None
+MODEL_CACHE = None
+CHECKPOINT_DIR = None
+FORECAST_MODE = None
+TOP_N_FEATURES = None
+FEATURE_IMPORTANCE_METHOD = None
+INTEGRATED_GRADIENTS_STEPS = None
 ############################# MACRO END #########################################
 
+# model --> compiled prediction function, so that it is traced only once per model
+PREDICT_FUNCTIONS = weakref.WeakKeyDictionary()
+
 def runSecondTier(configFileName, cefType, loadFromSavedModel):
-    global TRAINING_WINDOW_HOURS
-    global PREDICTION_WINDOW_HOURS
-    global MAX_PREDICTION_WINDOW_HOURS
-    global MODEL_SLIDING_WINDOW_LEN
-    global BUFFER_HOURS
-    global DEPENDENT_VARIABLE_COL
     global SAVED_MODEL_LOCATION
+    global CEF_TYPE
 
     secondTierConfig = {}
 
@@ -60,135 +74,141 @@ def runSecondTier(configFileName, cefType, loadFromSavedModel):
         secondTierConfig = json.load(configFile)
         # print(secondTierConfig)
 
-    numTestDays = secondTierConfig["NUM_TEST_DAYS"]
-    numValDays = secondTierConfig["NUM_VAL_DAYS"]
-    TRAINING_WINDOW_HOURS = secondTierConfig["TRAINING_WINDOW_HOURS"]
-    MODEL_SLIDING_WINDOW_LEN = secondTierConfig["MODEL_SLIDING_WINDOW_LEN"]
-    PREDICTION_WINDOW_HOURS = secondTierConfig["PREDICTION_WINDOW_HOURS"]
-    MAX_PREDICTION_WINDOW_HOURS = secondTierConfig["MAX_PREDICTION_WINDOW_HOURS"]
-    TOP_N_FEATURES = secondTierConfig["TOP_N_FEATURES"]
+    initializeMacros(secondTierConfig)
+    if (secondTierConfig["ENABLE_PROFILER_TRACE"] == "True"):
+        instrumentation.enableProfiler(secondTierConfig["PROFILER_TRACE_DIR"])
     NUMBER_OF_EXPERIMENTS = secondTierConfig["NUMBER_OF_EXPERIMENTS_PER_REGION"]
-    BUFFER_HOURS = PREDICTION_WINDOW_HOURS - 24
 
     regionList = secondTierConfig["REGION"]
+    numReplicas = 1
+    CEF_TYPE = "lifecycle" if cefType == "-l" else "direct"
     if (loadFromSavedModel is True):
+        if (FORECAST_MODE != "recursive"):
+            raise ValueError("The saved second tier models are recursive mode models. Set FORECAST_MODE to " + 
+                            "\"recursive\" to use them (-s).")
         NUMBER_OF_EXPERIMENTS = 1
         if (cefType == "-l"):
             SAVED_MODEL_LOCATION = secondTierConfig["LIFECYCLE_SAVED_MODEL_LOCATION"]
         else:
             SAVED_MODEL_LOCATION = secondTierConfig["DIRECT_SAVED_MODEL_LOCATION"]
-    writeCIForecastsToFile = secondTierConfig["WRITE_CI_FORECASTS_TO_FILE"]
-
+        if (secondTierConfig["MODEL_CACHE"]["PRELOAD"] == "True"):
+            print("Preloading saved models...")
+            MODEL_CACHE.preload([(region, CEF_TYPE, getSavedModelFileName(region)) for region in regionList])
+    elif (secondTierConfig["ENSEMBLE_MODE"] == "True"):
+        # All experiments are trained at once as replicas of a single ensemble model
+        numReplicas = NUMBER_OF_EXPERIMENTS
+        NUMBER_OF_EXPERIMENTS = 1
     for region in regionList:
-        print("CarbonCast: CNN-LSTM model for region:", region)
-        regionConfig = secondTierConfig[region]
-        inFileName = regionConfig["DIRECT_CEF_IN_FILE_NAME"]
-        outFileNamePrefix = regionConfig["DIRECT_CEF_OUT_FILE_NAME_PREFIX"]
-        if (cefType == "-l"):
-            inFileName = regionConfig["LIFECYCLE_CEF_IN_FILE_NAME"]
-            outFileNamePrefix = regionConfig["LIFECYCLE_CEF_OUT_FILE_NAME_PREFIX"]
-        forecastInFileName = regionConfig["FORECAST_IN_FILE_NAME"]
-        numHistoricalAndDateTimeFeatures = regionConfig["NUM_FEATURES"]
-        numForecastFeatures = regionConfig["NUM_FORECAST_FEATURES"]
-        startCol = regionConfig["START_COL"]
-
-        print("Initializing...")
-        dataset, forecastDataset, dateTime = initialize(inFileName, forecastInFileName, startCol)
-        print("***** Initialization done *****")
-
-        # split into train and test
-        print("Spliting dataset into train/test...")
-        # dataset = dataset[:-BUFFER_HOURS]
-        trainData, valData, testData, _ = common.splitDataset(dataset.values, 
-                                                (numTestDays+BUFFER_HOURS//24), numValDays, 
-                                                MAX_PREDICTION_WINDOW_HOURS-PREDICTION_WINDOW_HOURS)
-        trainDates = dateTime[: -((numTestDays+BUFFER_HOURS//24)*24):]
-        trainDates, validationDates = trainDates[: -(numValDays*24)], trainDates[-(numValDays*24):]
-        testDates = dateTime[-((numTestDays+BUFFER_HOURS//24)*24):]
-        trainData = trainData[:, startCol: startCol+numHistoricalAndDateTimeFeatures]
-        valData = valData[:, startCol: startCol+numHistoricalAndDateTimeFeatures]
-        testData = testData[:, startCol: startCol+numHistoricalAndDateTimeFeatures]
-        print("TrainData shape: ", trainData.shape) # days x hour x features
-        print("ValData shape: ", valData.shape) # days x hour x features
-        print("TestData shape: ", testData.shape) # days x hour x features
-
-        wTrainData, wValData, wTestData, wFullTrainData = common.splitWeatherDataset(
-                forecastDataset.values, numTestDays, numValDays, MAX_PREDICTION_WINDOW_HOURS)
-        wTrainData = wTrainData[:, :numForecastFeatures]
-        wValData = wValData[:, :numForecastFeatures]
-        wTestData = wTestData[:, :numForecastFeatures]
-        print("WeatherTrainData shape: ", wTrainData.shape) # (days x hour) x features
-        print("WeatherValData shape: ", wValData.shape) # (days x hour) x features
-        print("WeatherTestData shape: ", wTestData.shape) # (days x hour) x features
-
-        trainData = fillMissingData(trainData)
-        valData = fillMissingData(valData)
-        testData = fillMissingData(testData)
-
-        wTrainData = fillMissingData(wTrainData)
-        wValData = fillMissingData(wValData)
-        wTestData = fillMissingData(wTestData)
-
-        print("***** Dataset split done *****")
-
-        featureList = dataset.columns.values
-        featureList = featureList[startCol:startCol+numHistoricalAndDateTimeFeatures].tolist()
-        featureList.extend(forecastDataset.columns.values[:numForecastFeatures])
-        print("Features: ", featureList)
-
-        print("Scaling data...")
-        # unscaledTestData = np.zeros(testData.shape[0])
-        unscaledTrainCarbonIntensity = np.zeros(trainData.shape[0])
-        # for i in range(testData.shape[0]):
-        #     unscaledTestData[i] = testData[i, DEPENDENT_VARIABLE_COL]
-        for i in range(trainData.shape[0]):
-            unscaledTrainCarbonIntensity[i] = trainData[i, DEPENDENT_VARIABLE_COL]
-        trainData, valData, testData, ftMin, ftMax = common.scaleDataset(trainData, valData, testData)
-        print(trainData.shape, valData.shape, testData.shape)
-        wTrainData, wValData, wTestData, wFtMin, wFtMax = common.scaleDataset(wTrainData, wValData, wTestData)
-        print(wTrainData.shape, wValData.shape, wTestData.shape)
-        print("***** Data scaling done *****")
-
-        ######################## START #####################
-        bestRMSE, bestMAPE = [], []
-        predictedData = None
-        for exptNum in range(NUMBER_OF_EXPERIMENTS):
-            print("Iteration: ", exptNum)
-            regionDailyMape = {}
-            bestModel, numFeaturesInTraining = trainingandValidationPhase(region, trainData, wTrainData, 
-                                            valData, wValData, secondTierConfig, exptNum, loadFromSavedModel)            
-            history = valData[-TRAINING_WINDOW_HOURS:, :]
-            weatherData = None
-            weatherData = wValData[-MAX_PREDICTION_WINDOW_HOURS:, :]
-            print("weatherData shape:", weatherData.shape)
-            history = history.tolist()
-            
-            predictedData = getDayAheadForecasts(bestModel, history, testData, 
+        runRegion(secondTierConfig, region, cefType, loadFromSavedModel, range(NUMBER_OF_EXPERIMENTS), numReplicas)
+
+    if (loadFromSavedModel is True):
+        cacheStats = MODEL_CACHE.getStats()
+        print("Model cache: ", cacheStats)
+        instrumentation.recordValue("modelCacheHitRate", cacheStats["hit_rate"])
+        instrumentation.recordValue("modelCacheAvgLoadTime", cacheStats["avg_load_time_s"])
+    instrumentation.writeRunReport(secondTierConfig["RUN_REPORT_FILE_PREFIX"])
+    return
+
+
+# Runs the given experiments for a region. Returns the scores of each experiment (ensemble replica).
+def runRegion(secondTierConfig, region, cefType, loadFromSavedModel, experiments, numReplicas=1):
+    global CEF_TYPE
+
+    CEF_TYPE = "lifecycle" if cefType == "-l" else "direct"
+    writeCIForecastsToFile = secondTierConfig["WRITE_CI_FORECASTS_TO_FILE"]
+    print("CarbonCast: CNN-LSTM model for region:", region)
+    regionConfig = secondTierConfig[region]
+    outFileNamePrefix = regionConfig["DIRECT_CEF_OUT_FILE_NAME_PREFIX"]
+    if (cefType == "-l"):
+        outFileNamePrefix = regionConfig["LIFECYCLE_CEF_OUT_FILE_NAME_PREFIX"]
+    numForecastFeatures = regionConfig["NUM_FORECAST_FEATURES"]
+    instrumentation.setLabels(region=region, source=CEF_TYPE)
+
+    # With a saved model & its metadata (scaler, features), only the history & test rows are loaded
+    # and no training windows are built
+    metadata = loadSavedModelMetadata(region) if loadFromSavedModel is True else None
+    isFastPath = (metadata is not None)
+    with instrumentation.stage("prepareData"):
+        if (isFastPath is True):
+            regionData = prepareInferenceData(secondTierConfig, region, cefType, metadata)
+        else:
+            regionData = prepareRegionData(secondTierConfig, region, cefType)
+    if (loadFromSavedModel is True and isFastPath is False):
+        print("Saving scaler & feature metadata to ", getSavedMetadataFileName(region))
+        modelRegistry.writeMetadataFile(getSavedMetadataFileName(region), 
+                                        getModelMetadata(region, regionData))
+    if (isFastPath is True and secondTierConfig["REPORT_FAST_PATH_SAVINGS"] == "True"):
+        reportFastPathSavings(secondTierConfig, region, cefType, metadata)
+    valData, testData = regionData["valData"], regionData["testData"]
+    wTestData = regionData["wTestData"]
+    ftMin, ftMax = regionData["ftMin"], regionData["ftMax"]
+    testDates = regionData["testDates"]
+
+    ######################## START #####################
+    bestRMSE, bestMAPE, scores = [], [], []
+    predictedData = None
+    for exptNum in experiments:
+        print("Iteration: ", exptNum)
+        trainingStartTime = time.perf_counter()
+        if (loadFromSavedModel is True):
+            with instrumentation.stage("loadModel"):
+                print("-s parameter specified. Loading model from ", getSavedModelFileName(region))
+                bestModel = MODEL_CACHE.get(region, CEF_TYPE, getSavedModelFileName(region))
+                numFeaturesInTraining = regionData["numFeatures"]
+        else:
+            with instrumentation.stage("training"):
+                bestModel, numFeaturesInTraining = trainingandValidationPhase(region, regionData["trainData"], 
+                                            regionData["wTrainData"], valData, regionData["wValData"], 
+                                            secondTierConfig, exptNum, loadFromSavedModel, numReplicas)
+        trainingTime = time.perf_counter() - trainingStartTime
+        history = valData[-TRAINING_WINDOW_HOURS:, :]
+        history = history.tolist()
+
+        walkForwardStartTime = time.perf_counter()
+        with instrumentation.stage("walkForwardForecast", profile=True):
+            if (FORECAST_MODE == "multioutput"):
+                replicaPredictedData = getMultiOutputDayAheadForecasts(bestModel, numReplicas, history, testData,
+                                TRAINING_WINDOW_HOURS, wTestData)
+                if (numReplicas == 1):
+                    replicaPredictedData = [replicaPredictedData]
+            elif (numReplicas > 1):
+                replicaPredictedData = getEnsembleDayAheadForecasts(bestModel, numReplicas, history, testData, 
                                 TRAINING_WINDOW_HOURS, numFeaturesInTraining, DEPENDENT_VARIABLE_COL,
-                                wFtMin[5:], wFtMax[5:], ftMin[DEPENDENT_VARIABLE_COL], ftMax[DEPENDENT_VARIABLE_COL],
-                                wTestData, weatherData, forecastDataset.columns.values[:numForecastFeatures])
-            print("***** Forecast done *****")
+                                wTestData)
+            else:
+                replicaPredictedData = [getDayAheadForecasts(bestModel, history, testData, 
+                                TRAINING_WINDOW_HOURS, numFeaturesInTraining, DEPENDENT_VARIABLE_COL,
+                                ftMin[DEPENDENT_VARIABLE_COL], ftMax[DEPENDENT_VARIABLE_COL],
+                                wTestData, regionData["forecastFeatures"])]
+        # avg. time for one PREDICTION_WINDOW_HOURS forecast (of all replicas)
+        avgTimeToForecast = (time.perf_counter()-walkForwardStartTime) / len(replicaPredictedData[0])
+        print("***** Forecast done *****")
+
+        if (secondTierConfig["FIND_IMPORTANT_FEATURES"] == "True"):
+            if (FORECAST_MODE != "recursive"):
+                print("Feature importance is only computed for recursive mode models")
+            else:
+                with instrumentation.stage("featureImportance"):
+                    print("**** Important features based on testData:")
+                    featureWindows = getFeatureImportanceWindows(valData, testData, wTestData)
+                    findImportantFeatures(bestModel, featureWindows, regionData["featureList"], testDates)
 
+        for replicaIdx in range(numReplicas):
+            regionDailyMape = {}
+            predictedData = replicaPredictedData[replicaIdx]
             unscaledTestData, unscaledPredictedData, formattedTestDates, rmseScore, mapeScore, dailyMapeScore = getUnscaledForecastsAndForecastAccuracy(
                                                                         testData, testDates, predictedData, 
                                                                         ftMin, ftMax)
             regionDailyMape[region] = dailyMapeScore
 
-            # print("**** Important features based on valData:")
-            # topNFeatures = findImportantFeatures(bestModel, valData, featureList, testDates)
-            # print("**** Important features based on testData:")
-            # modTestData = manipulateTestDataShape(testData, MODEL_SLIDING_WINDOW_LEN, PREDICTION_WINDOW_HOURS, False)
-            # modTestData = np.reshape(modTestData, (modTestData.shape[0]*modTestData.shape[1], modTestData.shape[2]))
-            # print(modTestData.shape, wTestData.shape)
-            # modTestData = np.append(modTestData, wTestData, axis=1)
-            # print("modtestdata shape: ", modTestData.shape)
-            # topNFeatures = findImportantFeatures(bestModel, modTestData, featureList, testDates)
-
             print("[BESTMODEL] Overall RMSE score: ", rmseScore)
             print("[BESTMODEL] Overall MAPE score: ", mapeScore)
             # print(scores)
             bestRMSE.append(rmseScore)
             bestMAPE.append(mapeScore)
+            scores.append({"region": region, "cef_type": CEF_TYPE, "experiment": exptNum+replicaIdx,
+                        "rmse": rmseScore, "mape": mapeScore, "avg_time_to_forecast_s": avgTimeToForecast,
+                        "training_time_s": trainingTime})
             print("Overall Mean MAPE: ", mapeScore)
             print("Daywise statistics...")
             for i in range(0, PREDICTION_WINDOW_HOURS//24):
@@ -198,7 +218,7 @@ def runSecondTier(configFileName, cefType, loadFromSavedModel):
                 print("90th percentile MAPE: ", np.percentile(regionDailyMape[region][:, i], 90))
                 print("95th percentile MAPE: ", np.percentile(regionDailyMape[region][:, i], 95))
                 print("99th percentile MAPE: ", np.percentile(regionDailyMape[region][:, i], 99))
-            
+
             data = []
             for i in range(len(unscaledTestData)):
                 row = []
@@ -207,34 +227,233 @@ def runSecondTier(configFileName, cefType, loadFromSavedModel):
                 row.append(str(unscaledPredictedData[i]))
                 data.append(row)
             if (writeCIForecastsToFile == "True"):
-                common.writeOutFile(outFileNamePrefix+"_"+str(exptNum)+".csv", data, "carbon_intensity", "w")
+                with instrumentation.stage("writeForecasts"):
+                    common.writeOutFile(outFileNamePrefix+"_"+str(exptNum+replicaIdx)+".csv", data, 
+                                        "carbon_intensity", "w")
 
-        print("[BEST] Average RMSE after ", NUMBER_OF_EXPERIMENTS, " expts: ", np.mean(bestRMSE))
-        print("[BEST] Average MAPE after ", NUMBER_OF_EXPERIMENTS, " expts: ", np.mean(bestMAPE))
-        print(bestRMSE)
-        print(bestMAPE)
+        if (numReplicas > 1):
+            _, _, _, rmseScore, mapeScore, _ = getUnscaledForecastsAndForecastAccuracy(
+                            testData, testDates, np.mean(replicaPredictedData, axis=0), ftMin, ftMax)
+            print("[ENSEMBLE] Mean forecast RMSE: ", rmseScore, ", MAPE: ", mapeScore)
 
-        ######################## END #####################
-        
-        print("####################", region, " done ####################\n\n")
+    print("[BEST] Average RMSE after ", len(bestRMSE), " expts: ", np.mean(bestRMSE))
+    print("[BEST] Average MAPE after ", len(bestMAPE), " expts: ", np.mean(bestMAPE))
+    print(bestRMSE)
+    print(bestMAPE)
 
-        
+    ######################## END #####################
+
+    print("####################", region, " done ####################\n\n")
+    return scores
+
+
+def initializeMacros(secondTierConfig):
+    global TRAINING_WINDOW_HOURS
+    global PREDICTION_WINDOW_HOURS
+    global MAX_PREDICTION_WINDOW_HOURS
+    global MODEL_SLIDING_WINDOW_LEN
+    global BUFFER_HOURS
+    global TOP_N_FEATURES
+    global FEATURE_IMPORTANCE_METHOD
+    global INTEGRATED_GRADIENTS_STEPS
+    global MODEL_CACHE
+    global CHECKPOINT_DIR
+    global FORECAST_MODE
+    TRAINING_WINDOW_HOURS = secondTierConfig["TRAINING_WINDOW_HOURS"]
+    MODEL_SLIDING_WINDOW_LEN = secondTierConfig["MODEL_SLIDING_WINDOW_LEN"]
+    PREDICTION_WINDOW_HOURS = secondTierConfig["PREDICTION_WINDOW_HOURS"]
+    MAX_PREDICTION_WINDOW_HOURS = secondTierConfig["MAX_PREDICTION_WINDOW_HOURS"]
+    TOP_N_FEATURES = secondTierConfig["TOP_N_FEATURES"]
+    FEATURE_IMPORTANCE_METHOD = secondTierConfig["FEATURE_IMPORTANCE_METHOD"]
+    INTEGRATED_GRADIENTS_STEPS = secondTierConfig["INTEGRATED_GRADIENTS_STEPS"]
+    BUFFER_HOURS = PREDICTION_WINDOW_HOURS - 24
+    MODEL_CACHE = modelCache.ModelCache(secondTierConfig["MODEL_CACHE"]["CAPACITY"])
+    CHECKPOINT_DIR = secondTierConfig["CHECKPOINT_DIR"]
+    FORECAST_MODE = secondTierConfig["FORECAST_MODE"]
+    if (FORECAST_MODE not in ["recursive", "multioutput"]):
+        raise ValueError("FORECAST_MODE should be recursive or multioutput, not "+str(FORECAST_MODE))
     return
 
+# Loads, splits, fills & scales the dataset of a region
+def prepareRegionData(secondTierConfig, region, cefType):
+    global PREDICTION_WINDOW_HOURS
+    global MAX_PREDICTION_WINDOW_HOURS
+    global BUFFER_HOURS
+    numTestDays = secondTierConfig["NUM_TEST_DAYS"]
+    numValDays = secondTierConfig["NUM_VAL_DAYS"]
+    regionConfig = secondTierConfig[region]
+    inFileName = regionConfig["DIRECT_CEF_IN_FILE_NAME"]
+    if (cefType == "-l"):
+        inFileName = regionConfig["LIFECYCLE_CEF_IN_FILE_NAME"]
+    forecastInFileName = regionConfig["FORECAST_IN_FILE_NAME"]
+    numHistoricalAndDateTimeFeatures = regionConfig["NUM_FEATURES"]
+    numForecastFeatures = regionConfig["NUM_FORECAST_FEATURES"]
+    startCol = regionConfig["START_COL"]
+
+    print("Initializing...")
+    dataset, forecastDataset, dateTime = initialize(inFileName, forecastInFileName, startCol)
+    print("***** Initialization done *****")
+
+    # split into train and test
+    print("Spliting dataset into train/test...")
+    # dataset = dataset[:-BUFFER_HOURS]
+    trainData, valData, testData, _ = common.splitDataset(dataset.values, 
+                                            (numTestDays+BUFFER_HOURS//24), numValDays, 
+                                            MAX_PREDICTION_WINDOW_HOURS-PREDICTION_WINDOW_HOURS)
+    trainDates = dateTime[: -((numTestDays+BUFFER_HOURS//24)*24):]
+    trainDates, validationDates = trainDates[: -(numValDays*24)], trainDates[-(numValDays*24):]
+    testDates = dateTime[-((numTestDays+BUFFER_HOURS//24)*24):]
+    trainData = trainData[:, startCol: startCol+numHistoricalAndDateTimeFeatures]
+    valData = valData[:, startCol: startCol+numHistoricalAndDateTimeFeatures]
+    testData = testData[:, startCol: startCol+numHistoricalAndDateTimeFeatures]
+    print("TrainData shape: ", trainData.shape) # days x hour x features
+    print("ValData shape: ", valData.shape) # days x hour x features
+    print("TestData shape: ", testData.shape) # days x hour x features
+
+    wTrainData, wValData, wTestData, wFullTrainData = common.splitWeatherDataset(
+            forecastDataset.values, numTestDays, numValDays, MAX_PREDICTION_WINDOW_HOURS)
+    wTrainData = wTrainData[:, :numForecastFeatures]
+    wValData = wValData[:, :numForecastFeatures]
+    wTestData = wTestData[:, :numForecastFeatures]
+    print("WeatherTrainData shape: ", wTrainData.shape) # (days x hour) x features
+    print("WeatherValData shape: ", wValData.shape) # (days x hour) x features
+    print("WeatherTestData shape: ", wTestData.shape) # (days x hour) x features
+
+    trainData = fillMissingData(trainData)
+    valData = fillMissingData(valData)
+    testData = fillMissingData(testData)
+
+    wTrainData = fillMissingData(wTrainData)
+    wValData = fillMissingData(wValData)
+    wTestData = fillMissingData(wTestData)
+
+    print("***** Dataset split done *****")
+
+    featureList = dataset.columns.values
+    featureList = featureList[startCol:startCol+numHistoricalAndDateTimeFeatures].tolist()
+    featureList.extend(forecastDataset.columns.values[:numForecastFeatures])
+    print("Features: ", featureList)
+
+    print("Scaling data...")
+    trainData, valData, testData, ftMin, ftMax = common.scaleDataset(trainData, valData, testData)
+    print(trainData.shape, valData.shape, testData.shape)
+    wTrainData, wValData, wTestData, wFtMin, wFtMax = common.scaleDataset(wTrainData, wValData, wTestData)
+    print(wTrainData.shape, wValData.shape, wTestData.shape)
+    # [issue day, MAX_PREDICTION_WINDOW_HOURS, features] forecasts of the training, validation & test issue days
+    weatherStore = weatherForecastStore.WeatherForecastStore(np.vstack((wTrainData, wValData, wTestData)),
+                                        MAX_PREDICTION_WINDOW_HOURS, forecastDataset.index.values)
+    wTrainData, wValData, wTestData = weatherStore.splitIssueDays(numTestDays, numValDays)
+    print("***** Data scaling done *****")
+
+    regionData = {"trainData": trainData, "valData": valData, "testData": testData,
+                "wTrainData": wTrainData, "wValData": wValData, "wTestData": wTestData,
+                "ftMin": ftMin, "ftMax": ftMax, "wFtMin": wFtMin, "wFtMax": wFtMax,
+                "testDates": testDates, "featureList": featureList, "numFeatures": len(featureList),
+                "forecastFeatures": forecastDataset.columns.values[:numForecastFeatures].tolist(),
+                "forecastDataset": forecastDataset}
+    return regionData
+
+# Loads & scales only the rows needed for walk-forward forecasting with a saved model, using the
+# scaler & features saved in its metadata. Same history/test data as prepareRegionData.
+def prepareInferenceData(secondTierConfig, region, cefType, metadata):
+    global TRAINING_WINDOW_HOURS
+    global MAX_PREDICTION_WINDOW_HOURS
+    global BUFFER_HOURS
+    numTestDays = secondTierConfig["NUM_TEST_DAYS"]
+    regionConfig = secondTierConfig[region]
+    inFileName = regionConfig["DIRECT_CEF_IN_FILE_NAME"]
+    if (cefType == "-l"):
+        inFileName = regionConfig["LIFECYCLE_CEF_IN_FILE_NAME"]
+    numHistoricalAndDateTimeFeatures = regionConfig["NUM_FEATURES"]
+    numForecastFeatures = regionConfig["NUM_FORECAST_FEATURES"]
+    startCol = regionConfig["START_COL"]
+    ftMin, ftMax = metadata["ftMin"], metadata["ftMax"]
+    wFtMin, wFtMax = metadata["wFtMin"], metadata["wFtMax"]
+
+    print("Initializing...")
+    numTestRows = (numTestDays+BUFFER_HOURS//24)*24
+    dataset, forecastDataset, dateTime = initialize(inFileName, regionConfig["FORECAST_IN_FILE_NAME"], startCol,
+                            TRAINING_WINDOW_HOURS+numTestRows, (numTestDays+1)*MAX_PREDICTION_WINDOW_HOURS)
+    print("***** Initialization done *****")
+
+    data = dataset.values[:, startCol: startCol+numHistoricalAndDateTimeFeatures]
+    valData = common.scaleWithMinMax(fillMissingData(data[:TRAINING_WINDOW_HOURS]), ftMin, ftMax)
+    testData = common.scaleWithMinMax(fillMissingData(data[TRAINING_WINDOW_HOURS:]), ftMin, ftMax)
+    testDates = dateTime[TRAINING_WINDOW_HOURS:]
+    wData = fillMissingData(forecastDataset.values[:, :numForecastFeatures].astype(np.float64))
+    wData = common.scaleWithMinMax(wData, wFtMin, wFtMax)
+    # the forecasts of the day before the first test day & of the test days
+    wTestData = weatherForecastStore.WeatherForecastStore(wData, MAX_PREDICTION_WINDOW_HOURS, 
+                                        forecastDataset.index.values)
+    print("History shape: ", valData.shape, "TestData shape: ", testData.shape)
+    print("WeatherTestData shape: ", wTestData.data.shape)
+
+    regionData = {"valData": valData, "testData": testData, "wTestData": wTestData,
+                "ftMin": ftMin, "ftMax": ftMax, "wFtMin": wFtMin, "wFtMax": wFtMax,
+                "testDates": testDates, "featureList": metadata["featureList"], 
+                "numFeatures": metadata["numFeatures"], "forecastFeatures": metadata["forecastFeatures"]}
+    return regionData
+
+def getModelMetadata(region, regionData):
+    # modelFileHash: sha256 of the saved model the scaler & features belong to
+    return {"region": region, "cefType": CEF_TYPE, "ftMin": regionData["ftMin"], "ftMax": regionData["ftMax"],
+            "wFtMin": regionData["wFtMin"], "wFtMax": regionData["wFtMax"],
+            "featureList": regionData["featureList"], "numFeatures": regionData["numFeatures"],
+            "forecastFeatures": regionData["forecastFeatures"],
+            "modelFileHash": MODEL_CACHE.getFileHash(getSavedModelFileName(region))}
+
+def loadSavedModelMetadata(region):
+    # Metadata of the saved model of the region, or None if there is none, or if it was saved for another
+    # version of the model file (the full data preparation is run then, & the metadata is saved again)
+    metadataFileName = getSavedMetadataFileName(region)
+    if (os.path.exists(metadataFileName) == False):
+        return None
+    metadata = modelRegistry.readMetadataFile(metadataFileName)
+    if (metadata.get("modelFileHash") != MODEL_CACHE.getFileHash(getSavedModelFileName(region))):
+        print(metadataFileName, " does not match ", getSavedModelFileName(region), ", ignoring it")
+        return None
+    return metadata
+
+def prepareRegionDataWithTrainingWindows(secondTierConfig, region, cefType):
+    # What -s used to do before forecasting: full dataset preparation & training window construction
+    regionData = prepareRegionData(secondTierConfig, region, cefType)
+    manipulateTrainingDataShape(regionData["trainData"], TRAINING_WINDOW_HOURS, TRAINING_WINDOW_HOURS,
+                                regionData["wTrainData"])
+    manipulateTrainingDataShape(regionData["valData"], TRAINING_WINDOW_HOURS, TRAINING_WINDOW_HOURS,
+                                regionData["wValData"])
+    return regionData
+
+def reportFastPathSavings(secondTierConfig, region, cefType, metadata):
+    print("Measuring time & memory saved by the saved model fast path...")
+    _, fastTime, fastMemory = instrumentation.measureCall(prepareInferenceData, secondTierConfig, region, 
+                                                            cefType, metadata)
+    _, fullTime, fullMemory = instrumentation.measureCall(prepareRegionDataWithTrainingWindows, secondTierConfig, 
+                                                            region, cefType)
+    print("[FAST PATH] ", region, ": data preparation time: ", round(fastTime, 3), " s (vs. ", round(fullTime, 3), 
+            " s), peak memory: ", round(fastMemory, 3), " MB (vs. ", round(fullMemory, 3), " MB)")
+    instrumentation.recordValue("fastPathTimeSaved_s", round(fullTime-fastTime, 6))
+    instrumentation.recordValue("fastPathMemorySaved_mb", round(fullMemory-fastMemory, 3))
+    return
 
-def initialize(inFileName, forecastInFileName, startCol):
+# numRows/numForecastRows: if given, only the last rows of the datasets are kept
+def initialize(inFileName, forecastInFileName, startCol, numRows=None, numForecastRows=None):
     print(inFileName)
     # load the new file
-    dataset = pd.read_csv(inFileName, header=0, infer_datetime_format=True, 
+    with instrumentation.stage("readCsv"):
+        dataset = pd.read_csv(inFileName, header=0, infer_datetime_format=True, 
+                            parse_dates=['UTC time'], index_col=['UTC time'])    
+        forecastDataset = pd.read_csv(forecastInFileName, header=0, infer_datetime_format=True, 
                             parse_dates=['UTC time'], index_col=['UTC time'])    
+    if (numRows is not None):
+        dataset = dataset.iloc[-numRows:].copy()
+    if (numForecastRows is not None):
+        forecastDataset = forecastDataset.iloc[-numForecastRows:].copy()
     # dataset = dataset[:8784]
     print(dataset.head())
     print(dataset.columns)
     dateTime = dataset.index.values
 
     print(forecastInFileName)
-    forecastDataset = pd.read_csv(forecastInFileName, header=0, infer_datetime_format=True, 
-                            parse_dates=['UTC time'], index_col=['UTC time'])    
     # dataset = dataset[:8784]
     print(forecastDataset.head())
     print(forecastDataset.columns)
@@ -245,7 +464,8 @@ def initialize(inFileName, forecastInFileName, startCol):
         print(col, dataset[col].dtype)
 
     print("\nAdding features related to date & time...")
-    modifiedDataset = addDateTimeFeatures(dataset, dateTime, startCol)
+    with instrumentation.stage("addDateTimeFeatures"):
+        modifiedDataset = addDateTimeFeatures(dataset, dateTime, startCol)
     dataset = modifiedDataset
     print("Features related to date & time added")
 
@@ -300,13 +520,11 @@ def addDateTimeFeatures(dataset, dateTime, startCol):
     return dataset
 
 # convert history into inputs and outputs
-def manipulateTrainingDataShape(data, trainWindowHours, labelWindowHours, weatherData = None): 
+# weatherStore has one forecast per day of data. A window starting at hour h of a day uses that day's
+# forecast from lead h on.
+def manipulateTrainingDataShape(data, trainWindowHours, labelWindowHours, weatherStore = None): 
     print("Data shape: ", data.shape)
-    global MAX_PREDICTION_WINDOW_HOURS
-    global PREDICTION_WINDOW_HOURS
     X, y, weatherX = list(), list(), list()
-    weatherIdx = 0
-    hourIdx = 0
     # step over the entire history one time step at a time
     for i in range(len(data)-(trainWindowHours+labelWindowHours)+1):
         # define the end of the input sequence
@@ -315,12 +533,7 @@ def manipulateTrainingDataShape(data, trainWindowHours, labelWindowHours, weathe
         xInput = data[i:trainWindow, :]
         # xInput = xInput.reshape((len(xInput), 1))
         X.append(xInput)
-        weatherX.append(weatherData[weatherIdx:weatherIdx+trainWindowHours])
-        weatherIdx +=1
-        hourIdx +=1
-        if(hourIdx ==24):
-            hourIdx = 0
-            weatherIdx += (MAX_PREDICTION_WINDOW_HOURS-24)
+        weatherX.append(weatherStore.getWindow(i//24, i%24, i%24+trainWindowHours))
         y.append(data[trainWindow:labelWindow, DEPENDENT_VARIABLE_COL])
     X = np.array(X, dtype=np.float64)
     y = np.array(y, dtype=np.float64)
@@ -328,6 +541,42 @@ def manipulateTrainingDataShape(data, trainWindowHours, labelWindowHours, weathe
     X = np.append(X, weatherX, axis=2)
     return X, y
 
+# Multi-output mode: the weather/source forecasts for the PREDICTION_WINDOW_HOURS after the history
+# [PREDICTION_WINDOW_HOURS, features] are stacked as [24, (PREDICTION_WINDOW_HOURS//24)*features]. Column
+# block k has the forecasts for hours 24k..24k+23, so that row r of the model input has the history at
+# hour r and the forecasts for hours r, r+24, r+48, ... after the history.
+def stackWeatherWindows(weatherWindows):
+    numWindows, numHours, numFeatures = weatherWindows.shape
+    weatherWindows = weatherWindows.reshape(numWindows, numHours//24, 24, numFeatures).transpose(0, 2, 1, 3)
+    return weatherWindows.reshape(numWindows, 24, (numHours//24)*numFeatures)
+
+# Multi-output mode training windows: trainWindowHours of history --> the next PREDICTION_WINDOW_HOURS.
+# weatherStore has one MAX_PREDICTION_WINDOW_HOURS forecast per day. Like in manipulateTrainingDataShape,
+# a window starting at hour h of a day uses that day's forecast from lead h on. Hours beyond that
+# forecast are taken from the next day's forecast, which is also issued before the end of the history.
+def manipulateMultiOutputTrainingDataShape(data, trainWindowHours, weatherStore):
+    global MAX_PREDICTION_WINDOW_HOURS
+    global PREDICTION_WINDOW_HOURS
+    print("Data shape: ", data.shape)
+    data = np.asarray(data, dtype=np.float64)
+    windowStart = np.arange(len(data)-(trainWindowHours+PREDICTION_WINDOW_HOURS)+1)
+    weatherLeads = (windowStart % 24)[:, np.newaxis] + np.arange(PREDICTION_WINDOW_HOURS)[np.newaxis, :]
+    weatherDays = (windowStart // 24)[:, np.newaxis] + (weatherLeads >= MAX_PREDICTION_WINDOW_HOURS)
+    weatherLeads = np.where(weatherLeads >= MAX_PREDICTION_WINDOW_HOURS, weatherLeads-24, weatherLeads)
+    # windows at the end of the data may not have the next day's forecast
+    isWindowComplete = np.all(weatherDays < len(weatherStore), axis=1)
+    windowStart = windowStart[isWindowComplete]
+    weatherDays, weatherLeads = weatherDays[isWindowComplete], weatherLeads[isWindowComplete]
+
+    historyWindows = np.lib.stride_tricks.sliding_window_view(data, trainWindowHours, axis=0)
+    X = historyWindows[windowStart].transpose(0, 2, 1)
+    labelWindows = np.lib.stride_tricks.sliding_window_view(data[trainWindowHours:, DEPENDENT_VARIABLE_COL], 
+                                                            PREDICTION_WINDOW_HOURS)
+    y = np.array(labelWindows[windowStart], dtype=np.float64)
+    weatherWindows = np.asarray(weatherStore.getWindows(weatherDays, weatherLeads), dtype=np.float64)
+    X = np.append(X, stackWeatherWindows(weatherWindows), axis=2)
+    return X, y
+
 def manipulateTestDataShape(data, slidingWindowLen, predictionWindowHours, isDates=False): 
     X = list()
     # step over the entire history one time step at a time
@@ -341,9 +590,20 @@ def manipulateTestDataShape(data, slidingWindowLen, predictionWindowHours, isDat
         X = np.array(X)
     return X
 
-# train the model
-def trainModel(trainX, trainY, valX, valY, hyperParams, iteration, region, loadFromSavedModel):
+def getSavedModelFileName(region):
+    global SAVED_MODEL_LOCATION
+    return SAVED_MODEL_LOCATION+"/"+region+".h5"
+
+def getSavedMetadataFileName(region):
     global SAVED_MODEL_LOCATION
+    return SAVED_MODEL_LOCATION+"/"+region+"_metadata.json"
+
+# train the model
+def trainModel(trainX, trainY, valX, valY, hyperParams, iteration, region, loadFromSavedModel, numReplicas=1):
+    global CEF_TYPE
+    global MODEL_CACHE
+    global CHECKPOINT_DIR
+    global FORECAST_MODE
 
     # define parameters
     print("Training...")
@@ -354,16 +614,63 @@ def trainModel(trainX, trainY, valX, valY, hyperParams, iteration, region, loadF
     print("Timesteps: ", n_timesteps, "No. of features: ", n_features, "No. of outputs: ", n_outputs)
 
     if (loadFromSavedModel is True):
-        print("-s parameter specified. Loading model from ", SAVED_MODEL_LOCATION+region+".h5")
-        bestModel = load_model(SAVED_MODEL_LOCATION+"/"+region+".h5")
+        print("-s parameter specified. Loading model from ", getSavedModelFileName(region))
+        bestModel = MODEL_CACHE.get(region, CEF_TYPE, getSavedModelFileName(region))
         return bestModel, n_features
 
     epochs = hyperParams["epoch"]    
     batchSize = hyperParams["batchsize"]
-    activationFunc = hyperParams["actv"]
     lossFunc = hyperParams["loss"]
     learningRate = hyperParams["lr"]
     minLearningRate = hyperParams["minlr"]
+
+    if (numReplicas > 1):
+        # ensemble mode: numReplicas independently initialized models trained together
+        model = ensemble.createEnsembleModel(
+                lambda: createModel(n_timesteps, n_features, n_outputs, hyperParams),
+                numReplicas, (n_timesteps, n_features))
+        trainY = ensemble.tileTargets(trainY, numReplicas)
+        valY = ensemble.tileTargets(valY, numReplicas)
+    else:
+        model = createModel(n_timesteps, n_features, n_outputs, hyperParams)
+
+    opt = tf.keras.optimizers.Adam(learning_rate = learningRate)
+    rlr = ReduceLROnPlateau(monitor="val_loss", mode="min", factor=0.1, patience=6, verbose=1, min_lr=minLearningRate)
+    if (numReplicas > 1):
+        # early stopping & best weights per replica, on each replica's own validation loss (the replicas share
+        # the optimizer, so the learning rate is still reduced on the total validation loss)
+        model.compile(loss=lossFunc, optimizer=opt,
+                        metrics=['mean_absolute_error']+ensemble.getReplicaLossMetrics(lossFunc, numReplicas))
+        callbacks = [rlr, ensemble.ReplicaEarlyStopping(numReplicas, patience=10)]
+    else:
+        model.compile(loss=lossFunc, optimizer=opt, metrics=['mean_absolute_error'])
+        # simple early stopping
+        es = EarlyStopping(monitor='val_loss', mode='min', verbose=1, patience=10)
+        os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+        checkpointFileName = os.path.join(CHECKPOINT_DIR, region+"_best_model_iter"+str(iteration)+".h5")
+        if (FORECAST_MODE == "multioutput"):
+            checkpointFileName = os.path.join(CHECKPOINT_DIR, region+"_multioutput_best_model_iter"+str(iteration)+".h5")
+        mc = ModelCheckpoint(checkpointFileName, monitor='val_loss', mode='min', verbose=1, save_best_only=True)
+        callbacks = [rlr, es, mc]
+
+# fit network
+    with instrumentation.stage("fit", profile=True):
+        hist = model.fit(trainX, trainY, epochs=epochs, batch_size=batchSize[0], verbose=verbose,
+                        validation_data=(valX, valY), callbacks=callbacks)
+
+    if (numReplicas > 1):
+        bestModel = model # best weights of each replica restored by ReplicaEarlyStopping
+    else:
+        bestModel = load_model(checkpointFileName)
+# showModelSummary(hist, model)
+# print("Loss history: ", hist.history)
+    # showModelSummary(hist, bestModel, "CNN")
+    # print("Training the best model...")
+    # hist = bestModel.fit(trainX, trainY, epochs=100, batch_size=trainParameters['batchsize'], verbose=verbose)
+    return bestModel, n_features
+
+def createModel(n_timesteps, n_features, n_outputs, hyperParams):
+    activationFunc = hyperParams["actv"]
     kernel1Size = hyperParams["kernel1"]
     kernel2Size = hyperParams["kernel2"]
     numFilters1 = hyperParams["filter1"]
@@ -385,25 +692,7 @@ def trainModel(trainX, trainY, valX, valY, hyperParams, iteration, region, loadF
     model.add(Dropout(dropoutRate))
     model.add(Dense(n_outputs))
 ################################################################################
-
-    opt = tf.keras.optimizers.Adam(learning_rate = learningRate)
-    model.compile(loss=lossFunc, optimizer=opt, metrics=['mean_absolute_error'])
-    # simple early stopping
-    es = EarlyStopping(monitor='val_loss', mode='min', verbose=1, patience=10)
-    mc = ModelCheckpoint(region+"_best_model_iter"+str(iteration)+".h5", monitor='val_loss', mode='min', verbose=1, save_best_only=True)
-    rlr = ReduceLROnPlateau(monitor="val_loss", mode="min", factor=0.1, patience=6, verbose=1, min_lr=minLearningRate)
-
-# fit network
-    hist = model.fit(trainX, trainY, epochs=epochs, batch_size=batchSize[0], verbose=verbose,
-                        validation_data=(valX, valY), callbacks=[rlr, es, mc])
-
-    bestModel = load_model(region+"_best_model_iter"+str(iteration)+".h5")
-# showModelSummary(hist, model)
-# print("Loss history: ", hist.history)
-    # showModelSummary(hist, bestModel, "CNN")
-    # print("Training the best model...")
-    # hist = bestModel.fit(trainX, trainY, epochs=100, batch_size=trainParameters['batchsize'], verbose=verbose)
-    return bestModel, n_features
+    return model
 
 def showModelSummary(history, model, architecture=None):
     print("Showing model summary...")
@@ -415,19 +704,22 @@ def showModelSummary(history, model, architecture=None):
 
 def getDayAheadForecasts(model, history, testData, 
                             trainWindowHours, numFeatures, depVarColumn,
-                            wFtMin, wFtMax, ciMin, ciMax,
-                            wTestData = None, weatherData = None,
+                            ciMin, ciMax,
+                            weatherStore = None,
                             forecastColumns=None):
     global MODEL_SLIDING_WINDOW_LEN
     global PREDICTION_WINDOW_HOURS
     global MAX_PREDICTION_WINDOW_HOURS
     global BUFFER_HOURS
     # walk-forward validation over each day
+    # weatherStore: issue day i is the forecast for test day i
     print("Testing (day ahead forecasts)...")
     # print(ciMin, ciMax)
     predictions = list()
-    weatherIdx = 0
     avgTimeToForecast = 0
+    # only the last trainWindowHours rows of the history are kept
+    history = historyBuffer.HistoryBuffer(history, trainWindowHours)
+    predictFunction = getPredictFunction(model)
     for i in range(0, ((len(testData)//24)-(BUFFER_HOURS//24))):
         beforeForecast = dt.now()
         dayAheadPredictions = list()
@@ -437,20 +729,17 @@ def getDayAheadForecasts(model, history, testData,
         for j in range(0, MAX_PREDICTION_WINDOW_HOURS, 24):
             if (j >= PREDICTION_WINDOW_HOURS):
                 continue
-            yhat_sequence, _ = getForecasts(model, tempHistory, 
-                            trainWindowHours, numFeatures, weatherData[j:j+24])
+            yhat_sequence, _ = getForecasts(predictFunction, tempHistory.getWindow(), 
+                            trainWindowHours, numFeatures, weatherStore.getWindow(i, j, j+24))
             dayAheadPredictions.extend(yhat_sequence)
             # add current prediction to history for predicting the next day
-            latestHistory = testData[currentDayHours+j:currentDayHours+j+24, :].tolist()
-            for k in range(24):
-                latestHistory[k][depVarColumn] = yhat_sequence[k]
+            latestHistory = np.array(testData[currentDayHours+j:currentDayHours+j+24, :], dtype=np.float64)
+            latestHistory[:, depVarColumn] = yhat_sequence[:24]
             tempHistory.extend(latestHistory)
         # get real observation and add to history for predicting the next day
         
-        history.extend(testData[currentDayHours:currentDayHours+MODEL_SLIDING_WINDOW_LEN, :].tolist())
+        history.extend(testData[currentDayHours:currentDayHours+MODEL_SLIDING_WINDOW_LEN, :])
         predictions.append(dayAheadPredictions)
-        weatherData = wTestData[weatherIdx:weatherIdx+MAX_PREDICTION_WINDOW_HOURS, :]
-        weatherIdx += MAX_PREDICTION_WINDOW_HOURS
         afterForecast = dt.now()
         timeTakenToForecast = (afterForecast - beforeForecast).total_seconds()
         # print("Day: ", i, ", time to forecast = ", timeTakenToForecast)
@@ -458,66 +747,181 @@ def getDayAheadForecasts(model, history, testData,
 
     avgTimeToForecast /= ((len(testData)//24)-(BUFFER_HOURS//24))
     print("Average time taken for a 96-hour forecast = ", avgTimeToForecast)
+    instrumentation.recordValue("avgTimeToForecast", avgTimeToForecast)
 
     # evaluate predictions days for each day
     predictedData = np.array(predictions, dtype=np.float64)
     return predictedData
 
-def getForecasts(model, history, trainWindowHours, numFeatures, weatherData):
-    # flatten data
-    data = np.array(history, dtype=np.float64)
+# Multi-output mode walk-forward validation: one model call per day for all PREDICTION_WINDOW_HOURS,
+# without feeding predictions back into the history. Returns [days, PREDICTION_WINDOW_HOURS], or
+# [numReplicas, days, PREDICTION_WINDOW_HOURS] for an ensemble.
+def getMultiOutputDayAheadForecasts(model, numReplicas, history, testData, trainWindowHours, 
+                                    weatherStore):
+    global MODEL_SLIDING_WINDOW_LEN
+    global PREDICTION_WINDOW_HOURS
+    global BUFFER_HOURS
+    print("Testing (day ahead forecasts, multi-output)...")
+    predictions = list()
+    avgTimeToForecast = 0
+    numDays = ((len(testData)//24)-(BUFFER_HOURS//24))
+    history = historyBuffer.HistoryBuffer(history, trainWindowHours)
+    predictFunction = getPredictFunction(model)
+    for i in range(numDays):
+        beforeForecast = dt.now()
+        weatherWindow = stackWeatherWindows(np.asarray(weatherStore.getWindow(i, 0, PREDICTION_WINDOW_HOURS)[np.newaxis],
+                                                        dtype=np.float64))
+        input_x = np.append(history.getWindow()[np.newaxis], weatherWindow, axis=2)
+        predictions.append(predictFunction(input_x.astype(np.float32)).numpy()[0])
+        currentDayHours = i* MODEL_SLIDING_WINDOW_LEN
+        history.extend(testData[currentDayHours:currentDayHours+MODEL_SLIDING_WINDOW_LEN, :])
+        avgTimeToForecast += (dt.now() - beforeForecast).total_seconds()
+
+    avgTimeToForecast /= numDays
+    print("Average time taken for a 96-hour forecast = ", avgTimeToForecast)
+    instrumentation.recordValue("avgTimeToForecast", avgTimeToForecast)
+    predictedData = np.array(predictions, dtype=np.float64)
+    if (numReplicas > 1):
+        predictedData = predictedData.transpose(1, 0, 2)
+    return predictedData
+
+# walk-forward validation of all replicas of an ensemble model. Each replica feeds its own predictions
+# back into its history, and all replicas are run in a single predict call per step.
+def getEnsembleDayAheadForecasts(model, numReplicas, history, testData, 
+                            trainWindowHours, numFeatures, depVarColumn,
+                            weatherStore):
+    global MODEL_SLIDING_WINDOW_LEN
+    global PREDICTION_WINDOW_HOURS
+    global BUFFER_HOURS
+    print("Testing (day ahead forecasts, ensemble of ", numReplicas, " replicas)...")
+    predictions = list()
+    history = np.array(history, dtype=np.float64)[-trainWindowHours:]
+    for i in range(0, ((len(testData)//24)-(BUFFER_HOURS//24))):
+        dayAheadPredictions = list()
+        # [numReplicas, trainWindowHours, features]
+        tempHistory = np.repeat(history[np.newaxis, :, :], numReplicas, axis=0)
+        currentDayHours = i* MODEL_SLIDING_WINDOW_LEN
+        for j in range(0, PREDICTION_WINDOW_HOURS, 24):
+            replicaWeatherData = np.repeat(weatherStore.getWindow(i, j, j+24)[np.newaxis], numReplicas, axis=0)
+            input_x = np.append(tempHistory[:, -trainWindowHours:, :], replicaWeatherData, axis=2)
+            input_x = input_x.reshape((numReplicas, trainWindowHours, numFeatures))
+            yhat_sequence = ensemble.predictReplicas(model, input_x) # [numReplicas, 24]
+            dayAheadPredictions.append(yhat_sequence)
+            # add current prediction to history for predicting the next day
+            latestHistory = np.repeat(testData[np.newaxis, currentDayHours+j:currentDayHours+j+24, :], 
+                                numReplicas, axis=0)
+            latestHistory[:, :, depVarColumn] = yhat_sequence[:, :24]
+            tempHistory = np.append(tempHistory, latestHistory, axis=1)[:, -trainWindowHours:, :]
+        # get real observation and add to history for predicting the next day
+        history = np.append(history, testData[currentDayHours:currentDayHours+MODEL_SLIDING_WINDOW_LEN, :], 
+                            axis=0)[-trainWindowHours:]
+        predictions.append(np.concatenate(dayAheadPredictions, axis=1))
+
+    # [numReplicas, days, PREDICTION_WINDOW_HOURS]
+    predictedData = np.array(predictions, dtype=np.float64).transpose(1, 0, 2)
+    return predictedData
+
+# Calls the model directly (in a compiled graph) instead of model.predict(), which has a
+# large per-call overhead when forecasting one sample at a time.
+def getPredictFunction(model):
+    if (model not in PREDICT_FUNCTIONS):
+        inputSpec = tf.TensorSpec(shape=(None,)+tuple(model.input_shape[1:]), dtype=tf.float32)
+        # weak reference, so that the cached function does not keep the model alive
+        modelRef = weakref.ref(model)
+        PREDICT_FUNCTIONS[model] = tf.function(lambda x: modelRef()(x, training=False), 
+                                            input_signature=[inputSpec])
+    return PREDICT_FUNCTIONS[model]
+
+def getForecasts(predictFunction, historyWindow, trainWindowHours, numFeatures, weatherData):
     # retrieve last observations for input data
-    input_x = data[-trainWindowHours:]
+    input_x = historyWindow[-trainWindowHours:]
     input_x = np.append(input_x, weatherData, axis=1)
     # reshape into [1, n_input, num_features]
     input_x = input_x.reshape((1, len(input_x), numFeatures))
     # print("ip_x shape: ", input_x.shape)
-    yhat = model.predict(input_x, verbose=0)
+    yhat = predictFunction(input_x.astype(np.float32)).numpy()
     # we only want the vector forecast
     yhat = yhat[0]
     return yhat, input_x
 
-def featureImportance(seq, model, features, testDates):
-    # print(seq.shape)
-    id_=1
-    seq = tf.Variable(seq[np.newaxis,:,:], dtype=tf.float32)
+# Gradients of the forecasts w.r.t. the inputs, for a batch of windows [windows, hours, features]
+# in a single forward & backward pass. Returns [windows, features] (averaged over hours).
+def featureImportance(windows, model):
+    windows = tf.convert_to_tensor(windows, dtype=tf.float32)
     with tf.GradientTape() as tape:
-        predictions = model(seq)
-    grads = tape.gradient(predictions, seq)
-    grads = tf.reduce_mean(grads, axis=1).numpy()[0]
+        tape.watch(windows)
+        predictions = model(windows, training=False)
+    grads = tape.gradient(predictions, windows)
+    grads = tf.reduce_mean(grads, axis=1).numpy()
     return grads
 
+# Integrated gradients (w.r.t. an all zero baseline) for a batch of windows. All interpolation
+# steps of all windows are run as one batch. Returns [windows, features] (averaged over hours).
+def integratedGradients(windows, model, numSteps):
+    windows = tf.convert_to_tensor(windows, dtype=tf.float32)
+    alphas = tf.reshape(tf.linspace(1.0/numSteps, 1.0, numSteps), (numSteps, 1, 1, 1))
+    # [steps*windows, hours, features]
+    interpolatedWindows = tf.reshape(alphas * windows[tf.newaxis], (-1, windows.shape[1], windows.shape[2]))
+    with tf.GradientTape() as tape:
+        tape.watch(interpolatedWindows)
+        predictions = model(interpolatedWindows, training=False)
+    grads = tape.gradient(predictions, interpolatedWindows)
+    grads = tf.reshape(grads, (numSteps, -1, windows.shape[1], windows.shape[2]))
+    attributions = windows * tf.reduce_mean(grads, axis=0)
+    attributions = tf.reduce_mean(attributions, axis=1).numpy()
+    return attributions
+
+# Model inputs (history & weather forecast features) of every prediction day of every test day, as rows of
+# MODEL_SLIDING_WINDOW_LEN hours: window i is prediction day (i % numPredictionDays) of test day
+# (i // numPredictionDays). The history holds the actual values (not the forecasts fed back by the recursive
+# forecaster), & issue day d of wTestData is the forecast for test day d.
+def getFeatureImportanceWindows(valData, testData, wTestData):
+    global TRAINING_WINDOW_HOURS
+    global PREDICTION_WINDOW_HOURS
+    global BUFFER_HOURS
+    numPredictionDays = PREDICTION_WINDOW_HOURS//24
+    numDays = min((len(testData)//24)-(BUFFER_HOURS//24), len(wTestData))
+    valAndTestData = np.vstack((valData[-TRAINING_WINDOW_HOURS:], testData))
+    # [test days, prediction days]
+    windowStart = (np.arange(numDays)[:, np.newaxis] + np.arange(numPredictionDays)[np.newaxis, :])*24
+    historyWindows = valAndTestData[windowStart[:, :, np.newaxis] + np.arange(TRAINING_WINDOW_HOURS)]
+    weatherWindows = wTestData.getWindows(np.arange(numDays)[:, np.newaxis, np.newaxis],
+                    (np.arange(numPredictionDays)*24)[np.newaxis, :, np.newaxis] + np.arange(TRAINING_WINDOW_HOURS))
+    windows = np.append(historyWindows, weatherWindows, axis=3)
+    return windows.reshape((-1, windows.shape[3]))
+
+# Returns the feature importances ([prediction days, features]) & the top TOP_N_FEATURES features (by
+# absolute importance) of each prediction day ([{feature: importance}]).
 def findImportantFeatures(model, valData, featureList, testDates):
     # print(model.summary())
     # print(valData.shape)
     global TOP_N_FEATURES
     global PREDICTION_WINDOW_HOURS
     global MODEL_SLIDING_WINDOW_LEN
-    topNFeatures = {}
-    featureImp = {}
+    global FEATURE_IMPORTANCE_METHOD
+    global INTEGRATED_GRADIENTS_STEPS
+    featureImportances, dailyTopNFeatures = [], []
     valDataReshaped = np.reshape(valData, (valData.shape[0]//MODEL_SLIDING_WINDOW_LEN, MODEL_SLIDING_WINDOW_LEN, valData.shape[1]))
     print(valDataReshaped.shape)
 
-    # dailydata = np.zeros((PREDICTION_WINDOW_HOURS//24, valDataReshaped.shape[0], valDataReshaped.shape[1], valDataReshaped.shape[2]))
-    dailydata = [[] for _ in range(PREDICTION_WINDOW_HOURS//24)]
-    # print(dailydata.shape)
-    for i in range(0, valDataReshaped.shape[0], PREDICTION_WINDOW_HOURS//24):
-        for j in range(PREDICTION_WINDOW_HOURS//24):
-            # print(j, ": ", i+j)
-            dailydata[j].append(valDataReshaped[i+j])
-
-    dailydata = np.array(dailydata)
+    # [prediction day, windows, hours, features]: window i of prediction day j is day (i*numPredictionDays + j)
+    numPredictionDays = PREDICTION_WINDOW_HOURS//24
+    numWindows = valDataReshaped.shape[0]//numPredictionDays
+    dailydata = valDataReshaped[:numWindows*numPredictionDays].reshape(
+                    (numWindows, numPredictionDays, valDataReshaped.shape[1], valDataReshaped.shape[2]))
+    dailydata = dailydata.transpose((1, 0, 2, 3))
     print(dailydata.shape)
 
-    for day in range(PREDICTION_WINDOW_HOURS//24):
+    for day in range(numPredictionDays):
         topNFeatures = {}
         featureImp = {}
 
-        grads = [None] * len(dailydata[day])
-        for i in range(len(dailydata[day])):
-            grads[i] = featureImportance(dailydata[day][i], model, featureList, testDates)
-        gradAvg = np.array(grads)
-        gradAvg = np.mean(gradAvg, axis=0)
+        if (FEATURE_IMPORTANCE_METHOD == "integrated_gradients"):
+            grads = integratedGradients(dailydata[day], model, INTEGRATED_GRADIENTS_STEPS)
+        else:
+            grads = featureImportance(dailydata[day], model)
+        gradAvg = np.mean(grads, axis=0)
+        featureImportances.append(gradAvg)
         # print(gradAvg, np.sum(gradAvg))
 
         for i in range(len(gradAvg)):
@@ -544,6 +948,7 @@ def findImportantFeatures(model, valData, featureList, testDates):
         print("Day ", day+1, ": Top ", TOP_N_FEATURES, " features:")
         for key, val in topNFeatures.items():
             print(key, ": ", val)
+        dailyTopNFeatures.append(topNFeatures)
     
     xLabel = ["carbon_intensity", "hour_sin", "hour_cos", "month_sin", "month_cos", "weekend",
             "coal", "nat_gas", "nuclear", "hydro",
@@ -563,7 +968,7 @@ def findImportantFeatures(model, valData, featureList, testDates):
     # # plt.xlabel('Features', fontsize=22)
     # plt.show() 
     # plt.title("Feature importance - " + region)
-    return topNFeatures
+    return np.array(featureImportances), dailyTopNFeatures
 
 def getScores(scaledActual, scaledPredicted, unscaledActual, unscaledPredicted, dates):
     global PREDICTION_WINDOW_HOURS
@@ -608,20 +1013,22 @@ def getScores(scaledActual, scaledPredicted, unscaledActual, unscaledPredicted,
 def getHyperParams(secondTierConfig):
     hyperParams = {}
     modelHyperparamsFromConfigFile = secondTierConfig["SECOND_TIER_CNN_LSTM_MODEL_HYPERPARAMS"]
-    hyperParams["epoch"] = modelHyperparamsFromConfigFile["EPOCH"]
-    hyperParams["batchsize"] = modelHyperparamsFromConfigFile["BATCH_SIZE"]
-    hyperParams["actv"] = modelHyperparamsFromConfigFile["ACTIVATION_FUNC"]
-    hyperParams["loss"] = modelHyperparamsFromConfigFile["LOSS_FUNC"]
-    hyperParams["lr"] = modelHyperparamsFromConfigFile["LEARNING_RATE"]
-    hyperParams["minlr"] = modelHyperparamsFromConfigFile["MIN_LEARNING_RATE"]
-
-    hyperParams["kernel1"] = modelHyperparamsFromConfigFile["CNN_KERNEL1"] # 4
-    hyperParams["kernel2"] = modelHyperparamsFromConfigFile["CNN_KERNEL2"] # 4
-    hyperParams["filter1"] = modelHyperparamsFromConfigFile["CNN_NUM_FILTERS1"] # 4
-    hyperParams["filter2"] = modelHyperparamsFromConfigFile["CNN_NUM_FILTERS2"] # 16
-    hyperParams["poolsize"] = modelHyperparamsFromConfigFile["CNN_POOL_SIZE"] # 2
-
-    hyperParams["dropoutRate"] = modelHyperparamsFromConfigFile["LSTM_DROPOUT_RATE"] # 2
+    # Entries may list several candidate values for the hyperparameter search.
+    # Otherwise, the first candidate is used.
+    hyperParams["epoch"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["EPOCH"])[0]
+    hyperParams["batchsize"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["BATCH_SIZE"])
+    hyperParams["actv"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["ACTIVATION_FUNC"])[0]
+    hyperParams["loss"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["LOSS_FUNC"])[0]
+    hyperParams["lr"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["LEARNING_RATE"])[0]
+    hyperParams["minlr"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["MIN_LEARNING_RATE"])[0]
+
+    hyperParams["kernel1"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["CNN_KERNEL1"])[0] # 4
+    hyperParams["kernel2"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["CNN_KERNEL2"])[0] # 4
+    hyperParams["filter1"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["CNN_NUM_FILTERS1"])[0] # 4
+    hyperParams["filter2"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["CNN_NUM_FILTERS2"])[0] # 16
+    hyperParams["poolsize"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["CNN_POOL_SIZE"])[0] # 2
+
+    hyperParams["dropoutRate"] = common.getHyperParamCandidates(modelHyperparamsFromConfigFile["LSTM_DROPOUT_RATE"])[0] # 2
 
     return hyperParams
 
@@ -633,19 +1040,26 @@ def fillMissingData(data): # If some data is missing (NaN), use the same value a
     return data
 
 def trainingandValidationPhase(region, trainData, wTrainData, valData, wValData, secondTierConfig, 
-                               exptNum, loadFromSavedModel):
+                               exptNum, loadFromSavedModel, numReplicas=1):
     global TRAINING_WINDOW_HOURS
+    global FORECAST_MODE
 
-    print("\nManipulating training data...")
-    X, y = manipulateTrainingDataShape(trainData, TRAINING_WINDOW_HOURS, TRAINING_WINDOW_HOURS, wTrainData)
-    # Next line actually labels validation data
-    valX, valY = manipulateTrainingDataShape(valData, TRAINING_WINDOW_HOURS, TRAINING_WINDOW_HOURS, wValData)
+    with instrumentation.stage("buildTrainingWindows"):
+        print("\nManipulating training data...")
+        if (FORECAST_MODE == "multioutput"):
+            X, y = manipulateMultiOutputTrainingDataShape(trainData, TRAINING_WINDOW_HOURS, wTrainData)
+            valX, valY = manipulateMultiOutputTrainingDataShape(valData, TRAINING_WINDOW_HOURS, wValData)
+        else:
+            X, y = manipulateTrainingDataShape(trainData, TRAINING_WINDOW_HOURS, TRAINING_WINDOW_HOURS, wTrainData)
+            # Next line actually labels validation data
+            valX, valY = manipulateTrainingDataShape(valData, TRAINING_WINDOW_HOURS, TRAINING_WINDOW_HOURS, wValData)
     print("***** Training data manipulation done *****")
     print("X.shape, y.shape: ", X.shape, y.shape)
 
     hyperParams = getHyperParams(secondTierConfig)
     print("\n[BESTMODEL] Starting training...")
-    bestTrainedModel, numFeatures = trainModel(X, y, valX, valY, hyperParams, exptNum, region, loadFromSavedModel)
+    bestTrainedModel, numFeatures = trainModel(X, y, valX, valY, hyperParams, exptNum, region, loadFromSavedModel,
+                                               numReplicas)
     print("***** Training done *****")
     return bestTrainedModel, numFeatures
 
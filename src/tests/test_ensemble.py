@@ -0,0 +1,63 @@
+'''
+Per-replica early stopping of ensemble.py on a tiny ensemble. Skipped without TensorFlow.
+Run from the repo root: python3 -m unittest discover -s src/tests
+'''
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+try:
+    import tensorflow as tf
+    import ensemble
+except ImportError:
+    tf = None
+
+NUM_REPLICAS, NUM_TIMESTEPS, NUM_FEATURES, NUM_OUTPUTS = 3, 8, 2, 4
+
+
+@unittest.skipIf(tf is None, "TensorFlow is not installed")
+class TestReplicaEarlyStopping(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.trainX, self.valX = rng.random((64, NUM_TIMESTEPS, NUM_FEATURES)), rng.random((32, NUM_TIMESTEPS, NUM_FEATURES))
+        weights = rng.random((NUM_TIMESTEPS*NUM_FEATURES, NUM_OUTPUTS))
+        self.trainY = self.trainX.reshape(64, -1) @ weights + rng.normal(0, 0.5, (64, NUM_OUTPUTS))
+        self.valY = self.valX.reshape(32, -1) @ weights
+        tf.random.set_seed(0)
+        with mock.patch("builtins.print"):
+            self.model = ensemble.createEnsembleModel(lambda: tf.keras.Sequential([tf.keras.layers.Flatten(),
+                                                    tf.keras.layers.Dense(NUM_OUTPUTS)]),
+                                                    NUM_REPLICAS, (NUM_TIMESTEPS, NUM_FEATURES))
+        # a large learning rate, so that the validation losses are not monotonic
+        self.model.compile(loss="mse", optimizer=tf.keras.optimizers.Adam(learning_rate=0.3),
+                        metrics=ensemble.getReplicaLossMetrics("mse", NUM_REPLICAS))
+
+    def getReplicaValLosses(self):
+        predictions = self.model.predict(self.valX, verbose=0)
+        return [float(np.mean((predictions[:, i]-self.valY)**2)) for i in range(NUM_REPLICAS)]
+
+    def testBestWeightsPerReplica(self):
+        earlyStopping = ensemble.ReplicaEarlyStopping(NUM_REPLICAS, patience=3)
+        with mock.patch("builtins.print"):
+            hist = self.model.fit(self.trainX, ensemble.tileTargets(self.trainY, NUM_REPLICAS), epochs=40,
+                                batch_size=16, verbose=0, callbacks=[earlyStopping],
+                                validation_data=(self.valX, ensemble.tileTargets(self.valY, NUM_REPLICAS)))
+        valLosses = [hist.history["val_"+ensemble.getReplicaMetricName(i)] for i in range(NUM_REPLICAS)]
+        # each replica has its own best epoch & is restored to it
+        np.testing.assert_allclose(self.getReplicaValLosses(), [min(losses) for losses in valLosses], rtol=1e-4)
+        self.assertEqual(earlyStopping.bestEpochs, [int(np.argmin(losses)) for losses in valLosses])
+        # training stops once no replica has improved for patience epochs
+        numEpochs = len(hist.history["loss"])
+        if (numEpochs < 40):
+            self.assertEqual(numEpochs-1-max(earlyStopping.bestEpochs), 3)
+        # the summed validation loss is the mean of the replica losses
+        np.testing.assert_allclose(hist.history["val_loss"], np.mean(valLosses, axis=0), rtol=1e-4)
+
+
+if __name__ == "__main__":
+    unittest.main()
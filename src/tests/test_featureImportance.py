@@ -0,0 +1,71 @@
+'''
+Feature importance of the second tier (FIND_IMPORTANT_FEATURES) on a tiny model. Skipped without TensorFlow.
+Run from the repo root: python3 -m unittest discover -s src/tests
+'''
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+try:
+    import tensorflow as tf
+    import secondTierForecasts
+    import weatherForecastStore
+except ImportError:
+    tf = None
+
+NUM_TEST_DAYS = 5
+NUM_HISTORY_FEATURES, NUM_FORECAST_FEATURES = 3, 2
+
+
+@unittest.skipIf(tf is None, "TensorFlow is not installed")
+class TestFeatureImportance(unittest.TestCase):
+    def setUp(self):
+        secondTierForecasts.TRAINING_WINDOW_HOURS = 24
+        secondTierForecasts.MODEL_SLIDING_WINDOW_LEN = 24
+        secondTierForecasts.PREDICTION_WINDOW_HOURS = 96
+        secondTierForecasts.MAX_PREDICTION_WINDOW_HOURS = 96
+        secondTierForecasts.BUFFER_HOURS = 72
+        secondTierForecasts.TOP_N_FEATURES = 3
+        secondTierForecasts.INTEGRATED_GRADIENTS_STEPS = 8
+        rng = np.random.default_rng(0)
+        self.valData = rng.random((48, NUM_HISTORY_FEATURES))
+        self.testData = rng.random(((NUM_TEST_DAYS+3)*24, NUM_HISTORY_FEATURES))
+        self.wTestData = weatherForecastStore.WeatherForecastStore(rng.random((NUM_TEST_DAYS*96, NUM_FORECAST_FEATURES)),
+                                                                    96)
+        self.featureList = ["carbon_intensity", "hour_sin", "hour_cos", "fcst_wind_speed", "fcst_temp"]
+        tf.random.set_seed(0)
+        self.model = tf.keras.Sequential([tf.keras.Input((24, len(self.featureList))), tf.keras.layers.Flatten(),
+                                        tf.keras.layers.Dense(24)])
+
+    def testFeatureWindows(self):
+        windows = secondTierForecasts.getFeatureImportanceWindows(self.valData, self.testData, self.wTestData)
+        self.assertEqual(windows.shape, (NUM_TEST_DAYS*4*24, len(self.featureList)))
+        # prediction day 2 of test day 1: history from hour 24+48 of [last val day, test days], weather leads 48..71
+        window = windows[(1*4+2)*24:(1*4+3)*24]
+        np.testing.assert_array_equal(window[:, :NUM_HISTORY_FEATURES], self.testData[48:72])
+        np.testing.assert_array_equal(window[:, NUM_HISTORY_FEATURES:], self.wTestData.getWindow(1, 48, 72))
+
+    def testTopNFeatures(self):
+        windows = secondTierForecasts.getFeatureImportanceWindows(self.valData, self.testData, self.wTestData)
+        for method in ["gradients", "integrated_gradients"]:
+            with self.subTest(method=method):
+                secondTierForecasts.FEATURE_IMPORTANCE_METHOD = method
+                with mock.patch("builtins.print"):
+                    featureImportances, dailyTopNFeatures = secondTierForecasts.findImportantFeatures(self.model,
+                                                            windows, self.featureList, None)
+                self.assertEqual(featureImportances.shape, (4, len(self.featureList)))
+                self.assertEqual(len(dailyTopNFeatures), 4)
+                for day, topNFeatures in enumerate(dailyTopNFeatures):
+                    self.assertEqual(len(topNFeatures), 3)
+                    # the features with the largest absolute importances, most important first
+                    expected = [self.featureList[i] for i in np.argsort(-np.abs(featureImportances[day]))[:3]]
+                    self.assertEqual(list(topNFeatures), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
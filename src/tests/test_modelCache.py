@@ -0,0 +1,71 @@
+'''
+ModelCache with a fake loadFunction (no TensorFlow needed).
+Run from the repo root: python3 -m unittest discover -s src/tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import modelCache
+
+
+class TestModelCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.loads = []
+        self.cache = modelCache.ModelCache(2, loadFunction=self.loadModel)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def loadModel(self, modelFileName):
+        # the "model" is the file content, so that reloads can be told apart
+        self.loads.append(modelFileName)
+        with open(modelFileName, "r") as modelFile:
+            return {"file": modelFileName, "content": modelFile.read()}
+
+    def writeModelFile(self, region, content):
+        modelFileName = os.path.join(self.tmpDir, region+".h5")
+        with open(modelFileName, "w") as modelFile:
+            modelFile.write(content)
+        return modelFileName
+
+    def testHit(self):
+        modelFileName = self.writeModelFile("CISO", "v1")
+        model = self.cache.get("CISO", "direct", modelFileName)
+        self.assertIs(self.cache.get("CISO", "direct", modelFileName), model)
+        self.assertEqual(len(self.loads), 1)
+        stats = self.cache.getStats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["loads"], stats["hit_rate"]), (1, 1, 1, 0.5))
+
+    def testLRUEviction(self):
+        fileNames = {region: self.writeModelFile(region, region) for region in ["CISO", "PJM", "ERCO"]}
+        self.cache.get("CISO", "direct", fileNames["CISO"])
+        self.cache.get("PJM", "direct", fileNames["PJM"])
+        self.cache.get("CISO", "direct", fileNames["CISO"]) # PJM is now the least recently used
+        self.cache.get("ERCO", "direct", fileNames["ERCO"])
+        stats = self.cache.getStats()
+        self.assertEqual((stats["size"], stats["evictions"]), (2, 1))
+        self.cache.get("CISO", "direct", fileNames["CISO"])
+        self.assertEqual(self.loads.count(fileNames["CISO"]), 1)
+        self.cache.get("PJM", "direct", fileNames["PJM"])
+        self.assertEqual(self.loads.count(fileNames["PJM"]), 2)
+
+    def testReloadAfterFileChange(self):
+        modelFileName = self.writeModelFile("CISO", "v1")
+        self.assertEqual(self.cache.get("CISO", "direct", modelFileName)["content"], "v1")
+        self.writeModelFile("CISO", "v2 (retrained)")
+        self.assertEqual(self.cache.get("CISO", "direct", modelFileName)["content"], "v2 (retrained)")
+        stats = self.cache.getStats()
+        self.assertEqual((stats["loads"], stats["invalidations"], stats["size"]), (2, 1, 1))
+        # the new version is cached
+        self.cache.get("CISO", "direct", modelFileName)
+        self.assertEqual(len(self.loads), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+'''
+NumPy forward pass of numpyModel.py against Keras, on a small Conv1D+LSTM+Dense model exported with
+exportWeights(). Skipped without TensorFlow.
+Run from the repo root: python3 -m unittest discover -s src/tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import numpyModel
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+NUM_TIMESTEPS, NUM_FEATURES = 24, 5
+
+
+@unittest.skipIf(tf is None, "TensorFlow is not installed")
+class TestNumpyModel(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def getExportedModel(self, model):
+        h5FileName = os.path.join(self.tmpDir, "model.h5")
+        npzFileName = os.path.join(self.tmpDir, "exported", "model.npz")
+        model.save(h5FileName)
+        with mock.patch("builtins.print"):
+            numpyModel.exportWeights(h5FileName, npzFileName)
+        return numpyModel.loadNumpyModel(npzFileName)
+
+    def testSameOutput(self):
+        # the second tier CNN-LSTM stack, in small
+        tf.random.set_seed(0)
+        model = tf.keras.Sequential([tf.keras.Input((NUM_TIMESTEPS, NUM_FEATURES)),
+                                    tf.keras.layers.Conv1D(4, 4, activation="relu", padding="same"),
+                                    tf.keras.layers.MaxPooling1D(2),
+                                    tf.keras.layers.Flatten(),
+                                    tf.keras.layers.RepeatVector(NUM_TIMESTEPS),
+                                    tf.keras.layers.LSTM(8, activation="relu", return_sequences=True),
+                                    tf.keras.layers.Dropout(0.2),
+                                    tf.keras.layers.Dense(6, activation="relu"),
+                                    tf.keras.layers.Dense(1)])
+        layers = self.getExportedModel(model)
+        self.assertEqual([layer["class_name"] for layer in layers], ["Conv1D", "MaxPooling1D", "Flatten",
+                        "RepeatVector", "LSTM", "Dropout", "Dense", "Dense"])
+        x = np.random.default_rng(0).random((16, NUM_TIMESTEPS, NUM_FEATURES)).astype(np.float32)
+        kerasOutput = model.predict(x, verbose=0)
+        numpyOutput = numpyModel.getPredictFunction(layers)(x).numpy()
+        self.assertEqual(numpyOutput.shape, kerasOutput.shape)
+        self.assertTrue(np.allclose(kerasOutput, numpyOutput, rtol=1e-4, atol=1e-6))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,16 @@
+'''
+Converts the aggregated 3-hourly weather forecasts of dataCollectionScript.py (one row per issue day)
+to hourly forecasts: 96 rows per issue day, one per hour of the prediction window. All five weather
+variables of every region are expanded as arrays (repeat/reshape) & written to
+<ISO>_aggregated_weather_data.csv. If INTERPOLATE_FORECASTS is True, instantaneous forecasts (wind speed,
+temperature, dewpoint) are linearly interpolated between the 3-hourly lead times instead of repeated.
+Usage: python3 cleanWeatherData.py [<ISO> ...] (default: every region in WEATHER_DATA_DIR with all the
+input files)
+'''
+
 import csv
-import math
+import os
+import sys
 from datetime import datetime as dt
 # from datetime import timedelta
 from datetime import timezone as tz
@@ -9,27 +20,35 @@ import numpy as np
 import pandas as pd
 import pytz as pytz
 
-ISO = "AUS_SA"
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import instrumentation
+import spatialReducer
+
 LOCAL_TIMEZONES = {"BPAT": "US/Pacific", "CISO": "US/Pacific", "ERCO": "US/Central", 
                     "SOCO" :"US/Central", "SWPP": "US/Central", "FPL": "US/Eastern", 
                     "ISNE": "US/Eastern", "NYIS": "US/Eastern", "PJM": "US/Eastern", 
                     "MISO": "US/Eastern", "SE": "CET", "GB": "UTC", "DK-DK2": "CET",
                     "DE": "CET", "PL": "CET"}
 # LOCAL_TIMEZONE = pytz.timezone(LOCAL_TIMEZONES[ISO])
-# FILE_DIR = "../final_weather_data/"+ISO+"/" #/2019_weather_data
-FILE_DIR = "../extn/"+ISO+"/weather_data/"
-IN_FILE_NAMES = [ISO+"_AVG_WIND_SPEED.csv", ISO+"_AVG_TEMP.csv", ISO+"_AVG_DPT.csv", ISO+"_AVG_DSWRF.csv", ISO+"_AVG_PCP.csv"]
-OUT_FILE_NAMES = [ISO+"_aggregated_weather_data.csv"]
+# WEATHER_DATA_DIR = "../final_weather_data/" #/2019_weather_data
+WEATHER_DATA_DIR = "../extn/"
+IN_FILE_SUFFIXES = ["_AVG_WIND_SPEED.csv", "_AVG_TEMP.csv", "_AVG_DPT.csv", "_AVG_DSWRF.csv", "_AVG_PCP.csv"]
+OUT_FILE_SUFFIX = "_aggregated_weather_data.csv"
 COLUMN_NAME = ["forecast_avg_wind_speed_wMean", "forecast_avg_temperature_wMean", "forecast_avg_dewpoint_wMean", 
                 "forecast_avg_dswrf_wMean", "forecast_avg_precipitation_wMean"]
 
 
 PREDICTION_PERIOD_DAYS = 4
 PREDICTION_WINDOW_HOURS = 24 * PREDICTION_PERIOD_DAYS
+FORECAST_INTERVAL_HOURS = 3
+INTERPOLATE_FORECASTS = False
+RUN_REPORT_FILE_PREFIX = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", 
+                                        "run_reports", "clean_weather_data")
 
 def readFile(inFileName):
     print("Filename: ", inFileName)
-    dataset = pd.read_csv(inFileName, header=0, infer_datetime_format=True, 
+    with instrumentation.stage("readCsv"):
+        dataset = pd.read_csv(inFileName, header=0, infer_datetime_format=True, 
                             parse_dates=['datetime'], index_col=['datetime'])    
     print(dataset.head())
     print(dataset.columns)
@@ -57,104 +76,101 @@ def writeLocalTimeToFile(dataset, dateTime, outFileName):
     modifiedDataset.to_csv(outFileName)
     return
 
+def getWeatherDataDir(iso):
+    return os.path.join(WEATHER_DATA_DIR, iso, "weather_data")
+
 def createHourlyTimeCol(dateTime):
     global PREDICTION_WINDOW_HOURS
-    global PREDICTION_PERIOD_DAYS
-    hourlyDateTime = []
-    dayIndex = 0
-    for dayIndex in range(len(dateTime)):
-        hourlyDateTime.append(dateTime[dayIndex])
-        for j in range(PREDICTION_WINDOW_HOURS-1):
-            hourlyDateTime.append(hourlyDateTime[-1] + np.timedelta64(1, 'h'))
-    return hourlyDateTime
-
-def createForecastColumns(dataset, modifiedDataset, colName):
-    global PREDICTION_PERIOD_DAYS
+    hourlyDateTime = dateTime[:, np.newaxis] + np.arange(PREDICTION_WINDOW_HOURS)*np.timedelta64(1, 'h')
+    return hourlyDateTime.ravel()
+
+def getForecastBlockColumns(dataset, avgOrAcc=None):
+    # Names of the 3-hourly forecast columns, in lead time order. Block b covers hours 3b..3b+3 of the
+    # prediction window.
+    global PREDICTION_WINDOW_HOURS
+    global FORECAST_INTERVAL_HOURS
+    blockColumns = []
+    for hour in range(0, PREDICTION_WINDOW_HOURS, FORECAST_INTERVAL_HOURS):
+        if (avgOrAcc is None):
+            blockColumns.append(str(hour+FORECAST_INTERVAL_HOURS)+" hr fcst")
+        elif (hour%2 == 0): # n-(n+3) hour avg
+            blockColumns.append(str(hour)+"-"+str(hour+3)+" hr "+avgOrAcc)
+        else: # n-(n+6) hour avg --> eg. 0-6 hr avg. This is how ds084.1 returns, & how data is stored
+            blockColumns.append(str(hour-3)+"-"+str(hour+3)+" hr "+avgOrAcc)
+    return blockColumns
+
+def expandForecasts(dataset, avgOrAcc=None, interpolate=False):
+    # [issue days, 3-hourly lead times] --> [issue days x PREDICTION_WINDOW_HOURS] hourly forecasts.
+    # Hour h (h >= 1) of a day has the value of the 3-hourly block that hour h-1 is in, i.e., the
+    # forecast for the end of its 3-hour period. Hour 0 has the previous day's 24 hour forecast
+    # (the first day: its hour 1 value).
     global PREDICTION_WINDOW_HOURS
-    idx, fcstIdx, i = 0, 0, 1
-    while i < len(modifiedDataset.index.values):
-        fcstIdx = 0
-        j=3
-        while (j<=PREDICTION_WINDOW_HOURS): # changed from 24 for 96 hour forecast
-            if(fcstIdx < j):
-                fcstColName = str(j)+" hr fcst"
-                modifiedDataset[colName].iloc[i] = dataset[fcstColName].iloc[idx]
-                # print(i, j, idx, fcstIdx)
-                fcstIdx += 1
-                i += 1
-                if(i == len(modifiedDataset.index.values)):
-                    break
+    global FORECAST_INTERVAL_HOURS
+    blockValues = dataset[getForecastBlockColumns(dataset, avgOrAcc)].values.astype(np.float64)
+    hours = np.arange(1, PREDICTION_WINDOW_HOURS)
+    hourlyValues = np.empty((len(blockValues), PREDICTION_WINDOW_HOURS))
+    if (interpolate is True and avgOrAcc is None):
+        # instantaneous forecasts at lead times 0 (analysis), 3, 6, ... hours
+        leadTimes = np.arange(0, PREDICTION_WINDOW_HOURS+1, FORECAST_INTERVAL_HOURS)
+        leadTimeValues = np.append(dataset[["Analysis"]].values.astype(np.float64), blockValues, axis=1)
+        blockIdx = np.minimum(hours // FORECAST_INTERVAL_HOURS, len(leadTimes)-2)
+        weights = (hours - leadTimes[blockIdx]) / FORECAST_INTERVAL_HOURS
+        hourlyValues[:, 1:] = ((1-weights)*leadTimeValues[:, blockIdx] + weights*leadTimeValues[:, blockIdx+1])
+    else:
+        hourlyValues[:, 1:] = blockValues[:, (hours-1) // FORECAST_INTERVAL_HOURS]
+    hourlyValues[1:, 0] = hourlyValues[:-1, 24]
+    hourlyValues[0, 0] = hourlyValues[0, 1]
+    return hourlyValues.ravel()
+
+def cleanRegionWeatherData(iso, interpolate=False):
+    # Expands all the weather variables of a region & writes them to <ISO>_aggregated_weather_data.csv
+    weatherDataDir = getWeatherDataDir(iso)
+    instrumentation.setLabels(region=iso, source="")
+    modifiedDataset = None
+    for inFileSuffix, colName in zip(IN_FILE_SUFFIXES, COLUMN_NAME):
+        instrumentation.setLabels(source=colName)
+        dataset, dateTime = readFile(os.path.join(weatherDataDir, iso+inFileSuffix))
+        if (modifiedDataset is None):
+            with instrumentation.stage("createHourlyTimeCol"):
+                modifiedDataset = pd.DataFrame(index=createHourlyTimeCol(dateTime))
+                modifiedDataset.index.name = "datetime"
+        with instrumentation.stage("createForecastColumns"):
+            if "dswrf" in colName:
+                hourlyValues = expandForecasts(dataset, "avg")
+            elif "precipitation" in colName:
+                hourlyValues = expandForecasts(dataset, "acc")
             else:
-                j+=3
-        idx += 1 # changed from 4 to 1 since we are not collecting updated weather data at 06, 12, 18 hours anymore
-    if "wind" in colName:
-        modifiedDataset[colName] = np.abs(modifiedDataset[colName].values)
-
-    for i in range(PREDICTION_WINDOW_HOURS, len(modifiedDataset.index.values), PREDICTION_WINDOW_HOURS): # Check correctness
-        modifiedDataset[colName].iloc[i] = modifiedDataset[colName].iloc[i-((PREDICTION_PERIOD_DAYS-1)*24)]
-
+                hourlyValues = expandForecasts(dataset, interpolate=interpolate)
+            if "wind" in colName:
+                hourlyValues = np.abs(hourlyValues)
+        if (len(hourlyValues) != len(modifiedDataset)):
+            raise ValueError(iso+inFileSuffix+" does not have the same issue days as "+iso+IN_FILE_SUFFIXES[0])
+        modifiedDataset[colName] = hourlyValues
+    instrumentation.setLabels(source="")
+    outFileName = os.path.join(weatherDataDir, iso+OUT_FILE_SUFFIX)
+    print("Writing ", outFileName, "...")
+    with instrumentation.stage("writeCsv"):
+        modifiedDataset.to_csv(outFileName)
     return modifiedDataset
 
-def createAvgOrAccForecastColumns(dataset, modifiedDataset, colName, avgOrAcc):
-    global PREDICTION_PERIOD_DAYS
-    global PREDICTION_WINDOW_HOURS
-    idx, fcstIdx, i = 0, 0, 1
-    timePeriodSuffix = " hr "+avgOrAcc
-    modifiedDatasetLength = len(modifiedDataset.index.values)
-    while i < modifiedDatasetLength:
-        fcstIdx = 0
-        for hour in range(0, PREDICTION_WINDOW_HOURS, 3):
-            timePeriod=""
-            if hour%2==0: # n-(n+3) hour avg
-                timePeriod = str(hour)+"-"+str(hour+3)+timePeriodSuffix
-            else: # n-(n+6) hour avg --> eg. 0-6 hr avg. This is how ds084.1 returns, & how data is stored
-                timePeriod = str(hour-3)+"-"+str(hour+3)+timePeriodSuffix
-            nHourAvgorAcc = dataset[timePeriod].iloc[idx]
-            while(fcstIdx < hour+3 and i < modifiedDatasetLength):
-                # print(timePeriod, idx, i ,len(modifiedDataset.index.values))
-                modifiedDataset[colName].iloc[i] = nHourAvgorAcc
-                i += 1
-                fcstIdx += 1
-        idx += 1 # changed from 4 to 1 since we are not collecting updated weather data at 06, 12, 18 hours anymore
-
-    for i in range(PREDICTION_WINDOW_HOURS, len(modifiedDataset.index.values), PREDICTION_WINDOW_HOURS):  # Check correctness
-        modifiedDataset[colName].iloc[i] = modifiedDataset[colName].iloc[i-((PREDICTION_PERIOD_DAYS-1)*24)]
-
-    return modifiedDataset
+def getRegions():
+    # every region in WEATHER_DATA_DIR with all the input files
+    regions = []
+    for iso in sorted(os.listdir(WEATHER_DATA_DIR)):
+        if (all([os.path.exists(os.path.join(getWeatherDataDir(iso), iso+inFileSuffix)) 
+                    for inFileSuffix in IN_FILE_SUFFIXES])):
+            regions.append(iso)
+    return regions
 
 def calcluateWindSpeed(dataset):
-    dataset["forecast_wind_speed"] = [None]*len(dataset)
-    for i in range(len(dataset)):
-        u = dataset["forecast_u_wind"].iloc[i]
-        v = dataset["forecast_v_wind"].iloc[i]
-        dataset["forecast_wind_speed"].iloc[i] = round(math.sqrt(u*u * v*v), 5)
+    dataset["forecast_wind_speed"] = np.round(spatialReducer.windSpeed(dataset["forecast_u_wind"].values, 
+                                                                    dataset["forecast_v_wind"].values), 5)
     return dataset
 
-dataset, dateTime = readFile(FILE_DIR+IN_FILE_NAMES[0])
-# writeLocalTimeToFile(dataset, dateTime, OUT_FILE_NAMES[i])
-hourlyDateTime = createHourlyTimeCol(dateTime)
-modifiedDataset = pd.DataFrame(index=hourlyDateTime, 
-        columns=COLUMN_NAME)
-modifiedDataset.index.name = "datetime"
-for i in range(len(IN_FILE_NAMES)):
-    dataset, dateTime = readFile(FILE_DIR+IN_FILE_NAMES[i])
-    colName = modifiedDataset.columns.values[i]
-    modifiedDataset[colName].iloc[0] = 0
-    if "dswrf" in colName:
-        modifiedDataset = createAvgOrAccForecastColumns(dataset, modifiedDataset, colName, "avg")
-    elif "precipitation" in colName:
-        modifiedDataset = createAvgOrAccForecastColumns(dataset, modifiedDataset, colName, "acc")
-    else:
-        modifiedDataset = createForecastColumns(dataset, modifiedDataset, colName)    
-    modifiedDataset[colName].iloc[0] = modifiedDataset[colName].iloc[1]
-    
-modifiedDataset.to_csv(FILE_DIR+OUT_FILE_NAMES[0])
-
-    
-    
-    
-    
-    
-
-
-
+if __name__ == "__main__":
+    regions = sys.argv[1:] if len(sys.argv) > 1 else getRegions()
+    print("Regions: ", regions)
+    for iso in regions:
+        print("*******************", iso, "*******************")
+        cleanRegionWeatherData(iso, INTERPOLATE_FORECASTS)
+    instrumentation.writeRunReport(RUN_REPORT_FILE_PREFIX)
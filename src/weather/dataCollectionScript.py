@@ -1,34 +1,89 @@
 '''
-This file uses the code from https://towardsdatascience.com/the-correct-way-to-average-the-globe-92ceecd172b7 
-for the below two functions:
-    earth_radius()
-    area_grid()
-These functions aggregate the weather data over a specified bounding box.
+Aggregates the GFS weather forecasts (GRIB2 files) over a region, using the area weighted averages of
+spatialReducer.py.
+GRIB2 files are extracted in parallel by NUM_WORKERS processes, one day (all lead times) per task. wgrib2 writes its CSV output to a
+pipe instead of a shared temp file, and the results are put back in file order.
+With GRIB_BACKEND = "eccodes", the GRIB2 messages are decoded in-process into NumPy arrays (requires
+the eccodes python package) instead of being converted to CSV text by wgrib2 & parsed back. The
+same area weighted averages & output files are produced.
+An inventory (message no., parameter, level, lead time, byte offset & length of every message) is
+built once per GRIB2 file & cached next to it (<file>.inv.csv). Only the messages of the requested
+variable are read & decoded, by byte range.
+Incremental mode (INCREMENTAL = True, or: python3 dataCollectionScript.py -i): a manifest of the processed
+GFS cycles is kept next to each output file (<output file>.manifest.csv). Only the cycles that are not in the
+manifest (from the first year of YEARS up to today) are extracted, & their rows are appended to the output file,
+INCREMENTAL_CHUNK_DAYS days at a time. The rows are written before the manifest, & rows that are not in the
+manifest are removed at the start of a run, so that an interrupted run can be resumed. Cycles with missing lead time files are listed
+in <output file>.missing.csv & retried on the next run (or filled with the previous file, if
+FILL_MISSING_CYCLES = True).
+Multi-region mode (MULTI_REGION = True, or: python3 dataCollectionScript.py -m): the regions of ISO_LIST are
+extracted from global GFS files (GLOBAL_FILE_DIR) in a single pass. Each file is decoded once, & the bounding
+box of every region (REGION_BOUNDING_BOXES) is cropped from the decoded grid, so the decoding cost does not
+grow with the number of regions. The output files are the same as those of the per-region GRIB2 files.
+With SAVE_WEATHER_CUBES = True (or: python3 dataCollectionScript.py -c), the cropped fields of each region are
+also kept in memory-mapped weather cubes (weatherCube.py, <output dir>/cubes/<variable>.cube), so that other
+aggregations can be computed with reaggregateWeather.py without decoding the GRIB2 files again.
 '''
 
 
 import subprocess
 from collections import namedtuple
 from calendar import monthrange
+import datetime
+import io
+import multiprocessing
 import os.path
+import sys
 import pandas as pd
 import csv
-import math
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import instrumentation
+import spatialReducer
+import weatherCube
+
+RUN_REPORT_FILE_PREFIX = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", 
+                                        "run_reports", "weather_data_collection")
+
 ISO_LIST = ["AUS_QLD"]
-# IF 2 CONSECUTIVE FILES ARE NOT PRESENT, MANUALLY ADD THEM
+MULTI_REGION = False # True: extract all regions of ISO_LIST from the global GFS files in GLOBAL_FILE_DIR
+GLOBAL_FILE_DIR = "../extn/global/weather_data/"
+# Bounding boxes (nlat, slat, wlon, elon) of the regions, as in ds084.1_control.ctl
+REGION_BOUNDING_BOXES = {"CISO": (42, 32, -124.75, -113.5), "PJM": (43, 34.25, -91, -73.5),
+                        "ERCO": (36.5, 25.25, -104.5, -93.25), "ISNE": (48, 40, -74.25, -66.5),
+                        "MISO": (50.00, 28.50, -107.75, -81.75), "BPAT": (49.50, 39.50, -125.25, -105.50),
+                        "SWPP": (49.50, 30.25, -107.75, -89.50), "SOCO": (35.50, 29.25, -90.50, -80.25),
+                        "FPL": (31.25, 24.00, -83.50, -79.50), "NYISO": (45.50, 40.00, -80.25, -71.25),
+                        "SE": (69, 55.25, 11.25, 21.25), "GB": (61, 49.75, -8.25, 2.25),
+                        "DE": (55.25, 47.25, 5.75, 15), "DK-DK2": (57.75, 54.75, 7.25, 11.25),
+                        "PL": (54.75, 49, 14, 24), "FI": (70.00, 59.75, 20.50, 31.50),
+                        "FR": (51.25, 42.25, -5.25, 8.25), "ES": (43.75, 36.00, -9.25, 3.50),
+                        "BE": (51.50, 49.50, 2.50, 6.25), "NL": (53.50, 50.75, 3.25, 7.00),
+                        "AUS_NSW": (-34.75, -36.50, 148.25, 150), "AUS_QLD": (-8.75, -29.75, 137.50, 154),
+                        "AUS_SA": (-25.50, -38.50, 128.50, 141.50), "CA-ON": (57.25, 41.25, -95.75, -73.75)}
+# IF 2 CONSECUTIVE FILES ARE NOT PRESENT, MANUALLY ADD THEM (incremental mode: see <output file>.missing.csv)
+INCREMENTAL = False # True: extract only the cycles that are not in the manifest & append them to the output files
+FILL_MISSING_CYCLES = False # incremental mode, True: replace missing lead time files with the previous file
+INCREMENTAL_CHUNK_DAYS = 30 # days extracted before the output file, manifest & weather cube are updated
+SAVE_WEATHER_CUBES = False # True: also write the cropped fields of each region to a weather cube
+MANIFEST_FIELDS = ["cycle", "num_files", "num_filled_files"]
+MISSING_CYCLE_FIELDS = ["cycle", "missing_files"]
 
 GRIB2_CMD = "grib2/wgrib2/wgrib2"
+NUM_WORKERS = 0 # parallel extraction processes, 0: one per core
+GRIB_BACKEND = "wgrib2" # wgrib2 or eccodes
+# (discipline, parameter category, parameter number) --> wgrib2 name of the GRIB2 parameter
+GRIB2_PARAMS = {(0, 0, 0): "TMP", (0, 0, 6): "DPT", (0, 2, 2): "UGRD", (0, 2, 3): "VGRD",
+                (0, 4, 7): "DSWRF", (0, 1, 8): "APCP"}
+WEATHER_VARIABLE_PARAMS = {"TEMP": ["TMP"], "DPT": ["DPT"], "WIND": ["UGRD", "VGRD"],
+                            "DSWRF": ["DSWRF"], "PCP": ["APCP"]}
 # FILE_DIR = "gfs.0p25.2020010100-2021010100.f000.grib2/"
 
 FILE_PREFIX = "gfs.0p25."
-UGRD_VGRD_SEPRATOR = {"CISO": 1886, "PJM": 2556, "SE": 2296, "DK-DK2": 221, 
-                        "ERCO": 2116, "ISNE": 1056, "GB": 1978, "DE": 1254, 
-                        "PL": 984, "AUS_NSW": 64, "AUS_QLD": 5695, "AUS_SA": 2809}
-TMP_DPT_SEPARATOR = {"CISO": 1886, "PJM": 2556, "SE": 2296, "DK-DK2": 221, 
-                        "ERCO": 2116, "ISNE": 1056, "GB": 1978, "DE": 1254, 
-                        "PL": 984, "AUS_NSW": 64, "AUS_QLD": 5695, "AUS_SA": 2809}
+INVENTORY_FIELDS = ["message", "param", "level", "lead_time_hours", "offset", "length"]
+# GRIB2 code table 4.4 (indicator of unit of time range) --> hours
+HOURS_PER_TIME_UNIT = {0: 1/60, 1: 1, 2: 24, 10: 3, 11: 6, 12: 12, 13: 1/3600}
 
 HOUR = ["00"] ##, "06", "12", "18"]
 FCST = ["000", "003", "006", "009", "012", "015", "018", "021", "024",
@@ -62,147 +117,485 @@ CSV_FILE_FIELDS_ACC = ["datetime", "param", "level", "latitude", "longitude", "0
         "48-51 hr acc", "48-54 hr acc", "54-57 hr acc", "54-60 hr acc", "60-63 hr acc",
         "60-66 hr acc", "66-69 hr acc", "66-72 hr acc", "72-75 hr acc", "72-78 hr acc",
         "78-81 hr acc", "78-84 hr acc", "84-87 hr acc", "84-90 hr acc", "90-93 hr acc", "90-96 hr acc"] 
-
-def getFileList(yearList=[2020], fileDir = None, fcstCol=FCST):
-    fileList = []
-    prevFile = None
+# output file suffix, GRIB2 file sub-directory, weather variable, output fields & lead times (multi-region mode)
+WEATHER_OUTPUTS = [("_AVG_WIND_SPEED.csv", "ugrd_vgrd/", "WIND", CSV_FILE_FIELDS_FCST, FCST),
+                    ("_AVG_TEMP.csv", "tmp_dpt/", "TEMP", CSV_FILE_FIELDS_FCST, FCST),
+                    ("_AVG_DPT.csv", "tmp_dpt/", "DPT", CSV_FILE_FIELDS_FCST, FCST),
+                    ("_AVG_DSWRF.csv", "dswrf/", "DSWRF", CSV_FILE_FIELDS_AVG, FCST_AVG_ACC),
+                    ("_AVG_PCP.csv", "apcp/", "PCP", CSV_FILE_FIELDS_ACC, FCST_AVG_ACC)]
+
+def getCycleList(yearList, lastDate=None):
+    # GFS cycles (YYYYMMDDHH) of every day of the years, up to lastDate (if given)
+    cycleList = []
     for year in yearList:
         for month in range(1, 13): # Month is always 1..12
             for day in range(1, monthrange(year, month)[1] + 1):
+                if (lastDate is not None and datetime.date(year, month, day) > lastDate):
+                    continue
                 curDate = str(year)+f"{month:02d}"+f"{day:02d}"
-                fileName = FILE_PREFIX + str(curDate)
-                oldFileName = fileName
                 for hr in HOUR:
-                    for fcst in fcstCol:
-                        fileName = oldFileName
-                        fileName +=str(hr) + ".f"+str(fcst)+".grib2"
-                        filePath = ""
-                        filePath = fileDir + fileName
-                        if (os.path.exists(filePath) == False):
-                            print(filePath + " doesn't exist")
-                            filePath = fileDir + str(prevFile)
-                            if (os.path.exists(filePath) == True):
-                                fileList.append(filePath)
-                                print("Using previous forecast value with file: ", prevFile)
-                            else:
-                                print(filePath + " doesn't exist also")
-                        else:
-                            fileList.append(filePath)
-                            prevFile = fileName # assuming the first file to be searched is always present
+                    cycleList.append(curDate+str(hr))
+    return cycleList
+
+def getCycleFiles(fileDir, cycle, fcstCol, prevFile=None, verbose=True):
+    # Lead time files of a cycle. A missing file is replaced by the previous file found.
+    # Returns the files, the names of the missing files & the last file found.
+    cycleFiles, missingFiles = [], []
+    for fcst in fcstCol:
+        fileName = FILE_PREFIX + cycle + ".f"+str(fcst)+".grib2"
+        filePath = fileDir + fileName
+        if (os.path.exists(filePath) == False):
+            missingFiles.append(fileName)
+            if (verbose == True):
+                print(filePath + " doesn't exist")
+            filePath = fileDir + str(prevFile)
+            if (os.path.exists(filePath) == True):
+                cycleFiles.append(filePath)
+                if (verbose == True):
+                    print("Using previous forecast value with file: ", prevFile)
+            elif (verbose == True):
+                print(filePath + " doesn't exist also")
+        else:
+            cycleFiles.append(filePath)
+            prevFile = fileName # assuming the first file to be searched is always present
+    return cycleFiles, missingFiles, prevFile
+
+def getFileList(yearList=[2020], fileDir = None, fcstCol=FCST):
+    fileList = []
+    prevFile = None
+    for cycle in getCycleList(yearList):
+        cycleFiles, _, prevFile = getCycleFiles(fileDir, cycle, fcstCol, prevFile)
+        fileList.extend(cycleFiles)
     return fileList
 
+def buildInventory(fileName):
+    # Reads the section headers of every GRIB2 message (not the data). One entry per message.
+    inventory = []
+    with open(fileName, "rb") as gribFile:
+        offset = 0
+        while True:
+            gribFile.seek(offset)
+            indicator = gribFile.read(16)
+            if (len(indicator) < 16):
+                break
+            if (indicator[:4] != b"GRIB" or indicator[7] != 2):
+                raise ValueError(fileName+": no GRIB2 message at byte "+str(offset))
+            discipline = indicator[6]
+            length = int.from_bytes(indicator[8:16], "big")
+            sectionOffset = offset + 16
+            entry = None
+            while (entry is None and sectionOffset < offset+length-4):
+                sectionHeader = gribFile.read(5)
+                sectionLength, sectionNumber = int.from_bytes(sectionHeader[:4], "big"), sectionHeader[4]
+                if (sectionNumber == 4):
+                    entry = getProductEntry(discipline, sectionHeader+gribFile.read(sectionLength-5))
+                else:
+                    gribFile.seek(sectionLength-5, os.SEEK_CUR)
+                sectionOffset += sectionLength
+            if (entry is None):
+                raise ValueError(fileName+": no product definition in the GRIB2 message at byte "+str(offset))
+            inventory.append(dict(entry, message=len(inventory)+1, offset=offset, length=length))
+            offset += length
+    return inventory
+
+def getProductEntry(discipline, section):
+    # Product definition templates 4.0-4.15 (used by GFS) share the octets read here
+    category, number = section[9], section[10]
+    param = GRIB2_PARAMS.get((discipline, category, number), 
+                            "var"+str(discipline)+"_"+str(category)+"_"+str(number))
+    leadTime = int.from_bytes(section[18:22], "big") * HOURS_PER_TIME_UNIT.get(section[17], 1)
+    scaleFactor = section[23] if section[23] < 128 else -(section[23]-128) # sign bit
+    level = int.from_bytes(section[24:28], "big") / 10**scaleFactor
+    if (level == int(level)):
+        level = int(level)
+    return {"param": param, "level": getLevelName(section[22], level), "lead_time_hours": leadTime}
+
+def getInventory(fileName):
+    # Cached inventory, rebuilt if the GRIB2 file is newer
+    inventoryFileName = fileName+".inv.csv"
+    if (os.path.exists(inventoryFileName) and os.path.getmtime(inventoryFileName) >= os.path.getmtime(fileName)):
+        with open(inventoryFileName, "r") as inventoryFile:
+            inventory = list(csv.DictReader(inventoryFile))
+        for entry in inventory:
+            for field in ["message", "offset", "length"]:
+                entry[field] = int(entry[field])
+        return inventory
+    inventory = buildInventory(fileName)
+    tmpInventoryFileName = inventoryFileName+"."+str(os.getpid())
+    with open(tmpInventoryFileName, "w") as inventoryFile:
+        csvwriter = csv.DictWriter(inventoryFile, fieldnames=INVENTORY_FIELDS)
+        csvwriter.writeheader()
+        csvwriter.writerows(inventory)
+    os.replace(tmpInventoryFileName, inventoryFileName)
+    return inventory
+
+def readGribCsv(fileName, entries):
+    # wgrib2 reads only the messages at the inventory byte offsets (-i, from stdin), & writes the CSV to
+    # stdout ("-") & the inventory to /dev/null, so that concurrent extractions do not share a temp file
+    inventoryLines = "".join([str(entry["message"])+":"+str(entry["offset"])+"\n" for entry in entries])
+    result = subprocess.run([GRIB2_CMD, fileName, "-i", "-inv", "/dev/null", "-csv", "-"],
+                            input=inventoryLines.encode(), stdout=subprocess.PIPE)
+    if (result.returncode != 0):
+        print("Error: Process call failed -- ", GRIB2_CMD, fileName)
+        return None
+    return pd.read_csv(io.BytesIO(result.stdout), names=HEADER)
+
+def readGribFields(fileName, params):
+    # Decodes the first message of each of the params in the file. Returns {param: (startDate, level,
+    # latitude, longitude, lat, lon, values)}: the first grid point, the grid axes (ascending) &
+    # the values in file (scanning) order. Returns None if a param is missing or decoding failed.
+    inventory = getInventory(fileName)
+    entries = []
+    for param in params:
+        paramEntries = [entry for entry in inventory if entry["param"] == param]
+        if (len(paramEntries) == 0):
+            print("Error: ", param, " not found in ", fileName)
+            return None
+        entries.append(paramEntries[0])
+    if (GRIB_BACKEND == "eccodes"):
+        return readGribMessages(fileName, entries)
+    dataset = readGribCsv(fileName, entries)
+    if (dataset is None):
+        return None
+    fields = {}
+    for param in params:
+        paramDataset = dataset[dataset["param"] == param]
+        fields[param] = (paramDataset["startDate"].iloc[0], paramDataset["level"].iloc[0],
+                        paramDataset["latitude"].iloc[0], paramDataset["longitude"].iloc[0],
+                        np.unique(paramDataset["latitude"].values), np.unique(paramDataset["longitude"].values),
+                        paramDataset["value"].values)
+    return fields
+
+def readGribMessages(fileName, entries):
+    # Decodes the messages at the inventory byte ranges in-process with eccodes. The fields are returned in
+    # the same order as wgrib2's (we:sn, first grid point: the southernmost one), whatever the scanning mode.
+    import eccodes
+    fields = {}
+    with open(fileName, "rb") as gribFile:
+        for entry in entries:
+            gribFile.seek(entry["offset"])
+            gid = eccodes.codes_new_from_message(gribFile.read(entry["length"]))
+            try:
+                dataDate, dataTime = str(eccodes.codes_get(gid, "dataDate")), eccodes.codes_get(gid, "dataTime")
+                startDate = dataDate[:4]+"-"+dataDate[4:6]+"-"+dataDate[6:]+" "+f"{dataTime//100:02d}:{dataTime%100:02d}:00"
+                latitudes, longitudes = getGridAxes(eccodes, gid)
+                values, firstLat = eccodes.codes_get_values(gid), eccodes.codes_get(gid, "latitudeOfFirstGridPointInDegrees")
+                if (eccodes.codes_get(gid, "jScansPositively") == 0):
+                    # north to south (GFS): same order as wgrib2 (we:sn), i.e., the first row is the southernmost
+                    values = np.reshape(values, (len(latitudes), len(longitudes)))[::-1].ravel()
+                    firstLat = eccodes.codes_get(gid, "latitudeOfLastGridPointInDegrees")
+                fields[entry["param"]] = (startDate, entry["level"], firstLat,
+                                        eccodes.codes_get(gid, "longitudeOfFirstGridPointInDegrees"),
+                                        np.unique(latitudes), np.unique(longitudes), values)
+            finally:
+                eccodes.codes_release(gid)
+    return fields
+
+def getGridAxes(eccodes, gid):
+    # Regular lat/lon grids (GFS): the axes follow from the grid definition, which is much faster than
+    # the distinctLatitudes/distinctLongitudes keys
+    if (eccodes.codes_get(gid, "gridType") != "regular_ll"):
+        return eccodes.codes_get_array(gid, "distinctLatitudes"), eccodes.codes_get_array(gid, "distinctLongitudes")
+    latitudes = np.linspace(eccodes.codes_get(gid, "latitudeOfFirstGridPointInDegrees"),
+                            eccodes.codes_get(gid, "latitudeOfLastGridPointInDegrees"), eccodes.codes_get(gid, "Nj"))
+    longitudes = np.linspace(eccodes.codes_get(gid, "longitudeOfFirstGridPointInDegrees"),
+                            eccodes.codes_get(gid, "longitudeOfLastGridPointInDegrees"), eccodes.codes_get(gid, "Ni"))
+    return latitudes, longitudes
+
+def getLevelName(typeOfSurface, level):
+    # same level names as wgrib2
+    if (typeOfSurface == 1):
+        return "surface"
+    if (typeOfSurface == 103):
+        return str(level)+" m above ground"
+    return str(typeOfSurface)+" "+str(level)
+
+def getRegionGrid(lat, lon, firstLat, firstLon, boundingBox):
+    # Rows & columns of the bounding box in a [lat, lon] grid (file order), the region's grid axes (ascending,
+    # longitudes unwrapped) & its first grid point. boundingBox None: the whole grid.
+    if (boundingBox is None):
+        return slice(None), slice(None), lat, lon, firstLat, firstLon
+    nlat, slat, wlon, elon = boundingBox
+    fileLat = lat if firstLat == lat[0] else lat[::-1]
+    rows = np.nonzero((fileLat >= slat-1e-6) & (fileLat <= nlat+1e-6))[0]
+    lonOffset = np.round((lon - wlon) % 360, 6) % 360 # east of wlon, in degrees
+    cols = np.nonzero(lonOffset <= (elon - wlon) % 360 + 1e-6)[0]
+    cols = cols[np.argsort(lonOffset[cols], kind="stable")]
+    if (len(rows) == 0 or len(cols) == 0):
+        raise ValueError("Bounding box "+str(boundingBox)+" is outside the grid")
+    return rows, cols, np.sort(fileLat[rows]), np.unwrap(lon[cols], period=360), fileLat[rows[0]], lon[cols[0]]
+
+def getDayRows(args):
+    # One output row per region: the header of the first file of the day, followed by the area weighted
+    # average of the weather variable over the region in each lead time file of the day (run in the worker
+    # processes). Each file is decoded once for all regions. regionBoxes: {region: bounding box (None: the
+    # whole grid)}. Files that could not be decoded are skipped. Rows are None if none could be decoded.
+    # keepCubes: also return the [lead time, lat, lon] float32 fields & the grid of each region.
+    dayFiles, weatherVariable, regionBoxes, keepCubes = args
+    params = WEATHER_VARIABLE_PARAMS[weatherVariable]
+    regionGrids, lat, lon = None, None, None
+    cubes = {region: {param: [] for param in params} for region in regionBoxes}
+    for fileName in dayFiles:
+        fields = readGribFields(fileName, params)
+        if (fields is None):
+            continue
+        if (regionGrids is None):
+            startDate, level, firstLat, firstLon, lat, lon, _ = fields[params[0]]
+            regionGrids = {region: getRegionGrid(lat, lon, firstLat, firstLon, boundingBox) 
+                            for region, boundingBox in regionBoxes.items()}
+        for param in params:
+            grid = np.reshape(fields[param][-1], (len(lat), len(lon)))
+            for region, (rows, cols, _, _, _, _) in regionGrids.items():
+                cubes[region][param].append(grid[rows][:, cols])
+    if (regionGrids is None):
+        return {region: None for region in regionBoxes}, {region: None for region in regionBoxes}
+    dayRows, dayCubes = {}, {}
+    for region, (_, _, regionLat, regionLon, regionFirstLat, regionFirstLon) in regionGrids.items():
+        if (weatherVariable == "WIND"):
+            cube = spatialReducer.windSpeed(np.stack(cubes[region]["UGRD"]), np.stack(cubes[region]["VGRD"]))
+        else:
+            cube = np.stack(cubes[region][params[0]])
+        weightedMeans = spatialReducer.reduceCube(cube, spatialReducer.getAreaWeights(regionLat, regionLon), 
+                                                ["weighted_mean"])["weighted_mean"]
+        dayRows[region] = [startDate, params[0], level, regionFirstLat, regionFirstLon] + weightedMeans.tolist()
+        if (keepCubes == True):
+            dayCubes[region] = (cube.astype(weatherCube.CUBE_DTYPE), {"param": params[0], "level": level,
+                                "lat": regionLat.tolist(), "lon": regionLon.tolist()})
+    return dayRows, dayCubes
+
+def getDayRow(args):
+    # One output row of a region's (cropped) GRIB2 files
+    dayFiles, weatherVariable = args
+    return getDayRows((dayFiles, weatherVariable, {None: None}, False))[0][None]
+
+def mapFiles(func, argsList):
+    # Runs func over argsList in NUM_WORKERS processes. Results are in the order of argsList.
+    numWorkers = NUM_WORKERS if NUM_WORKERS > 0 else multiprocessing.cpu_count()
+    numWorkers = max(1, min(numWorkers, len(argsList)))
+    with multiprocessing.Pool(processes=numWorkers) as pool:
+        results = pool.map(func, argsList, chunksize=max(1, len(argsList)//(numWorkers*8)))
+    return results
+
+def getRegionWeatherRows(dayFileLists, weatherVariable, regionBoxes, keepCubes=False):
+    # One row per day (list of lead time files) & region: {region: rows}, & with keepCubes, {region: [(issue
+    # time, fields, grid)]} of the days with all lead times
+    regionRows, regionCubes = {region: [] for region in regionBoxes}, {region: [] for region in regionBoxes}
+    dayResults = mapFiles(getDayRows, [(dayFiles, weatherVariable, regionBoxes, keepCubes) for dayFiles in dayFileLists])
+    for dayFiles, (dayRows, dayCubes) in zip(dayFileLists, dayResults):
+        if (None in dayRows.values()):
+            print("Error: no data for files ", dayFiles[0], " onwards")
+            continue
+        for region, row in dayRows.items():
+            regionRows[region].append(row)
+            if (keepCubes == True and len(dayCubes[region][0]) == len(dayFiles)):
+                regionCubes[region].append((row[0],)+dayCubes[region])
+    return regionRows, regionCubes
+
+def getWeatherRows(fileList, weatherVariable, numFcst):
+    # One row per day (numFcst lead time files)
+    dayFileLists = [fileList[rowStart:rowStart+numFcst] for rowStart in range(0, len(fileList), numFcst)]
+    return getRegionWeatherRows(dayFileLists, weatherVariable, {None: None})[0][None]
+
+def writeWeatherCube(outFileName, weatherVariable, fcstCol, dayCubes, reset):
+    # dayCubes: [(issue time, fields, grid)]. Returns False if there was nothing to write.
+    if (len(dayCubes) == 0):
+        return False
+    cubeFileName = weatherCube.getCubeFileName(outFileName, weatherVariable)
+    gridMetadata = dict(dayCubes[0][2], variable=weatherVariable, lead_times=list(fcstCol))
+    weatherCube.writeCubeDays(cubeFileName, [issueTime for issueTime, _, _ in dayCubes], 
+                            [fields for _, fields, _ in dayCubes], gridMetadata, reset)
+    return True
+
+def getRegionWeatherData(fileList, csvFields, outFileNames, fcstCol, weatherVariable, regionBoxes):
+    # outFileNames: {region: output file}. The days are extracted INCREMENTAL_CHUNK_DAYS at a time, so that
+    # the fields kept for the weather cubes (SAVE_WEATHER_CUBES) fit in memory.
+    for outFileName in outFileNames.values():
+        with open(outFileName, 'w') as csvfile: 
+            csvwriter = csv.writer(csvfile)                    
+            csvwriter.writerow(csvFields)
+    numFcst = len(fcstCol)
+    dayFileLists = [fileList[rowStart:rowStart+numFcst] for rowStart in range(0, len(fileList), numFcst)]
+    chunkSize = INCREMENTAL_CHUNK_DAYS*len(HOUR)
+    resetCubes = {region: True for region in outFileNames}
+    for chunkStart in range(0, len(dayFileLists), chunkSize):
+        regionRows, regionCubes = getRegionWeatherRows(dayFileLists[chunkStart:chunkStart+chunkSize], weatherVariable, 
+                                                        regionBoxes, SAVE_WEATHER_CUBES)
+        for region, outFileName in outFileNames.items():
+            if (SAVE_WEATHER_CUBES == True and writeWeatherCube(outFileName, weatherVariable, fcstCol, 
+                                                                regionCubes[region], resetCubes[region])):
+                resetCubes[region] = False
+            with open(outFileName, 'a') as csvfile:
+                csvwriter = csv.writer(csvfile)
+                csvwriter.writerows(regionRows[region])
+    return
+
 def getWeatherData(fileList, csvFields, outFileName, fcstCol, weatherVariable):
+    getRegionWeatherData(fileList, csvFields, {None: outFileName}, fcstCol, weatherVariable, {None: None})
+    return
+
+def getWindData(fileList, csvFields, outFileName):
     with open(outFileName, 'w') as csvfile: 
         # creating a csv writer object 
         csvwriter = csv.writer(csvfile)                    
         # writing the fields 
         csvwriter.writerow(csvFields)
-    fileIdx = 0
-    rows = []
-    while fileIdx < len(fileList):
-        row = None
-        lat = None
-        lon = None
-        # weatherValues = []
-        for i in range(len(fcstCol)):
-            val = subprocess.call(GRIB2_CMD + " " + fileList[fileIdx] + " -csv tmp.csv", shell=True)
-            fileIdx+=1
-            if(val == 0):
-                dataset = pd.read_csv("tmp.csv", infer_datetime_format=True, 
-                        names=HEADER) #, header=0,  parse_dates=['UTC time'], index_col=['UTC time'])    
-                # print(dataset.head(2))
-                if (weatherVariable == "TEMP"):
-                    dataset = dataset[:TMP_DPT_SEPARATOR[ISO]]
-                elif (weatherVariable == "DPT"):
-                    dataset = dataset[TMP_DPT_SEPARATOR[ISO]:]
-                if (i==0):
-                    lat = np.unique(dataset["latitude"].values)
-                    lon = np.unique(dataset["longitude"].values)
-                    grid_cell_area = area_grid(lat, lon)
-                    total_area_of_earth = np.sum(grid_cell_area)
-                # averageValue = round(dataset["value"].mean(), 5)
-                
-                if row is None:
-                    row = [dataset["startDate"].iloc[0], dataset["param"].iloc[0], dataset["level"].iloc[0],
-                                dataset["latitude"].iloc[0], dataset["longitude"].iloc[0]]
-
-                value = dataset["value"].values
-                # weighted_mean = np.mean(temperature)
-                value = np.reshape(value, (len(lat), len(lon)))
-                weighted_mean = (value * grid_cell_area) / total_area_of_earth
-                weighted_mean = np.sum(weighted_mean)
-                row.append(weighted_mean)
-                delFile = subprocess.call("rm tmp.csv", shell=True)
-                if(delFile != 0):
-                    print("Error: Process call failed -- rm")
-            else:
-                print("Error: Process call failed -- ", GRIB2_CMD)
-        # writing to csv file
-        # print(weatherValues)
-        # row.extend(weatherValues) 
-        rows.append(row)
+    rows = getWeatherRows(fileList, "WIND", len(FCST))
     with open(outFileName, 'a') as csvfile:
         csvwriter = csv.writer(csvfile)
         csvwriter.writerows(rows)
 
     return
 
-def getWindData(fileList, csvFields, outFileName):
-    # print(len(fileList))
-    # exit(0)
-    with open(outFileName, 'w') as csvfile: 
-        # creating a csv writer object 
-        csvwriter = csv.writer(csvfile)                    
-        # writing the fields 
-        csvwriter.writerow(csvFields)
-    fileIdx = 0
-    rows = []
-    
-    while fileIdx < len(fileList):
-        row = None
-        lat = None
-        lon = None
-        grid_cell_area = None
-        total_area_of_earth = None
-        # weatherValues = []
-        for i in range(len(FCST)):
-            val = subprocess.call(GRIB2_CMD + " " + fileList[fileIdx] + " -csv tmp.csv", shell=True)
-            fileIdx+=1
-            if(val == 0):
-                dataset = pd.read_csv("tmp.csv", infer_datetime_format=True, 
-                        names=HEADER) #, header=0,  parse_dates=['UTC time'], index_col=['UTC time'])    
-                # print(dataset.head(2))
-                vdataset = dataset[UGRD_VGRD_SEPRATOR[ISO]:]
-                udataset = dataset[:UGRD_VGRD_SEPRATOR[ISO]]
-                if (i==0):
-                    lat = np.unique(dataset["latitude"].values)
-                    lon = np.unique(dataset["longitude"].values)
-                    grid_cell_area = area_grid(lat, lon)
-                    total_area_of_earth = np.sum(grid_cell_area)
-                if row is None:
-                    row = [dataset["startDate"].iloc[0], dataset["param"].iloc[0], dataset["level"].iloc[0],
-                                dataset["latitude"].iloc[0], dataset["longitude"].iloc[0]]
-
-                windSpeed = (udataset["value"].values**2 + vdataset["value"].values**2)**(0.5)
-                # weighted_mean = np.mean(temperature)
-                value = np.reshape(windSpeed, (len(lat), len(lon)))
-                weighted_mean = (value * grid_cell_area) / total_area_of_earth
-                weighted_mean = np.sum(weighted_mean)
-                row.append(weighted_mean)
-                
-                delFile = subprocess.call("rm tmp.csv", shell=True)
-                if(delFile != 0):
-                    print("Error: Process call failed -- rm")
-            else:
-                print("Error: Process call failed -- ", GRIB2_CMD)
-        # writing to csv file
-        # print(weatherValues)
-        # row.extend(weatherValues) 
-        rows.append(row)
-    with open(outFileName, 'a') as csvfile:
+def getCycleDateTime(cycle):
+    # YYYYMMDDHH --> datetime column of the output files
+    return cycle[:4]+"-"+cycle[4:6]+"-"+cycle[6:8]+" "+cycle[8:10]+":00:00"
+
+def writeCsvFile(fileName, fields, rows):
+    # Written to a temp file & renamed, so that an interrupted run never leaves a partly written file
+    tmpFileName = fileName+"."+str(os.getpid())
+    with open(tmpFileName, "w") as csvfile:
+        csvwriter = csv.DictWriter(csvfile, fieldnames=fields)
+        csvwriter.writeheader()
+        csvwriter.writerows(rows)
+    os.replace(tmpFileName, fileName)
+    return
+
+def appendCsvRows(fileName, rows, fields=None):
+    # fields: rows are dicts. Flushed to disk before returning.
+    with open(fileName, "a") as csvfile:
+        csvwriter = csv.writer(csvfile) if fields is None else csv.DictWriter(csvfile, fieldnames=fields)
+        csvwriter.writerows(rows)
+        csvfile.flush()
+        os.fsync(csvfile.fileno())
+    return
+
+def loadManifest(outFileName, csvFields):
+    # Cycles in the output file: {cycle: manifest entry}. Output rows that are not in the manifest (written by
+    # an interrupted run) & manifest entries without an output row are removed.
+    manifestFileName = outFileName+".manifest.csv"
+    if (os.path.exists(outFileName) == False):
+        writeCsvFile(outFileName, csvFields, [])
+        writeCsvFile(manifestFileName, MANIFEST_FIELDS, [])
+        return {}
+    header, rows = readOutputFile(outFileName)
+    cycles = [getRowCycle(row, len(header)) for row in rows]
+    if (os.path.exists(manifestFileName) == False):
+        # output file of a full run: all of its rows are processed cycles
+        print("No manifest for ", outFileName, ", creating it from the output file")
+        manifest = {cycle: {"cycle": cycle, "num_files": "", "num_filled_files": ""} for cycle in cycles if cycle is not None}
+        writeCsvFile(manifestFileName, MANIFEST_FIELDS, list(manifest.values()))
+        return manifest
+    with open(manifestFileName, "r") as manifestFile:
+        manifestEntries = list(csv.DictReader(manifestFile))
+    cycleSet = set(cycles)
+    manifest = {entry["cycle"]: entry for entry in manifestEntries if entry["cycle"] in cycleSet}
+    if (len(manifest) != len(manifestEntries)):
+        print("Removing ", len(manifestEntries)-len(manifest), " entries without output rows from ", manifestFileName)
+        writeCsvFile(manifestFileName, MANIFEST_FIELDS, list(manifest.values()))
+    keptRows, keptCycles = [], set()
+    for cycle, row in zip(cycles, rows):
+        if (cycle in manifest and cycle not in keptCycles):
+            keptRows.append(row)
+            keptCycles.add(cycle)
+    if (len(keptRows) != len(rows)):
+        print("Removing ", len(rows)-len(keptRows), " unrecorded rows from ", outFileName)
+        writeOutputFile(outFileName, header, keptRows)
+    return manifest
+
+def getRowCycle(row, numFields):
+    # None for rows that were not completely written
+    if (len(row) != numFields or len(row[0]) != 19):
+        return None
+    return row[0][:4]+row[0][5:7]+row[0][8:10]+row[0][11:13]
+
+def readOutputFile(outFileName):
+    with open(outFileName, "r", newline="") as csvfile:
+        rows = list(csv.reader(csvfile))
+    return rows[0], rows[1:]
+
+def writeOutputFile(outFileName, header, rows):
+    # same format as getWeatherData()
+    tmpFileName = outFileName+"."+str(os.getpid())
+    with open(tmpFileName, "w") as csvfile:
         csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(header)
         csvwriter.writerows(rows)
+    os.replace(tmpFileName, outFileName)
+    return
+
+def getIncrementalYears(yearList, manifests):
+    # Years from the first year of yearList (or of the oldest cycle in the manifests) through this year, so that
+    # the cycles issued after the last year of yearList are also picked up
+    firstYear = min([min(yearList)]+[int(cycle[:4]) for manifest in manifests.values() for cycle in manifest])
+    return list(range(firstYear, datetime.date.today().year+1))
+
+def updateRegionWeatherData(fileDir, csvFields, outFileNames, fcstCol, weatherVariable, yearList, regionBoxes):
+    # Incremental mode: extracts the cycles (from the first year of yearList up to today) that are not in the
+    # manifest of all output files ({region: output file}) & appends their rows to the output files that do not
+    # have them.
+    # Cycles with missing lead time files are skipped & listed in <output file>.missing.csv, unless
+    # FILL_MISSING_CYCLES.
+    manifests = {region: loadManifest(outFileName, csvFields) for region, outFileName in outFileNames.items()}
+    pendingCycles = [cycle for cycle in getCycleList(getIncrementalYears(yearList, manifests), datetime.date.today())
+                    if any([cycle not in manifest for manifest in manifests.values()])]
+    print(min([len(manifest) for manifest in manifests.values()]), " cycles already processed, ", len(pendingCycles), " pending")
+    cycleFiles, missingCycles, prevFile = [], [], None
+    for cycle in pendingCycles:
+        files, missingFiles, prevFile = getCycleFiles(fileDir, cycle, fcstCol, prevFile, False)
+        if (len(missingFiles) > 0):
+            missingCycles.append({"cycle": cycle, "missing_files": " ".join(missingFiles)})
+            # cycles without any file of their own are not filled: they may not have been downloaded yet
+            if (FILL_MISSING_CYCLES == False or len(missingFiles) == len(fcstCol) or len(files) != len(fcstCol)):
+                continue
+        cycleFiles.append((cycle, files, len(missingFiles)))
+    for outFileName in outFileNames.values():
+        writeCsvFile(outFileName+".missing.csv", MISSING_CYCLE_FIELDS, missingCycles)
+    if (len(missingCycles) > 0):
+        print(len(missingCycles), " cycles with missing files, see ", outFileName+".missing.csv")
+
+    chunkSize = INCREMENTAL_CHUNK_DAYS*len(HOUR)
+    for chunkStart in range(0, len(cycleFiles), chunkSize):
+        chunk = cycleFiles[chunkStart:chunkStart+chunkSize]
+        dayResults = mapFiles(getDayRows, [(files, weatherVariable, regionBoxes, SAVE_WEATHER_CUBES) for _, files, _ in chunk])
+        for region, outFileName in outFileNames.items():
+            rows, entries, dayCubes = [], [], []
+            for (cycle, files, numFilledFiles), (dayRows, regionDayCubes) in zip(chunk, dayResults):
+                if (cycle in manifests[region]):
+                    continue
+                if (dayRows[region] is None):
+                    print("Error: no data for cycle ", cycle)
+                    continue
+                rows.append([getCycleDateTime(cycle)] + dayRows[region][1:])
+                entries.append({"cycle": cycle, "num_files": len(files), "num_filled_files": numFilledFiles})
+                if (SAVE_WEATHER_CUBES == True and len(regionDayCubes[region][0]) == len(files)):
+                    dayCubes.append((rows[-1][0],)+regionDayCubes[region])
+            # cube & rows first: a cycle is only in the manifest once its row is on disk
+            writeWeatherCube(outFileName, weatherVariable, fcstCol, dayCubes, False)
+            appendCsvRows(outFileName, rows)
+            appendCsvRows(outFileName+".manifest.csv", entries, MANIFEST_FIELDS)
+            print("Appended ", len(rows), " cycles to ", outFileName)
+    for region, outFileName in outFileNames.items():
+        lastCycle = max(manifests[region]) if len(manifests[region]) > 0 else ""
+        if (len(cycleFiles) > 0 and cycleFiles[0][0] < lastCycle):
+            # missing cycles that were filled in are appended after later ones
+            header, rows = readOutputFile(outFileName)
+            writeOutputFile(outFileName, header, sorted(rows, key=lambda row: row[0]))
+    return
+
+def updateWeatherData(fileDir, csvFields, outFileName, fcstCol, weatherVariable, yearList):
+    updateRegionWeatherData(fileDir, csvFields, {None: outFileName}, fcstCol, weatherVariable, yearList, {None: None})
+    return
 
+def extractWeatherData(fileDir, csvFields, outFileNames, fcstCol, weatherVariable, regionBoxes):
+    # outFileNames: {region: output file}, regionBoxes: {region: bounding box (None: the whole grid)}
+    if (INCREMENTAL == True):
+        with instrumentation.stage("updateWeatherData"):
+            updateRegionWeatherData(fileDir, csvFields, outFileNames, fcstCol, weatherVariable, YEARS, regionBoxes)
+        return
+    with instrumentation.stage("getFileList"):
+        fileList = getFileList(YEARS, fileDir, fcstCol=fcstCol)
+    with instrumentation.stage("extractWeatherData"):
+        getRegionWeatherData(fileList, csvFields, outFileNames, fcstCol, weatherVariable, regionBoxes)
     return
 
 def addColumnToCSVFile(fileName, newColName, newColValue):
@@ -211,166 +604,43 @@ def addColumnToCSVFile(fileName, newColName, newColValue):
     dataset.to_csv(fileName)
     return
 
+def getFileWindSpeedStats(fileName):
+    fields = readGribFields(fileName, ["UGRD", "VGRD"])
+    if (fields is None):
+        return None
+    _, _, _, _, lat, lon, _ = fields["UGRD"]
+    windSpeed = spatialReducer.windSpeed(fields["UGRD"][-1], fields["VGRD"][-1])
+    stats = spatialReducer.reduceCube(np.reshape(windSpeed, (1, len(lat), len(lon))), 
+                                    spatialReducer.getAreaWeights(lat, lon))
+    return fields["UGRD"][0], stats["max"][0], stats["sum"][0], stats["mean"][0]
+
 def getWindSpeedAcrossAllRegions(inFileName):
-    maxWindSpeedList = []
-    totalWindSpeedList = []
-    avgWindSpeedList = []
     uWindFileList = None
     if (inFileName is None):
-        uWindFileList = getFileList(2020, "SE/ugrd_vgrd/")
+        uWindFileList = getFileList([2020], "SE/ugrd_vgrd/")
     else:
-        uWindFileList = getFileList(2020, inFileName)
-    # vWindFileList = getFileList(2020, "ds084_1/vGRD/")
-    fileIdx = 0
-    rows = []
-    while fileIdx < len(uWindFileList):
-        row = None
-        # weatherValues = []
-        for i in range(len(FCST)):
-            uval = subprocess.call(GRIB2_CMD + " " + uWindFileList[fileIdx] + " -csv utmp.csv", shell=True)
-            if(uval == 0):
-                vval = 0 #subprocess.call(GRIB2_CMD + " " + vWindFileList[fileIdx] + " -csv vtmp.csv", shell=True)
-                fileIdx+=1
-                if (vval == 0):
-                    udataset = pd.read_csv("utmp.csv", infer_datetime_format=True, 
-                            names=HEADER)
-                    # vdataset = pd.read_csv("vtmp.csv", infer_datetime_format=True, 
-                    #         names=HEADER)
-                    vdataset = udataset[UGRD_VGRD_SEPRATOR[ISO]:]
-                    udataset = udataset[:UGRD_VGRD_SEPRATOR[ISO]]
-                    # if row is None:
-                    #     row = [dataset["startDate"].iloc[cityIdx], dataset["param"].iloc[cityIdx], dataset["level"].iloc[cityIdx],
-                    #                 dataset["latitude"].iloc[cityIdx], dataset["longitude"].iloc[cityIdx]]
-
-                    maxWindSpeed = 0
-                    totalWindSpeed = 0
-                    avgWindSpeed = 0
-                    for j in range(len(udataset)):
-                        u = udataset["value"].iloc[j]
-                        v = vdataset["value"].iloc[j]
-                        windSpeed = math.sqrt(u*u + v*v)
-                        totalWindSpeed +=windSpeed
-                        if  windSpeed> maxWindSpeed:
-                            maxWindSpeed = windSpeed
-                    avgWindSpeed = totalWindSpeed/len(udataset)
-                    maxWindSpeedList.append([udataset["startDate"].iloc[0], maxWindSpeed])
-                    totalWindSpeedList.append([udataset["startDate"].iloc[0], totalWindSpeed])
-                    avgWindSpeedList.append([udataset["startDate"].iloc[0], avgWindSpeed])
-                    # delFile = subprocess.call("rm utmp.csv", shell=True)
-                    # if(delFile != 0):
-                    #     print("Error: Process call failed -- rm")
-                else:
-                    print("Error: Process call failed -- ", GRIB2_CMD)
-            else:
-                print("Error: Process call failed -- ", GRIB2_CMD)
-        # writing to csv file
-        # print(weatherValues)
-        # row.extend(weatherValues) 
-        # rows.append(row)
+        uWindFileList = getFileList([2020], inFileName)
+    results = [result for result in mapFiles(getFileWindSpeedStats, uWindFileList) if result is not None]
+    maxWindSpeedList = [[startDate, maxWindSpeed] for startDate, maxWindSpeed, _, _ in results]
+    totalWindSpeedList = [[startDate, totalWindSpeed] for startDate, _, totalWindSpeed, _ in results]
+    avgWindSpeedList = [[startDate, avgWindSpeed] for startDate, _, _, avgWindSpeed in results]
     return maxWindSpeedList, totalWindSpeedList, avgWindSpeedList
 
+def getFileDSWRFStats(fileName):
+    fields = readGribFields(fileName, ["DSWRF"])
+    if (fields is None):
+        return None
+    startDate, _, _, _, lat, lon, value = fields["DSWRF"]
+    stats = spatialReducer.reduceCube(np.reshape(value, (1, len(lat), len(lon))), 
+                                    spatialReducer.getAreaWeights(lat, lon))
+    return startDate, stats["sum"][0], stats["mean"][0]
+
 def getTotalDWSRFcrossAllRegions():
-    totalWindSpeedList = []
-    avgWindSpeedList = []
-    dswrfFileList = getFileList(2020, "PJM/dswrf/")
-    # vWindFileList = getFileList(2020, "ds084_1/vGRD/")
-    fileIdx = 0
-    rows = []
-    while fileIdx < len(dswrfFileList):
-        row = None
-        # weatherValues = []
-        for i in range(len(FCST)):
-            uval = subprocess.call(GRIB2_CMD + " " + dswrfFileList[fileIdx] + " -csv utmp.csv", shell=True)
-            if(uval == 0):
-                fileIdx+=1
-                udataset = pd.read_csv("utmp.csv", infer_datetime_format=True, 
-                        names=HEADER)
-                totalWindSpeed = np.sum(udataset["value"].values)
-                avgWindSpeed = np.average(udataset["value"].values)
-                totalWindSpeedList.append([udataset["startDate"].iloc[0], totalWindSpeed])
-                avgWindSpeedList.append([udataset["startDate"].iloc[0], avgWindSpeed])
-            else:
-                print("Error: Process call failed -- ", GRIB2_CMD)
-        # writing to csv file
-        # print(weatherValues)
-        # row.extend(weatherValues) 
-        # rows.append(row)
-    return totalWindSpeedList, avgWindSpeedList
-
-def earth_radius(lat):
-    '''
-    calculate radius of Earth assuming oblate spheroid
-    defined by WGS84
-    
-    Input
-    ---------
-    lat: vector or latitudes in degrees  
-    
-    Output
-    ----------
-    r: vector of radius in meters
-    
-    Notes
-    -----------
-    WGS84: https://earth-info.nga.mil/GandG/publications/tr8350.2/tr8350.2-a/Chapter%203.pdf
-    '''
-    from numpy import deg2rad, sin, cos
-
-    # define oblate spheroid from WGS84
-    a = 6378137
-    b = 6356752.3142
-    e2 = 1 - (b**2/a**2)
-    
-    # convert from geodecic to geocentric
-    # see equation 3-110 in WGS84
-    lat = deg2rad(lat)
-    lat_gc = np.arctan( (1-e2)*np.tan(lat) )
-
-    # radius equation
-    # see equation 3-107 in WGS84
-    r = (
-        (a * (1 - e2)**0.5) 
-         / (1 - (e2 * np.cos(lat_gc)**2))**0.5 
-        )
-
-    # print("Earth radius:", r ,len(r))
-    return r
-
-def area_grid(lat, lon):
-    """
-    Calculate the area of each grid cell
-    Area is in square meters
-    
-    Input
-    -----------
-    lat: vector of latitude in degrees
-    lon: vector of longitude in degrees
-    
-    Output
-    -----------
-    area: grid-cell area in square-meters with dimensions, [lat,lon]
-    
-    Notes
-    -----------
-    Based on the function in
-    https://github.com/chadagreene/CDT/blob/master/cdt/cdtarea.m
-    """
-    from numpy import meshgrid, deg2rad, gradient, cos
-    from xarray import DataArray
-
-    xlon, ylat = meshgrid(lon, lat)
-    # print(ylat)
-    R = earth_radius(ylat)
-
-    dlat = deg2rad(gradient(ylat, axis=0))
-    dlon = deg2rad(gradient(xlon, axis=1))
-
-    dy = dlat * R
-    dx = dlon * R * cos(deg2rad(ylat))
-
-    area = dy * dx
-    # print("Area shape: ", area.shape, type(area))
-    return area
+    dswrfFileList = getFileList([2020], "PJM/dswrf/")
+    results = [result for result in mapFiles(getFileDSWRFStats, dswrfFileList) if result is not None]
+    totalDwsrfList = [[startDate, totalDswrf] for startDate, totalDswrf, _ in results]
+    avgDwsrfList = [[startDate, avgDswrf] for startDate, _, avgDswrf in results]
+    return totalDwsrfList, avgDwsrfList
 
 # # maxWindSpeedList, totalWindSpeedList, avgWindSpeedList = getWindSpeedAcrossAllRegions()
 # totalDwsrfList, avgDwsrfList = getTotalDWSRFcrossAllRegions()
@@ -380,59 +650,77 @@ def area_grid(lat, lon):
 
 
 
-for ISO in ISO_LIST:
-    # FILE_DIR = ["../final_weather_data/"+ISO+"/ugrd_vgrd/", #/2019_weather_data
-    #         "../final_weather_data/"+ISO+"/tmp_dpt/",
-    #         "../final_weather_data/"+ISO+"/tmp_dpt/",
-    #         "../final_weather_data/"+ISO+"/dswrf/",
-    #         "../final_weather_data/"+ISO+"/apcp/"]
-
-    # OUT_FILE_NAME_LIST = ["../final_weather_data/"+ISO+"/"+ISO+"_AVG_WIND_SPEED.csv", #/2019_weather_data
-    #                     "../final_weather_data/"+ISO+"/"+ISO+"_AVG_TEMP.csv",
-    #                     "../final_weather_data/"+ISO+"/"+ISO+"_AVG_DPT.csv",
-    #                     "../final_weather_data/"+ISO+"/"+ISO+"_AVG_DSWRF.csv",
-    #                     "../final_weather_data/"+ISO+"/"+ISO+"_AVG_PCP.csv"]
-
-    FILE_DIR = ["../extn/"+ISO+"/weather_data/ugrd_vgrd/",
-            "../extn/"+ISO+"/weather_data/tmp_dpt/",
-            "../extn/"+ISO+"/weather_data/tmp_dpt/",
-            "../extn/"+ISO+"/weather_data/dswrf/",
-            "../extn/"+ISO+"/weather_data/apcp/"]
-
-    OUT_FILE_NAME_LIST = ["../extn/"+ISO+"/weather_data/"+ISO+"_AVG_WIND_SPEED.csv",
-                        "../extn/"+ISO+"/weather_data/"+ISO+"_AVG_TEMP.csv",
-                        "../extn/"+ISO+"/weather_data/"+ISO+"_AVG_DPT.csv",
-                        "../extn/"+ISO+"/weather_data/"+ISO+"_AVG_DSWRF.csv",
-                        "../extn/"+ISO+"/weather_data/"+ISO+"_AVG_PCP.csv"]
-
-    # FILE_DIR = ["../extn/"+ISO+"/weather_data/tmp_dpt/",
-    #         "../extn/"+ISO+"/weather_data/tmp_dpt/"]
+if __name__ == "__main__":
+    if (len(set(sys.argv[1:]) - set(["-i", "-m", "-c"])) > 0):
+        print("Usage: python3 dataCollectionScript.py [-i (incremental)] [-m (all regions from global files)]",
+                "[-c (save weather cubes)]")
+        print("")
+        exit(0)
+    if ("-i" in sys.argv[1:]):
+        INCREMENTAL = True
+    if ("-m" in sys.argv[1:]):
+        MULTI_REGION = True
+    if ("-c" in sys.argv[1:]):
+        SAVE_WEATHER_CUBES = True
+    if (MULTI_REGION == True):
+        regionBoxes = {ISO: REGION_BOUNDING_BOXES[ISO] for ISO in ISO_LIST}
+        print("*******************", ISO_LIST, "from", GLOBAL_FILE_DIR, "*******************")
+        for ISO in ISO_LIST:
+            os.makedirs("../extn/"+ISO+"/weather_data/", exist_ok=True)
+        for outFileSuffix, fileSubDir, weatherVariable, csvFields, fcstCol in WEATHER_OUTPUTS:
+            instrumentation.setLabels(region="all", source=weatherVariable)
+            outFileNames = {ISO: "../extn/"+ISO+"/weather_data/"+ISO+outFileSuffix for ISO in ISO_LIST}
+            print(weatherVariable, ": ", list(outFileNames.values()))
+            extractWeatherData(GLOBAL_FILE_DIR+fileSubDir, csvFields, outFileNames, fcstCol, weatherVariable, regionBoxes)
+    for ISO in (ISO_LIST if MULTI_REGION == False else []):
+        # FILE_DIR = ["../final_weather_data/"+ISO+"/ugrd_vgrd/", #/2019_weather_data
+        #         "../final_weather_data/"+ISO+"/tmp_dpt/",
+        #         "../final_weather_data/"+ISO+"/tmp_dpt/",
+        #         "../final_weather_data/"+ISO+"/dswrf/",
+        #         "../final_weather_data/"+ISO+"/apcp/"]
+
+        # OUT_FILE_NAME_LIST = ["../final_weather_data/"+ISO+"/"+ISO+"_AVG_WIND_SPEED.csv", #/2019_weather_data
+        #                     "../final_weather_data/"+ISO+"/"+ISO+"_AVG_TEMP.csv",
+        #                     "../final_weather_data/"+ISO+"/"+ISO+"_AVG_DPT.csv",
+        #                     "../final_weather_data/"+ISO+"/"+ISO+"_AVG_DSWRF.csv",
+        #                     "../final_weather_data/"+ISO+"/"+ISO+"_AVG_PCP.csv"]
+
+        FILE_DIR = ["../extn/"+ISO+"/weather_data/ugrd_vgrd/",
+                "../extn/"+ISO+"/weather_data/tmp_dpt/",
+                "../extn/"+ISO+"/weather_data/tmp_dpt/",
+                "../extn/"+ISO+"/weather_data/dswrf/",
+                "../extn/"+ISO+"/weather_data/apcp/"]
+
+        OUT_FILE_NAME_LIST = ["../extn/"+ISO+"/weather_data/"+ISO+"_AVG_WIND_SPEED.csv",
+                            "../extn/"+ISO+"/weather_data/"+ISO+"_AVG_TEMP.csv",
+                            "../extn/"+ISO+"/weather_data/"+ISO+"_AVG_DPT.csv",
+                            "../extn/"+ISO+"/weather_data/"+ISO+"_AVG_DSWRF.csv",
+                            "../extn/"+ISO+"/weather_data/"+ISO+"_AVG_PCP.csv"]
+
+        # FILE_DIR = ["../extn/"+ISO+"/weather_data/tmp_dpt/",
+        #         "../extn/"+ISO+"/weather_data/tmp_dpt/"]
             
-    # OUT_FILE_NAME_LIST = ["../extn/"+ISO+"/weather_data/"+ISO+"_AVG_TEMP.csv",
-    #                     "../extn/"+ISO+"/weather_data/"+ISO+"_AVG_DPT.csv"]
-
-    print("*******************", ISO, "*******************")
-    for xx in range(len(OUT_FILE_NAME_LIST)):
-        if ("WIND" in OUT_FILE_NAME_LIST[xx]):
-            fileList = getFileList(YEARS, FILE_DIR[xx], fcstCol=FCST)
-            print("WIND: ", OUT_FILE_NAME_LIST[xx])
-            getWindData(fileList, CSV_FILE_FIELDS_FCST, OUT_FILE_NAME_LIST[xx])
-        else:
-            if ("TEMP" in OUT_FILE_NAME_LIST[xx]):
-                fileList = getFileList(YEARS, FILE_DIR[xx], fcstCol=FCST)
+        # OUT_FILE_NAME_LIST = ["../extn/"+ISO+"/weather_data/"+ISO+"_AVG_TEMP.csv",
+        #                     "../extn/"+ISO+"/weather_data/"+ISO+"_AVG_DPT.csv"]
+
+        print("*******************", ISO, "*******************")
+        for xx in range(len(OUT_FILE_NAME_LIST)):
+            instrumentation.setLabels(region=ISO, source=os.path.basename(OUT_FILE_NAME_LIST[xx]))
+            if ("WIND" in OUT_FILE_NAME_LIST[xx]):
+                print("WIND: ", OUT_FILE_NAME_LIST[xx])
+                extractWeatherData(FILE_DIR[xx], CSV_FILE_FIELDS_FCST, {ISO: OUT_FILE_NAME_LIST[xx]}, FCST, "WIND", {ISO: None})
+            elif ("TEMP" in OUT_FILE_NAME_LIST[xx]):
                 print("TEMP: ", OUT_FILE_NAME_LIST[xx])
-                getWeatherData(fileList, CSV_FILE_FIELDS_FCST, OUT_FILE_NAME_LIST[xx], FCST, "TEMP")
+                extractWeatherData(FILE_DIR[xx], CSV_FILE_FIELDS_FCST, {ISO: OUT_FILE_NAME_LIST[xx]}, FCST, "TEMP", {ISO: None})
             elif ("DPT" in OUT_FILE_NAME_LIST[xx]):
-                fileList = getFileList(YEARS, FILE_DIR[xx], fcstCol=FCST)
                 print("DPT: ", OUT_FILE_NAME_LIST[xx])
-                getWeatherData(fileList, CSV_FILE_FIELDS_FCST, OUT_FILE_NAME_LIST[xx], FCST, "DPT")
+                extractWeatherData(FILE_DIR[xx], CSV_FILE_FIELDS_FCST, {ISO: OUT_FILE_NAME_LIST[xx]}, FCST, "DPT", {ISO: None})
             elif ("DSWRF" in OUT_FILE_NAME_LIST[xx]):
-                fileList = getFileList(YEARS, FILE_DIR[xx], fcstCol=FCST_AVG_ACC)
                 print("DSWRF: ", OUT_FILE_NAME_LIST[xx])
-                getWeatherData(fileList, CSV_FILE_FIELDS_AVG, OUT_FILE_NAME_LIST[xx], FCST_AVG_ACC, "DSWRF")
+                extractWeatherData(FILE_DIR[xx], CSV_FILE_FIELDS_AVG, {ISO: OUT_FILE_NAME_LIST[xx]}, FCST_AVG_ACC, "DSWRF", {ISO: None})
             elif ("PCP" in OUT_FILE_NAME_LIST[xx]):
-                fileList = getFileList(YEARS, FILE_DIR[xx], fcstCol=FCST_AVG_ACC)
                 print("PCP: ", OUT_FILE_NAME_LIST[xx])
-                getWeatherData(fileList, CSV_FILE_FIELDS_ACC, OUT_FILE_NAME_LIST[xx], FCST_AVG_ACC, "PCP")
-    print("*******************", ISO, " done *******************")
+                extractWeatherData(FILE_DIR[xx], CSV_FILE_FIELDS_ACC, {ISO: OUT_FILE_NAME_LIST[xx]}, FCST_AVG_ACC, "PCP", {ISO: None})
+        print("*******************", ISO, " done *******************")
+    instrumentation.writeRunReport(RUN_REPORT_FILE_PREFIX)
 
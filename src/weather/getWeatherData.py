@@ -1,6 +1,67 @@
-import rdams_client as rc
+'''
+Downloads the GFS weather forecasts (ds084.1) from the NCAR RDA with the rdams client
+(https://github.com/NCAR/rda-apps-clients).
+python3 getWeatherData.py: submits one request, from the control file ds084.1_control.ctl.
+python3 getWeatherData.py -b: batch mode. One request is built per (region, variable, period) of
+BATCH_REGIONS, BATCH_VARIABLES & BATCH_START_DATE..BATCH_END_DATE (BATCH_PERIOD_MONTHS per request), from
+the control file. At most MAX_OPEN_REQUESTS requests are open at a time. Their status is polled
+asynchronously, with exponential backoff (POLL_INTERVAL_S..MAX_POLL_INTERVAL_S), & completed requests are
+downloaded (MAX_PARALLEL_DOWNLOADS at a time) into the directories of dataCollectionScript.py
+(<WEATHER_DATA_DIR>/<region>/weather_data/<ugrd_vgrd|tmp_dpt|dswrf|apcp>/), then purged. The request ids
+& the downloaded requests are kept in BATCH_STATE_FILE, so that an interrupted batch is resumed without
+submitting the requests again. Requests that raise an exception (rdams client or network errors) are logged
+& retried after POLL_INTERVAL_S, at most MAX_REQUEST_RETRIES times, without stopping the other requests; a
+submitted request is resumed from its request id.
+The batch functions take the rdams client module as a parameter (client), e.g., to run them against a mock
+of the rdams API.
+'''
+
+import asyncio
+import datetime
+import json
+import os
+import re
+import shutil
+import sys
+
+try:
+    import rdams_client as rc
+except ImportError:
+    rc = None # batch mode can be run with another client
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import dataCollectionScript
 
 dsid = 'ds084.1'
+CONTROL_FILE = "ds084.1_control.ctl"
+
+# MACRO START
+BATCH_REGIONS = ["CISO", "PJM", "ERCO"] # regions of dataCollectionScript.REGION_BOUNDING_BOXES, or "global"
+BATCH_VARIABLES = ["WIND", "TMP_DPT", "DSWRF", "PCP"]
+BATCH_START_DATE = datetime.date(2019, 1, 1)
+BATCH_END_DATE = datetime.date(2021, 12, 31) # inclusive
+BATCH_PERIOD_MONTHS = 3 # months per request
+MAX_OPEN_REQUESTS = 10 # submitted & not yet purged
+MAX_PARALLEL_DOWNLOADS = 4
+POLL_INTERVAL_S = 60 # first status poll of a request, doubled after every poll
+MAX_POLL_INTERVAL_S = 1800
+MAX_REQUEST_RETRIES = 3 # retries of the requests that raised an exception (e.g., a connection error)
+WEATHER_DATA_DIR = "../extn/"
+BATCH_STATE_FILE = "../extn/rda_batch_state.json"
+# MACRO END
+
+GLOBAL_REGION = "global" # no bounding box, files in dataCollectionScript.GLOBAL_FILE_DIR
+FCST_PRODUCTS = "/".join(["Analysis"]+[str(hour)+"-hour Forecast" for hour in range(3, 97, 3)])
+AVG_PRODUCTS = "/".join([str(hours)+"-hour Average (initial+"+str(start)+" to initial+"+str(start+hours)+")" 
+                        for start in range(0, 96, 6) for hours in [3, 6]])
+ACC_PRODUCTS = AVG_PRODUCTS.replace("Average", "Accumulation")
+# batch variable --> RDA parameters, level, products & sub-directory of the GRIB2 files (dataCollectionScript.py)
+RDA_VARIABLES = {"WIND": ("U GRD/V GRD", "HTGL:10", FCST_PRODUCTS, "ugrd_vgrd"),
+                "TMP_DPT": ("TMP/DPT", "HTGL:2", FCST_PRODUCTS, "tmp_dpt"),
+                "DSWRF": ("DSWRF", "SFC:0", AVG_PRODUCTS, "dswrf"),
+                "PCP": ("A PCP", "SFC:0", ACC_PRODUCTS, "apcp")}
+RDA_COMPLETED_STATUS = "Completed"
+GRIB_FILE_NAME_PATTERN = re.compile(re.escape(dataCollectionScript.FILE_PREFIX)+r"\d{10}\.f\d{3}\.grib2")
 
 
 def getSeriesParams(dsid):
@@ -87,10 +148,174 @@ def submitDataRequest(template_dict):
     print("Success!")
     return response
 
-# param_map = getSeriesParams(dsid)
-# print(param_map)
-# getSeriesMetadata(dsid)
-template_dict = getTemplateFile(dsid)
-for k,v in template_dict.items():
-    print(k, ": ", v)
-response = submitDataRequest(template_dict)
\ No newline at end of file
+def getResponseData(response):
+    # newer versions of the rdams API return the data in "data", older ones in "result"
+    return response["data"] if "data" in response else response["result"]
+
+def getPeriods(startDate, endDate, periodMonths):
+    # [(first day, last day)] of periodMonths months (the last one ends at endDate)
+    periods = []
+    periodStart = startDate
+    while (periodStart <= endDate):
+        monthIdx = periodStart.month - 1 + periodMonths
+        nextStart = datetime.date(periodStart.year + monthIdx//12, monthIdx%12 + 1, 1)
+        periods.append((periodStart, min(nextStart - datetime.timedelta(days=1), endDate)))
+        periodStart = nextStart
+    return periods
+
+def getRegionFileDir(region, variable):
+    # GRIB2 file directory of dataCollectionScript.py
+    subDir = RDA_VARIABLES[variable][3]
+    return os.path.join(WEATHER_DATA_DIR, region, "weather_data", subDir)
+
+def getCycleRange(periodStart, periodEnd):
+    # RDA date range of the GFS cycles of the period that dataCollectionScript.py extracts (HOUR), e.g.,
+    # 201901010000/to/201903310000 for the 00 UTC cycles only
+    return (periodStart.strftime("%Y%m%d")+min(dataCollectionScript.HOUR)+"00/to/"+
+            periodEnd.strftime("%Y%m%d")+max(dataCollectionScript.HOUR)+"00")
+
+def getBatchRequests(templateDict, regions, variables, startDate, endDate, periodMonths):
+    # [(key, control dict, target dir)], one per (region, variable, period)
+    requests = []
+    for region in regions:
+        for variable in variables:
+            param, level, product, _ = RDA_VARIABLES[variable]
+            for periodStart, periodEnd in getPeriods(startDate, endDate, periodMonths):
+                control = dict(templateDict, dataset=dsid, datetype="init", param=param, level=level, product=product,
+                                date=getCycleRange(periodStart, periodEnd))
+                for key in ["nlat", "slat", "wlon", "elon"]:
+                    control.pop(key, None)
+                if (region != GLOBAL_REGION):
+                    nlat, slat, wlon, elon = dataCollectionScript.REGION_BOUNDING_BOXES[region]
+                    control.update(nlat=nlat, slat=slat, wlon=wlon, elon=elon)
+                requests.append((region+"_"+variable+"_"+periodStart.strftime("%Y%m%d"), control, 
+                                getRegionFileDir(region, variable)))
+    return requests
+
+def loadBatchState(stateFileName):
+    # {request key: {"request_id": RDA request id, "status": "submitted"/"downloaded"}}
+    if (os.path.exists(stateFileName) == False):
+        return {}
+    with open(stateFileName, "r") as stateFile:
+        return json.load(stateFile)
+
+def saveBatchState(stateFileName, state):
+    os.makedirs(os.path.dirname(stateFileName) or ".", exist_ok=True)
+    tmpFileName = stateFileName+"."+str(os.getpid())
+    with open(tmpFileName, "w") as stateFile:
+        json.dump(state, stateFile, indent=1)
+    os.replace(tmpFileName, stateFileName)
+    return
+
+def downloadRequest(client, requestId, targetDir):
+    # Downloads the files of the request to a staging directory & moves them to targetDir, named as
+    # expected by dataCollectionScript.py (gfs.0p25.<cycle>.f<lead time>.grib2). Returns the no. of files.
+    stagingDir = os.path.join(targetDir, ".rda_"+str(requestId))
+    os.makedirs(stagingDir, exist_ok=True)
+    client.download(requestId, stagingDir)
+    numFiles = 0
+    for dirPath, _, fileNames in os.walk(stagingDir):
+        for fileName in fileNames:
+            match = GRIB_FILE_NAME_PATTERN.search(fileName)
+            os.replace(os.path.join(dirPath, fileName), os.path.join(targetDir, match.group(0) if match else fileName))
+            numFiles += 1
+    shutil.rmtree(stagingDir)
+    return numFiles
+
+async def pollRequest(client, requestId):
+    # Polls the status of the request until it is completed or failed, with exponential backoff
+    interval = POLL_INTERVAL_S
+    while True:
+        status = getResponseData(await asyncio.to_thread(client.get_status, requestId))["status"]
+        if (status == RDA_COMPLETED_STATUS or "error" in status.lower() or "purge" in status.lower()):
+            return status
+        await asyncio.sleep(interval)
+        interval = min(interval*2, MAX_POLL_INTERVAL_S)
+
+async def runRequest(client, key, control, targetDir, state, stateFileName, openRequests, downloads):
+    entry = state.get(key, {})
+    if (entry.get("status") == "downloaded"):
+        return "downloaded"
+    async with openRequests:
+        if ("request_id" not in entry):
+            response = await asyncio.to_thread(client.submit_json, control)
+            if (response.get("code") != 200):
+                print(key, ": submission failed: ", response)
+                return "failed"
+            entry = {"request_id": getResponseData(response)["request_id"], "status": "submitted"}
+            state[key] = entry
+            saveBatchState(stateFileName, state)
+            print(key, ": submitted, request ", entry["request_id"])
+        status = await pollRequest(client, entry["request_id"])
+        if (status != RDA_COMPLETED_STATUS):
+            print(key, ": request ", entry["request_id"], " ", status, ", it will be submitted again on the next run")
+            if ("purge" not in status.lower()):
+                await asyncio.to_thread(client.purge_request, entry["request_id"])
+            del state[key]
+            saveBatchState(stateFileName, state)
+            return "failed"
+        async with downloads:
+            os.makedirs(targetDir, exist_ok=True)
+            numFiles = await asyncio.to_thread(downloadRequest, client, entry["request_id"], targetDir)
+        await asyncio.to_thread(client.purge_request, entry["request_id"])
+    entry["status"] = "downloaded"
+    saveBatchState(stateFileName, state)
+    print(key, ": ", numFiles, " files downloaded to ", targetDir)
+    return "downloaded"
+
+async def runBatchRequests(client, requests, stateFileName):
+    state = loadBatchState(stateFileName)
+    openRequests, downloads = asyncio.Semaphore(MAX_OPEN_REQUESTS), asyncio.Semaphore(MAX_PARALLEL_DOWNLOADS)
+    statuses, pendingRequests = {}, requests
+    for attempt in range(MAX_REQUEST_RETRIES+1):
+        if (attempt > 0):
+            print("Retrying ", len(pendingRequests), " requests (", attempt, "/", MAX_REQUEST_RETRIES, ")")
+            await asyncio.sleep(POLL_INTERVAL_S)
+        results = await asyncio.gather(*[runRequest(client, key, control, targetDir, state, stateFileName, openRequests,
+                                                    downloads) for key, control, targetDir in pendingRequests],
+                                        return_exceptions=True)
+        failedRequests = []
+        for request, result in zip(pendingRequests, results):
+            if (isinstance(result, Exception)):
+                print(request[0], ": error: ", repr(result))
+                statuses[request[0]] = "failed"
+                failedRequests.append(request)
+            else:
+                statuses[request[0]] = result
+        pendingRequests = failedRequests
+        if (len(pendingRequests) == 0):
+            break
+    return {key: statuses[key] for key, _, _ in requests}
+
+def runBatch(client=None, regions=None, variables=None, stateFileName=None):
+    # Returns {request key: "downloaded"/"failed"}
+    client = rc if client is None else client
+    requests = getBatchRequests(client.read_control_file(control_file=CONTROL_FILE), 
+                                BATCH_REGIONS if regions is None else regions,
+                                BATCH_VARIABLES if variables is None else variables,
+                                BATCH_START_DATE, BATCH_END_DATE, BATCH_PERIOD_MONTHS)
+    print(len(requests), " requests, at most ", MAX_OPEN_REQUESTS, " open at a time")
+    statuses = asyncio.run(runBatchRequests(client, requests, BATCH_STATE_FILE if stateFileName is None else stateFileName))
+    failedKeys = [key for key, status in statuses.items() if status != "downloaded"]
+    print(len(statuses)-len(failedKeys), " requests downloaded, ", len(failedKeys), " failed: ", failedKeys)
+    return statuses
+
+
+if __name__ == "__main__":
+    if (rc is None):
+        print("rdams_client not found: add rda-apps-clients/src/python to the PYTHONPATH")
+        exit(1)
+    if (len(sys.argv) > 1 and sys.argv[1] == "-b"):
+        statuses = runBatch()
+        exit(0 if all([status == "downloaded" for status in statuses.values()]) else 1)
+    elif (len(sys.argv) > 1):
+        print("Usage: python3 getWeatherData.py [-b (batch)]")
+        print("")
+        exit(0)
+    # param_map = getSeriesParams(dsid)
+    # print(param_map)
+    # getSeriesMetadata(dsid)
+    template_dict = getTemplateFile(dsid)
+    for k,v in template_dict.items():
+        print(k, ": ", v)
+    response = submitDataRequest(template_dict)
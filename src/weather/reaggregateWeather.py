@@ -0,0 +1,107 @@
+'''
+Computes new aggregations of the weather forecasts of a region from its weather cube (weatherCube.py), without
+decoding the GRIB2 files again. The cubes are saved by dataCollectionScript.py (SAVE_WEATHER_CUBES = True, or -c).
+Usage: python3 reaggregateWeather.py <ISO> <weather variable> <statistic> <output file> [<weights file>]
+    weather variable: WIND, TEMP, DPT, DSWRF or PCP
+    statistic: weighted_mean, mean, max or sum (over the grid cells of the region)
+    weights file (weighted_mean only; default: the area weights, as in dataCollectionScript.py):
+        .npy: [lat, lon] mask on the grid of the cube (lat south to north, lon west to east), multiplied with
+            the area weights, e.g., a land mask or the share of each grid cell in the region
+        .csv: sites with latitude, longitude & weight columns, e.g., wind or solar farms & their capacity.
+            The weight of a site goes to the nearest grid cell.
+The output file has the same format as the <ISO>_AVG_*.csv files of dataCollectionScript.py.
+'''
+
+import csv
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import dataCollectionScript
+import spatialReducer
+import weatherCube
+
+WEATHER_DATA_DIR = "../extn/"
+CHUNK_ISSUE_TIMES = 64 # issue times reduced at a time
+
+
+def getCubeFileName(iso, weatherVariable):
+    return os.path.join(WEATHER_DATA_DIR, iso, "weather_data", "cubes", weatherVariable+".cube")
+
+def getSiteWeights(sitesFileName, lat, lon):
+    # Weight of each site (latitude, longitude, weight columns) in its nearest grid cell
+    sites = pd.read_csv(sitesFileName)
+    weights = np.zeros((len(lat), len(lon)))
+    latStep = np.abs(lat[1]-lat[0]) if len(lat) > 1 else 0
+    lonStep = np.abs(lon[1]-lon[0]) if len(lon) > 1 else 0
+    for siteLat, siteLon, siteWeight in zip(sites["latitude"], sites["longitude"], sites["weight"]):
+        latDist = np.abs(lat - siteLat)
+        lonDist = np.abs((lon - siteLon + 180) % 360 - 180)
+        latIdx, lonIdx = np.argmin(latDist), np.argmin(lonDist)
+        if (latDist[latIdx] > latStep/2+1e-6 or lonDist[lonIdx] > lonStep/2+1e-6):
+            print("Site (", siteLat, ", ", siteLon, ") is outside the grid, skipped")
+            continue
+        weights[latIdx, lonIdx] += siteWeight
+    return weights
+
+def getWeights(weightsFileName, lat, lon):
+    # Normalized [lat, lon] weights: the area weights, optionally multiplied with a mask (.npy), or site weights (.csv)
+    areaWeights = spatialReducer.getAreaWeights(lat, lon)
+    if (weightsFileName is None):
+        return areaWeights
+    if (weightsFileName.endswith(".npy")):
+        mask = np.load(weightsFileName)
+        if (mask.shape != areaWeights.shape):
+            raise ValueError(weightsFileName+": mask shape "+str(mask.shape)+" != grid shape "+str(areaWeights.shape))
+        weights = areaWeights * mask
+    elif (weightsFileName.endswith(".csv")):
+        weights = getSiteWeights(weightsFileName, lat, lon)
+    else:
+        raise ValueError(weightsFileName+": weights file must be .npy or .csv")
+    if (np.sum(weights) <= 0):
+        raise ValueError(weightsFileName+": the weights of the grid cells sum to 0")
+    return weights / np.sum(weights)
+
+def reaggregate(cube, statistic, weights):
+    # cube: [issue time, lead time, lat, lon] --> [issue time, lead time]
+    values = np.zeros(cube.shape[:2])
+    for start in range(0, len(cube), CHUNK_ISSUE_TIMES):
+        chunk = np.asarray(cube[start:start+CHUNK_ISSUE_TIMES], dtype=np.float64)
+        chunkValues = spatialReducer.reduceCube(np.reshape(chunk, (-1,)+cube.shape[2:]), weights, [statistic])[statistic]
+        values[start:start+len(chunk)] = np.reshape(chunkValues, (len(chunk), cube.shape[1]))
+    return values
+
+def reaggregateWeather(iso, weatherVariable, statistic, outFileName, weightsFileName=None):
+    if (statistic not in spatialReducer.STATISTICS):
+        raise ValueError("Unknown statistic: "+statistic)
+    if (weightsFileName is not None and statistic != "weighted_mean"):
+        raise ValueError("A weights file can only be used with weighted_mean")
+    csvFields = {outputVariable: fields for _, _, outputVariable, fields, _ in dataCollectionScript.WEATHER_OUTPUTS}
+    metadata, cube = weatherCube.loadCube(getCubeFileName(iso, weatherVariable))
+    lat, lon = np.array(metadata["lat"]), np.array(metadata["lon"])
+    print(iso, weatherVariable, ": ", cube.shape[0], " issue times, ", cube.shape[1], " lead times, grid: ",
+            cube.shape[2], "x", cube.shape[3])
+    values = reaggregate(cube, statistic, getWeights(weightsFileName, lat, lon))
+    print("Writing ", outFileName, "...")
+    with open(outFileName, "w") as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(csvFields[weatherVariable])
+        for idx in np.argsort(metadata["issue_times"], kind="stable"):
+            csvwriter.writerow([metadata["issue_times"][idx], metadata["param"], metadata["level"],
+                                lat[0], lon[0]] + values[idx].tolist())
+    return values
+
+
+if __name__ == "__main__":
+    if (len(sys.argv) not in [5, 6]):
+        print("Usage: python3 reaggregateWeather.py <ISO> <WIND/TEMP/DPT/DSWRF/PCP> "+
+                "<weighted_mean/mean/max/sum> <output file> [<weights file (.npy/.csv)>]")
+        print("")
+        exit(0)
+    startTime = time.time()
+    reaggregateWeather(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5] if len(sys.argv) == 6 else None)
+    print("Done in ", round(time.time()-startTime, 2), " s")
@@ -0,0 +1,128 @@
+'''
+Spatial reduction of gridded weather forecasts.
+Fields are reduced as (lead time, lat, lon) cubes, i.e., all lead times of a day at once: area
+weighted mean, plain mean, max & sum over the grid, per lead time.
+The area weights of a grid are computed once per bounding box & cached in memory & on disk (in
+AREA_WEIGHT_CACHE_DIR).
+This file uses the code from https://towardsdatascience.com/the-correct-way-to-average-the-globe-92ceecd172b7 
+for the below two functions:
+    earth_radius()
+    area_grid()
+'''
+
+import os
+
+import numpy as np
+
+AREA_WEIGHT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", 
+                                        "area_weight_cache")
+
+AREA_WEIGHTS = {} # (bounding box, grid size) --> area weights, normalized to sum to 1
+STATISTICS = ["weighted_mean", "mean", "max", "sum"]
+
+
+def getGridKey(lat, lon):
+    return (round(float(lat[0]), 6), round(float(lat[-1]), 6), len(lat), 
+            round(float(lon[0]), 6), round(float(lon[-1]), 6), len(lon))
+
+def getAreaWeights(lat, lon):
+    # lat, lon: grid axes (ascending). Returns the [lat, lon] area weights of the grid cells, summing to 1.
+    gridKey = getGridKey(lat, lon)
+    if (gridKey in AREA_WEIGHTS):
+        return AREA_WEIGHTS[gridKey]
+    cacheFileName = os.path.join(AREA_WEIGHT_CACHE_DIR, "area_weights_"+"_".join([str(val) for val in gridKey])+".npy")
+    if (os.path.exists(cacheFileName)):
+        areaWeights = np.load(cacheFileName)
+    else:
+        grid_cell_area = area_grid(lat, lon)
+        areaWeights = grid_cell_area / np.sum(grid_cell_area)
+        os.makedirs(AREA_WEIGHT_CACHE_DIR, exist_ok=True)
+        tmpCacheFileName = cacheFileName[:-len(".npy")]+"_"+str(os.getpid())+".npy"
+        np.save(tmpCacheFileName, areaWeights)
+        os.replace(tmpCacheFileName, cacheFileName)
+    AREA_WEIGHTS[gridKey] = areaWeights
+    return areaWeights
+
+def windSpeed(u, v):
+    return np.sqrt(np.square(u) + np.square(v))
+
+def reduceCube(cube, areaWeights, statistics=STATISTICS):
+    # cube: [lead times, lat, lon] --> {statistic: [lead times]}
+    flatCube = np.reshape(cube, (len(cube), -1))
+    statFuncs = {"weighted_mean": lambda: flatCube @ np.ravel(areaWeights), "mean": lambda: np.mean(flatCube, axis=1),
+                "max": lambda: np.max(flatCube, axis=1), "sum": lambda: np.sum(flatCube, axis=1)}
+    return {statistic: statFuncs[statistic]() for statistic in statistics}
+
+def earth_radius(lat):
+    '''
+    calculate radius of Earth assuming oblate spheroid
+    defined by WGS84
+    
+    Input
+    ---------
+    lat: vector or latitudes in degrees  
+    
+    Output
+    ----------
+    r: vector of radius in meters
+    
+    Notes
+    -----------
+    WGS84: https://earth-info.nga.mil/GandG/publications/tr8350.2/tr8350.2-a/Chapter%203.pdf
+    '''
+    from numpy import deg2rad, sin, cos
+
+    # define oblate spheroid from WGS84
+    a = 6378137
+    b = 6356752.3142
+    e2 = 1 - (b**2/a**2)
+    
+    # convert from geodecic to geocentric
+    # see equation 3-110 in WGS84
+    lat = deg2rad(lat)
+    lat_gc = np.arctan( (1-e2)*np.tan(lat) )
+
+    # radius equation
+    # see equation 3-107 in WGS84
+    r = (
+        (a * (1 - e2)**0.5) 
+         / (1 - (e2 * np.cos(lat_gc)**2))**0.5 
+        )
+
+    # print("Earth radius:", r ,len(r))
+    return r
+
+def area_grid(lat, lon):
+    """
+    Calculate the area of each grid cell
+    Area is in square meters
+    
+    Input
+    -----------
+    lat: vector of latitude in degrees
+    lon: vector of longitude in degrees
+    
+    Output
+    -----------
+    area: grid-cell area in square-meters with dimensions, [lat,lon]
+    
+    Notes
+    -----------
+    Based on the function in
+    https://github.com/chadagreene/CDT/blob/master/cdt/cdtarea.m
+    """
+    from numpy import meshgrid, deg2rad, gradient, cos
+
+    xlon, ylat = meshgrid(lon, lat)
+    # print(ylat)
+    R = earth_radius(ylat)
+
+    dlat = deg2rad(gradient(ylat, axis=0))
+    dlon = deg2rad(gradient(xlon, axis=1))
+
+    dy = dlat * R
+    dx = dlon * R * cos(deg2rad(ylat))
+
+    area = dy * dx
+    # print("Area shape: ", area.shape, type(area))
+    return area
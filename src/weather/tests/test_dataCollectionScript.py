@@ -0,0 +1,141 @@
+'''
+The wgrib2 & eccodes backends of dataCollectionScript.py must produce the same output rows.
+data/gfs.0p25.2020010100.f003.grib2: TMP, UGRD & VGRD on a small 0.25 degree GFS-like grid, scanned north
+to south (jScansPositively = 0) like the GFS files, with fields that grow from north to south.
+data/<file>.wgrib2.csv: the rows written by "wgrib2 <file> -csv -" (we:sn order), used if wgrib2 is not
+installed (GRIB2_CMD). Without eccodes, the eccodes backend decodes the messages with FakeEccodes instead.
+Run from the repo root: python3 -m unittest discover -s src/weather/tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import dataCollectionScript
+import spatialReducer
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+GRIB_FILE_NAME = "gfs.0p25.2020010100.f003.grib2"
+REGION_BOXES = {None: None, "box": (59.5, 58.5, -9.75, -9.0)}
+
+
+def readRecordedGribCsv(fileName, entries):
+    params = [entry["param"] for entry in entries]
+    dataset = pd.read_csv(os.path.join(DATA_DIR, GRIB_FILE_NAME+".wgrib2.csv"), names=dataCollectionScript.HEADER)
+    return dataset[dataset["param"].isin(params)]
+
+
+class FakeEccodes:
+    # The eccodes functions used by readGribMessages. The messages of the fixture are "decoded" from the
+    # recorded wgrib2 rows (we:sn) & scanned north to south (jScansPositively = 0), like the GFS files.
+    def __init__(self, fileName):
+        dataset = pd.read_csv(os.path.join(DATA_DIR, GRIB_FILE_NAME+".wgrib2.csv"), names=dataCollectionScript.HEADER)
+        self.messages, self.handles = {}, {}
+        with open(fileName, "rb") as gribFile:
+            for entry in dataCollectionScript.buildInventory(fileName):
+                gribFile.seek(entry["offset"])
+                paramDataset = dataset[dataset["param"] == entry["param"]]
+                lat, lon = np.unique(paramDataset["latitude"].values), np.unique(paramDataset["longitude"].values)
+                startDate = paramDataset["startDate"].iloc[0]
+                self.messages[gribFile.read(entry["length"])] = {
+                    "dataDate": int(startDate[:10].replace("-", "")), "dataTime": int(startDate[11:13])*100,
+                    "gridType": "regular_ll", "jScansPositively": 0, "Nj": len(lat), "Ni": len(lon),
+                    "latitudeOfFirstGridPointInDegrees": lat[-1], "latitudeOfLastGridPointInDegrees": lat[0],
+                    "longitudeOfFirstGridPointInDegrees": lon[0], "longitudeOfLastGridPointInDegrees": lon[-1],
+                    "values": np.reshape(paramDataset["value"].values, (len(lat), len(lon)))[::-1].ravel()}
+
+    def codes_new_from_message(self, message):
+        gid = len(self.handles)+1
+        self.handles[gid] = self.messages[message]
+        return gid
+
+    def codes_get(self, gid, key):
+        return self.handles[gid][key]
+
+    def codes_get_values(self, gid):
+        return self.handles[gid]["values"].copy()
+
+    def codes_get_array(self, gid, key):
+        raise KeyError(key) # regular_ll grids only
+
+    def codes_release(self, gid):
+        del self.handles[gid]
+
+
+class TestGribBackends(unittest.TestCase):
+    def setUp(self):
+        try:
+            import eccodes
+        except ImportError:
+            self.skipTest("eccodes is not installed")
+        self.startPatches()
+
+    def startPatches(self):
+        self.tmpDir = tempfile.mkdtemp()
+        # the inventory & area weights are cached on disk: keep them out of the repo
+        self.fileName = os.path.join(self.tmpDir, GRIB_FILE_NAME)
+        shutil.copy(os.path.join(DATA_DIR, GRIB_FILE_NAME), self.fileName)
+        self.patches = [mock.patch.object(spatialReducer, "AREA_WEIGHT_CACHE_DIR", self.tmpDir),
+                        mock.patch.dict(spatialReducer.AREA_WEIGHTS, clear=True)]
+        if (shutil.which(dataCollectionScript.GRIB2_CMD) is None):
+            self.patches.append(mock.patch.object(dataCollectionScript, "readGribCsv", readRecordedGribCsv))
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.tmpDir)
+
+    def getDayRows(self, backend, weatherVariable):
+        with mock.patch.object(dataCollectionScript, "GRIB_BACKEND", backend):
+            return dataCollectionScript.getDayRows(([self.fileName], weatherVariable, REGION_BOXES, False))[0]
+
+    def testSameRows(self):
+        for weatherVariable in ["TEMP", "WIND"]:
+            wgrib2Rows = self.getDayRows("wgrib2", weatherVariable)
+            eccodesRows = self.getDayRows("eccodes", weatherVariable)
+            for region in REGION_BOXES:
+                with self.subTest(weatherVariable=weatherVariable, region=region):
+                    # header: start date, param, level & first grid point (the southernmost latitude)
+                    self.assertEqual(wgrib2Rows[region][:3], eccodesRows[region][:3])
+                    np.testing.assert_allclose(wgrib2Rows[region][3:5], eccodesRows[region][3:5])
+                    np.testing.assert_allclose(wgrib2Rows[region][5:], eccodesRows[region][5:], rtol=1e-5)
+
+    def testFirstGridPoint(self):
+        eccodesRows = self.getDayRows("eccodes", "TEMP")
+        self.assertAlmostEqual(eccodesRows[None][3], 58)
+        self.assertAlmostEqual(eccodesRows["box"][3], 58.5)
+
+
+class TestMockedEccodes(TestGribBackends):
+    # The same checks with the messages decoded by FakeEccodes (no eccodes needed)
+    def setUp(self):
+        self.startPatches()
+        self.patches.append(mock.patch.dict(sys.modules, {"eccodes": FakeEccodes(self.fileName)}))
+        self.patches[-1].start()
+
+    def testLatitudeOrder(self):
+        params = dataCollectionScript.WEATHER_VARIABLE_PARAMS["WIND"]
+        with mock.patch.object(dataCollectionScript, "GRIB_BACKEND", "wgrib2"):
+            wgrib2Fields = dataCollectionScript.readGribFields(self.fileName, params)
+        with mock.patch.object(dataCollectionScript, "GRIB_BACKEND", "eccodes"):
+            eccodesFields = dataCollectionScript.readGribFields(self.fileName, params)
+        for param in params:
+            with self.subTest(param=param):
+                # the messages start at the northernmost row, the fields at the southernmost one (we:sn)
+                self.assertEqual(eccodesFields[param][2], wgrib2Fields[param][2])
+                self.assertEqual(eccodesFields[param][2], eccodesFields[param][4][0])
+                np.testing.assert_array_equal(eccodesFields[param][4], wgrib2Fields[param][4])
+                np.testing.assert_array_equal(eccodesFields[param][6], wgrib2Fields[param][6])
+
+
+if __name__ == "__main__":
+    unittest.main()
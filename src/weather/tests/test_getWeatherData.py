@@ -0,0 +1,166 @@
+'''
+Batch mode of getWeatherData.py against a mock of the rdams client (no RDA account or network needed).
+Run from the repo root: python3 -m unittest discover -s src/weather/tests
+'''
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import getWeatherData
+
+
+class MockRdamsClient:
+    # The rdams_client functions used by the batch mode. Requests are completed after NUM_QUEUED_POLLS status
+    # polls; the first submission of each (date in failDates, region) ends with an error instead. The first
+    # numRaises status polls of the requests of raiseDates raise a ConnectionError.
+    NUM_QUEUED_POLLS = 2
+
+    def __init__(self, failDates=(), raiseDates=(), numRaises=1):
+        self.lock = threading.Lock()
+        self.controls, self.polls, self.purged, self.failing = {}, {}, set(), set()
+        self.failDates, self.submitted = set(failDates), set()
+        self.raiseDates, self.numRaises, self.raised = set(raiseDates), numRaises, {}
+        self.numOpen, self.maxOpen, self.numDownloads, self.maxDownloads = 0, 0, 0, 0
+
+    def read_control_file(self, control_file):
+        return {"dataset": "ds084.1", "date": "202112010000/to/202201310000", "datetype": "init",
+                "param": "A PCP", "level": "SFC:0", "nlat": -8.75, "slat": -29.75, "wlon": 137.50, "elon": 154,
+                "targetdir": "/glade/scratch"}
+
+    def submit_json(self, control):
+        with self.lock:
+            requestId = len(self.controls)+1
+            self.controls[requestId], self.polls[requestId] = control, 0
+            submission = (control["date"][:8], control.get("nlat"))
+            if (submission[0] in self.failDates and submission not in self.submitted):
+                self.failing.add(requestId)
+            self.submitted.add(submission)
+            self.numOpen += 1
+            self.maxOpen = max(self.maxOpen, self.numOpen)
+        return {"code": 200, "data": {"request_id": requestId}}
+
+    def get_status(self, requestId):
+        with self.lock:
+            self.polls[requestId] += 1
+            if (self.controls[requestId]["date"][:8] in self.raiseDates and
+                self.raised.get(requestId, 0) < self.numRaises):
+                self.raised[requestId] = self.raised.get(requestId, 0) + 1
+                raise ConnectionError("connection reset")
+            if (requestId in self.failing):
+                return {"data": {"status": "Error"}}
+            if (self.polls[requestId] <= self.NUM_QUEUED_POLLS):
+                return {"data": {"status": "Queued for Processing"}}
+        return {"data": {"status": getWeatherData.RDA_COMPLETED_STATUS}}
+
+    def download(self, requestId, outDir):
+        with self.lock:
+            self.numDownloads += 1
+            self.maxDownloads = max(self.maxDownloads, self.numDownloads)
+        time.sleep(0.02)
+        firstDay = datetime.datetime.strptime(self.controls[requestId]["date"][:8], "%Y%m%d")
+        for fcst in ["000", "003"]:
+            fileName = "gfs.0p25."+firstDay.strftime("%Y%m%d")+"00.f"+fcst+".grib2.user"+str(requestId)+".grib2"
+            with open(os.path.join(outDir, fileName), "w") as gribFile:
+                gribFile.write("GRIB")
+        with self.lock:
+            self.numDownloads -= 1
+
+    def purge_request(self, requestId):
+        with self.lock:
+            self.purged.add(requestId)
+            self.numOpen -= 1
+
+
+class TestBatchRequests(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.stateFileName = os.path.join(self.tmpDir, "rda_batch_state.json")
+        self.patches = [mock.patch.multiple(getWeatherData, WEATHER_DATA_DIR=self.tmpDir, MAX_OPEN_REQUESTS=3,
+                                            MAX_PARALLEL_DOWNLOADS=2, POLL_INTERVAL_S=0.001, MAX_POLL_INTERVAL_S=0.004,
+                                            BATCH_START_DATE=datetime.date(2019, 1, 1),
+                                            BATCH_END_DATE=datetime.date(2019, 12, 31), BATCH_PERIOD_MONTHS=1)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.tmpDir)
+
+    def runBatch(self, client):
+        with mock.patch("builtins.print"):
+            return getWeatherData.runBatch(client, ["CISO", "global"], ["WIND"], self.stateFileName)
+
+    def testCycleRange(self):
+        client = MockRdamsClient()
+        requests = getWeatherData.getBatchRequests(client.read_control_file(getWeatherData.CONTROL_FILE), ["CISO"],
+                                                ["PCP"], datetime.date(2019, 1, 1), datetime.date(2019, 6, 30), 3)
+        self.assertEqual([control["date"] for _, control, _ in requests],
+                        ["201901010000/to/201903310000", "201904010000/to/201906300000"])
+        with mock.patch.object(getWeatherData.dataCollectionScript, "HOUR", ["00", "12"]):
+            self.assertEqual(getWeatherData.getCycleRange(datetime.date(2019, 1, 1), datetime.date(2019, 3, 31)),
+                            "201901010000/to/201903311200")
+
+    def testBoundedConcurrency(self):
+        client = MockRdamsClient()
+        statuses = self.runBatch(client)
+        self.assertEqual(len(statuses), 24)
+        self.assertTrue(all([status == "downloaded" for status in statuses.values()]))
+        self.assertEqual(client.maxOpen, getWeatherData.MAX_OPEN_REQUESTS)
+        self.assertLessEqual(client.maxDownloads, getWeatherData.MAX_PARALLEL_DOWNLOADS)
+        self.assertEqual(client.purged, set(client.controls))
+        # files renamed as expected by dataCollectionScript.py
+        self.assertEqual(sorted(os.listdir(getWeatherData.getRegionFileDir("CISO", "WIND")))[:2],
+                        ["gfs.0p25.2019010100.f000.grib2", "gfs.0p25.2019010100.f003.grib2"])
+        # nothing is submitted again once downloaded
+        self.assertEqual(self.runBatch(client), statuses)
+        self.assertEqual(len(client.controls), 24)
+
+    def testResubmissionAfterFailure(self):
+        client = MockRdamsClient(failDates=["20190301"])
+        statuses = self.runBatch(client)
+        failedKeys = sorted([key for key, status in statuses.items() if status == "failed"])
+        self.assertEqual(failedKeys, ["CISO_WIND_20190301", "global_WIND_20190301"])
+        # failed requests are purged & dropped from the state, so they are submitted again on the next run
+        self.assertEqual(client.purged, set(client.controls))
+        self.assertEqual(client.numOpen, 0)
+        statuses = self.runBatch(client)
+        self.assertTrue(all([status == "downloaded" for status in statuses.values()]))
+        self.assertEqual(len(client.controls), 26)
+        self.assertEqual(sorted([control["date"][:8] for control in list(client.controls.values())[24:]]),
+                        ["20190301", "20190301"])
+
+    def testRetryAfterException(self):
+        client = MockRdamsClient(raiseDates=["20190301"])
+        statuses = self.runBatch(client)
+        self.assertTrue(all([status == "downloaded" for status in statuses.values()]))
+        # the submitted requests are resumed, not submitted again
+        self.assertEqual(len(client.controls), 24)
+        self.assertEqual(sorted(client.raised.values()), [1, 1])
+        self.assertEqual(client.purged, set(client.controls))
+
+    def testExceptionAfterRetries(self):
+        client = MockRdamsClient(raiseDates=["20190301"], numRaises=getWeatherData.MAX_REQUEST_RETRIES+1)
+        statuses = self.runBatch(client)
+        # the other requests are downloaded
+        failedKeys = sorted([key for key, status in statuses.items() if status == "failed"])
+        self.assertEqual(failedKeys, ["CISO_WIND_20190301", "global_WIND_20190301"])
+        self.assertEqual(len([status for status in statuses.values() if status == "downloaded"]), 22)
+        self.assertEqual(sorted(client.raised.values()), [getWeatherData.MAX_REQUEST_RETRIES+1]*2)
+        # still submitted (not purged): resumed on the next run
+        self.assertEqual(len(client.controls)-len(client.purged), 2)
+        statuses = self.runBatch(client)
+        self.assertTrue(all([status == "downloaded" for status in statuses.values()]))
+        self.assertEqual(len(client.controls), 24)
+
+
+if __name__ == "__main__":
+    unittest.main()
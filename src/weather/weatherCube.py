@@ -0,0 +1,76 @@
+'''
+Memory-mapped cubes of the regional weather forecasts, written by dataCollectionScript.py
+(SAVE_WEATHER_CUBES = True) & read by reaggregateWeather.py.
+One cube per region & weather variable: the cropped fields of all issue times, as float32
+[issue time, lead time, lat, lon] (lat south to north, lon west to east), in <variable>.cube (raw, C order).
+The grid axes, lead times, issue times & GRIB2 parameter of the cube are in <variable>.cube.json. The metadata
+is written after the fields, so bytes of an interrupted write are not part of the cube (& are overwritten by
+the next write).
+'''
+
+import json
+import os
+
+import numpy as np
+
+CUBE_DTYPE = np.float32
+
+
+def getCubeFileName(outFileName, weatherVariable):
+    # <dir of the output file>/cubes/<weather variable>.cube
+    return os.path.join(os.path.dirname(outFileName), "cubes", weatherVariable+".cube")
+
+def readCubeMetadata(cubeFileName):
+    if (os.path.exists(cubeFileName+".json") == False):
+        return None
+    with open(cubeFileName+".json", "r") as metadataFile:
+        return json.load(metadataFile)
+
+def writeCubeMetadata(cubeFileName, metadata):
+    tmpFileName = cubeFileName+".json."+str(os.getpid())
+    with open(tmpFileName, "w") as metadataFile:
+        json.dump(metadata, metadataFile)
+    os.replace(tmpFileName, cubeFileName+".json")
+    return
+
+def writeCubeDays(cubeFileName, issueTimes, dayCubes, gridMetadata, reset=False):
+    # Writes the [lead time, lat, lon] fields of the issue times. Issue times already in the cube are
+    # overwritten, the others are appended. gridMetadata: param, level, lat, lon & lead_times of the fields.
+    # reset: start a new cube.
+    metadata = None if reset else readCubeMetadata(cubeFileName)
+    if (metadata is None):
+        metadata = dict(gridMetadata, issue_times=[])
+    for key in ["lat", "lon"]:
+        if (len(metadata[key]) != len(gridMetadata[key]) or np.allclose(metadata[key], gridMetadata[key]) == False):
+            raise ValueError(cubeFileName+": the "+key+" axis of the new fields differs from that of the cube")
+    if (list(metadata["lead_times"]) != list(gridMetadata["lead_times"])):
+        raise ValueError(cubeFileName+": the lead times of the new fields differ from those of the cube")
+    dayShape = (len(metadata["lead_times"]), len(metadata["lat"]), len(metadata["lon"]))
+    daySize = int(np.prod(dayShape)) * np.dtype(CUBE_DTYPE).itemsize
+    issueTimeIdx = {issueTime: idx for idx, issueTime in enumerate(metadata["issue_times"])}
+    os.makedirs(os.path.dirname(cubeFileName), exist_ok=True)
+    with open(cubeFileName, "r+b" if os.path.exists(cubeFileName) and reset == False else "wb") as cubeFile:
+        cubeFile.truncate(len(metadata["issue_times"])*daySize)
+        for issueTime, dayCube in zip(issueTimes, dayCubes):
+            if (dayCube.shape != dayShape):
+                raise ValueError(cubeFileName+": fields of "+issueTime+" have shape "+str(dayCube.shape)+
+                                ", expected "+str(dayShape))
+            if (issueTime not in issueTimeIdx):
+                issueTimeIdx[issueTime] = len(metadata["issue_times"])
+                metadata["issue_times"].append(issueTime)
+            cubeFile.seek(issueTimeIdx[issueTime]*daySize)
+            cubeFile.write(np.ascontiguousarray(dayCube, dtype=CUBE_DTYPE).tobytes())
+        cubeFile.flush()
+        os.fsync(cubeFile.fileno())
+    writeCubeMetadata(cubeFileName, metadata)
+    return metadata
+
+def loadCube(cubeFileName):
+    # Returns the metadata & the read-only [issue time, lead time, lat, lon] memory map of the cube
+    metadata = readCubeMetadata(cubeFileName)
+    if (metadata is None):
+        raise FileNotFoundError(cubeFileName+".json")
+    shape = (len(metadata["issue_times"]), len(metadata["lead_times"]), len(metadata["lat"]), len(metadata["lon"]))
+    if (shape[0] == 0):
+        return metadata, np.zeros(shape, dtype=CUBE_DTYPE)
+    return metadata, np.memmap(cubeFileName, dtype=CUBE_DTYPE, mode="r", shape=shape)
@@ -0,0 +1,78 @@
+'''
+Weather (& source production) forecasts of a region, indexed by (issue time, lead hour).
+The forecast files have one block of leadHours hourly rows per issue day (row k of a block is the forecast
+for <issue time> + k hours). The store keeps the rows as a [issue day, lead hour, feature] array with the
+issue times as its index, so that the forecast of an issue time for leads a..b is a view of the array
+(found in O(1)), instead of walking the flat rows with hand-maintained offsets.
+'''
+
+import numpy as np
+
+
+class WeatherForecastStore:
+    def __init__(self, rows, leadHours, rowTimes=None):
+        # rows: [(issue days x leadHours), features], rowTimes: the UTC time of each row (optional)
+        rows = np.asarray(rows)
+        if (len(rows) % leadHours != 0):
+            raise ValueError("No. of forecast rows ("+str(len(rows))+") is not a multiple of "+str(leadHours))
+        self.leadHours = leadHours
+        self.data = rows.reshape(len(rows)//leadHours, leadHours, rows.shape[1])
+        self.issueTimes = None
+        if (rowTimes is not None):
+            self.issueTimes = np.asarray(rowTimes, dtype="datetime64[ns]")[::leadHours]
+        self.initializeIndex()
+
+    def initializeIndex(self):
+        self.issueIdx = {}
+        if (self.issueTimes is not None):
+            self.issueIdx = {issueTime: idx for idx, issueTime in enumerate(self.issueTimes)}
+
+    def __len__(self):
+        return len(self.data)
+
+    def getIssueIdx(self, issueTime):
+        # issueTime: a timestamp, or the position of the issue day in the store (negative from the end)
+        if (isinstance(issueTime, (int, np.integer))):
+            if (issueTime < -len(self.data) or issueTime >= len(self.data)):
+                raise IndexError("Issue day "+str(issueTime)+" is not in the store ("+str(len(self.data))+" days)")
+            return int(issueTime) % len(self.data)
+        issueTime = np.datetime64(issueTime, "ns")
+        if (issueTime not in self.issueIdx):
+            raise KeyError("No forecast issued at "+str(issueTime))
+        return self.issueIdx[issueTime]
+
+    def getWindow(self, issueTime, leadStart=0, leadEnd=None):
+        # [leads, features] forecast of leads leadStart..leadEnd-1. This is a view, not a copy.
+        return self.data[self.getIssueIdx(issueTime), leadStart:leadEnd]
+
+    def getWindows(self, issueIdx, leads):
+        # Forecasts of many issue days at once (a copy): issueIdx & leads are broadcast against each other,
+        # e.g. issueIdx [windows, 1] & leads [windows, hours] --> [windows, hours, features]
+        return self.data[issueIdx, leads]
+
+    def getIssueDays(self, start=None, end=None):
+        # Store of the issue days start..end-1, sharing the data of this store
+        issueDays = WeatherForecastStore.__new__(WeatherForecastStore)
+        issueDays.leadHours = self.leadHours
+        issueDays.data = self.data[start:end]
+        issueDays.issueTimes = None if self.issueTimes is None else self.issueTimes[start:end]
+        issueDays.initializeIndex()
+        return issueDays
+
+    def splitIssueDays(self, numTestDays, numValDays):
+        # Training, validation & test issue days (views). The forecast used for test day i is issued at the
+        # start of its history window, so the test store starts with the last validation issue day.
+        numTrainDays = len(self.data)-numTestDays-numValDays
+        return (self.getIssueDays(0, numTrainDays), self.getIssueDays(numTrainDays, numTrainDays+numValDays),
+                self.getIssueDays(numTrainDays+numValDays-1))
+
+    def withRows(self, rows):
+        # Store of the same issue days with other [(issue days x leadHours), features] rows
+        store = WeatherForecastStore(rows, self.leadHours)
+        store.issueTimes = self.issueTimes
+        store.initializeIndex()
+        return store
+
+    def getRows(self):
+        # Flat [(issue days x leadHours), features] rows, as in the forecast file
+        return self.data.reshape(-1, self.data.shape[2])